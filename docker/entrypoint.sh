@@ -40,6 +40,8 @@ case "$1" in
   ;;
   worker)
     echo "starting worker"
+    # validations of the worker are run by this server, it dies with the container
+    python manage.py validatorserver &
     python manage.py rqworker default gtfseditor --worker-class rqworkers.gtfseditorWorker.GTFSEditorWorker
   ;;
 esac
\ No newline at end of file
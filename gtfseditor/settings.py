@@ -11,6 +11,7 @@ https://docs.djangoproject.com/en/3.0/ref/settings/
 """
 
 import os
+import tempfile
 import sys
 from typing import List
 
@@ -142,6 +143,38 @@ STATIC_URL = '/static/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 MEDIA_URL = '/media/'
 
+# uploaded GTFS files wait here until the worker loads them, it has to be shared by web server and workers
+GTFS_STAGING_ROOT = os.path.join(MEDIA_ROOT, 'staging')
+
+# GTFS imports load independent files at the same time, each one on its own database connection ('staged' mode).
+# 'uploaders' mode loads one file after another inside a single transaction, 'diff' only writes rows that changed
+# and 'bulk' builds the indexes of shape points and stop times once at the end (see rqworkers.jobs)
+GTFS_IMPORT_MODE = config('GTFS_IMPORT_MODE', default='staged')
+GTFS_IMPORT_WORKERS = config('GTFS_IMPORT_WORKERS', default=4, cast=int)
+# staged imports give up publishing when a row stays locked by an editor longer than this, and retry later
+GTFS_IMPORT_LOCK_TIMEOUT = config('GTFS_IMPORT_LOCK_TIMEOUT', default='5s')
+GTFS_IMPORT_PUBLISH_ATTEMPTS = config('GTFS_IMPORT_PUBLISH_ATTEMPTS', default=3, cast=int)
+# seconds between two updates of the progress of an import in the meta of its job
+GTFS_IMPORT_PROGRESS_INTERVAL = config('GTFS_IMPORT_PROGRESS_INTERVAL', default=2, cast=float)
+# buildgtfs (and the job that builds and validates a project) exports tables at the same time in this number of
+# processes, each one with its own database connection. 1 exports one table after another in the job process
+GTFS_BUILD_WORKERS = config('GTFS_BUILD_WORKERS', default=1, cast=int)
+# compressed files of the tables of each project, buildgtfs only exports again the tables that changed since then
+GTFS_BUILD_CACHE_ROOT = os.path.join(MEDIA_ROOT, 'build_cache')
+# validators run after each build: 'native' checks the tables of the project with SQL queries in seconds, 'jar'
+# runs the GTFS validator on the GTFS file and is skipped when the native checks already found errors
+GTFS_VALIDATORS = config('GTFS_VALIDATORS', default='native,jar', cast=Csv())
+# the jar validator runs in the validator server of the host (manage.py validatorserver) when it is listening on this
+# socket, at most GTFS_VALIDATOR_WORKERS at the same time and GTFS_VALIDATOR_TIMEOUT seconds each. Workers run it
+# by themselves when there is no server
+GTFS_VALIDATOR_SOCKET = config('GTFS_VALIDATOR_SOCKET', default=os.path.join(BASE_DIR, 'tmp', 'gtfs-validator.sock'))
+GTFS_VALIDATOR_WORKERS = config('GTFS_VALIDATOR_WORKERS', default=2, cast=int)
+GTFS_VALIDATOR_TIMEOUT = config('GTFS_VALIDATOR_TIMEOUT', default=60 * 60, cast=int)
+# each validation works in a directory of its own inside this root, better on a fast local disk. At most
+# GTFS_WORKSPACE_SLOTS validations of the host use it at the same time, the rest wait for a free slot
+GTFS_WORKSPACE_ROOT = config('GTFS_WORKSPACE_ROOT', default=os.path.join(tempfile.gettempdir(), 'gtfseditor'))
+GTFS_WORKSPACE_SLOTS = config('GTFS_WORKSPACE_SLOTS', default=2, cast=int)
+
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': [],
     'DEFAULT_RENDERER_CLASSES': (
@@ -44,6 +44,8 @@ project_router.register(r'frequencies', api_views.FrequencyViewSet, basename='pr
 
 project_router.register(r'services', api_views.ServiceViewSet, basename='project-services')
 project_router.register(r'tables', api_views.TablesViewSet, basename='project-tables')
+project_router.register(r'extracts', api_views.ExtractViewSet, basename='project-extracts')
+project_router.register(r'validationnotices', api_views.ValidationNoticeViewSet, basename='project-validationnotices')
 
 urlpatterns = [
     path(r'admin/', admin.site.urls),
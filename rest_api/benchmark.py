@@ -0,0 +1,52 @@
+import abc
+import time
+import uuid
+import zipfile
+
+from django.core.management.base import BaseCommand, CommandError
+
+from rest_api.models import Project
+from rest_api.purge import purge_project
+from rqworkers.jobs import upload_gtfs_file, IMPORT_MODE_STAGED
+
+
+class BenchmarkCommand(BaseCommand, abc.ABC):
+    """Base of the benchmark commands. It loads the GTFS zip file given as argument in a throwaway project, calls
+    benchmark with it and purges the project at the end"""
+
+    def add_arguments(self, parser):
+        parser.add_argument('zip_path', help='GTFS zip file used as input')
+        parser.add_argument('--repeat', type=int, default=3, help='times each measure is repeated, the best is kept')
+
+    def handle(self, *args, **options):
+        zip_path = options['zip_path']
+        repeat = max(1, options['repeat'])
+
+        try:
+            zipfile.ZipFile(zip_path, 'r').close()
+        except (IOError, zipfile.BadZipFile) as e:
+            raise CommandError('"{0}" is not a valid zip file: {1}'.format(zip_path, e))
+
+        # every table is loaded, so foreign keys can be resolved
+        project_obj = Project.objects.create(name='benchmark-{0}'.format(uuid.uuid4().hex[:8]))
+        try:
+            upload_gtfs_file(project_obj.pk, zip_path, mode=IMPORT_MODE_STAGED)
+            self.benchmark(project_obj, zip_path, repeat, options)
+        finally:
+            purge_project(project_obj)
+
+    @abc.abstractmethod
+    def benchmark(self, project_obj, zip_path, repeat, options):
+        """ measures and reports what the command is about, with the project loaded from zip_path """
+
+    @staticmethod
+    def measure(repeat, function):
+        """ best time in seconds of repeat calls to function """
+        best_time = None
+        for _ in range(repeat):
+            start_time = time.time()
+            function()
+            elapsed_time = time.time() - start_time
+            best_time = elapsed_time if best_time is None else min(best_time, elapsed_time)
+        # tiny tables can be processed faster than the clock resolution
+        return max(best_time, 1e-6)
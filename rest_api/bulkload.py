@@ -0,0 +1,878 @@
+import csv
+import io
+import logging
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from django.conf import settings
+from django.db import connection, transaction, DataError, OperationalError
+from django.db import models
+from django.db.models.expressions import RawSQL
+from psycopg2 import sql
+from rest_framework.exceptions import ParseError, ValidationError
+
+from rest_api.purge import purge
+
+logger = logging.getLogger(__name__)
+
+# max number of unresolved values reported back to the user
+UNRESOLVED_SAMPLE_SIZE = 20
+# first key of the advisory lock taken while a project imports a GTFS, the second one is the project
+IMPORT_LOCK_ID = 4870
+# SQLSTATE raised when lock_timeout expires
+LOCK_NOT_AVAILABLE = '55P03'
+# files whose live tables are large enough to load them without indexes when defer_indexes is used
+DEFERRED_INDEX_FILES = ['shapes.txt', 'stop_times.txt']
+
+
+class UnresolvedForeignKeyError(ValidationError):
+    """Raised when a CSV references entities (trip_id, stop_id, ...) that do not exist in the project"""
+
+    def __init__(self, filename, csv_key, values, count):
+        self.filename = filename
+        self.csv_key = csv_key
+        self.values = values
+        self.count = count
+        self.message = '{0}: {1} value(s) in column "{2}" do not exist in project: {3}'.format(
+            filename, count, csv_key, ', '.join(map(str, values)))
+        super().__init__(dict(filename=filename, field=csv_key, values=values, count=count, message=self.message))
+
+    def __str__(self):
+        return self.message
+
+
+class DuplicatedRowError(ValidationError):
+    """Raised when a CSV has more than one row with the same natural id (stop_id, (trip_id, stop_sequence), ...)"""
+
+    def __init__(self, filename, csv_keys, values, count):
+        self.filename = filename
+        self.csv_keys = csv_keys
+        self.values = values
+        self.count = count
+        self.message = '{0}: {1} value(s) of ({2}) are repeated: {3}'.format(
+            filename, count, ', '.join(csv_keys), ', '.join(map(str, values)))
+        super().__init__(dict(filename=filename, fields=csv_keys, values=values, count=count, message=self.message))
+
+    def __str__(self):
+        return self.message
+
+
+class CopyStream:
+    """File-like object that feeds COPY FROM STDIN with the lines of a text file, skipping blank lines
+    (csv.DictReader ignores them but COPY would read them as rows with missing columns).
+    on_read is called after each block with the number of lines read so far"""
+
+    def __init__(self, text_file, on_read=None):
+        self.lines = iter(text_file)
+        self.on_read = on_read
+        self.line_number = 0
+
+    def read(self, size=-1):
+        buffer = list()
+        length = 0
+        for line in self.lines:
+            if line.strip('\r\n') == '':
+                continue
+            buffer.append(line)
+            length += len(line)
+            if 0 < size <= length:
+                break
+        self.line_number += len(buffer)
+        if self.on_read is not None:
+            self.on_read(self.line_number)
+        return ''.join(buffer)
+
+
+def cast_expression(field, expression):
+    """ SQL expression that converts a text column from a GTFS file to the database type of field """
+    expression = sql.SQL("NULLIF({0}, '')").format(expression)
+    if isinstance(field, models.DateField):
+        return sql.SQL("to_date({0}, 'YYYYMMDD')").format(expression)
+    return sql.SQL('CAST({0} AS {1})').format(expression, sql.SQL(field.db_type(connection)))
+
+
+def get_column(model, key):
+    """ database column of model referenced by key, which can be either the name of a field or its column """
+    for field in model._meta.concrete_fields:
+        if key in [field.name, field.column]:
+            return field.column
+    raise ValueError('{0} does not have a field named "{1}"'.format(model.__name__, key))
+
+
+def read_header(text_file):
+    return [column.strip() for column in next(csv.reader([text_file.readline()]), [])]
+
+
+def copy_into_table(cursor, text_file, table_name, filename, temporary=True, on_read=None):
+    """Creates table_name with one text column per column of the CSV header and fills it with COPY FROM STDIN.
+    on_read is passed to CopyStream. Returns the header"""
+    header = read_header(text_file)
+    if len(header) == 0 or len(set(header)) != len(header):
+        raise ParseError('{0}: header is empty or has repeated columns'.format(filename))
+
+    table = sql.Identifier(table_name)
+    cursor.execute(sql.SQL('DROP TABLE IF EXISTS {0}').format(table))
+    create_query = 'CREATE TEMPORARY TABLE {0} ({1}) ON COMMIT DROP' if temporary else \
+        'CREATE UNLOGGED TABLE {0} ({1})'
+    cursor.execute(sql.SQL(create_query).format(
+        table, sql.SQL(', ').join([sql.SQL('{0} text').format(sql.Identifier(c)) for c in header])))
+    try:
+        with transaction.atomic():
+            cursor.copy_expert(sql.SQL('COPY {0} ({1}) FROM STDIN WITH (FORMAT csv)').format(
+                table, sql.SQL(', ').join(map(sql.Identifier, header))).as_string(cursor.connection),
+                CopyStream(text_file, on_read))
+    except DataError as e:
+        raise ParseError('{0}: {1}'.format(filename, e))
+
+    return header
+
+
+def get_parent_query(fk, project_pk, with_id=True):
+    """ SQL (and its params) that lists the natural ids (and primary keys) of the parent model of fk in project """
+    fields = [fk['model_key'], 'id'] if with_id else [fk['model_key']]
+    query, params = fk['model'].objects.filter_by_project(project_pk).values_list(*fields).query.sql_with_params()
+    return query, list(params)
+
+
+def check_foreign_key(cursor, table_name, csv_key, parent_sql, parent_params, filename):
+    """ raises UnresolvedForeignKeyError if values of column csv_key are not among the natural ids of parent_sql """
+    query = sql.SQL(
+        'SELECT s.{0}, count(*) OVER () FROM {1} s WHERE s.{0} IS NOT NULL AND s.{0} <> {2} AND NOT EXISTS '
+        '(SELECT 1 FROM ({3}) AS p WHERE p.natural_id = s.{0}) GROUP BY s.{0} ORDER BY s.{0} LIMIT {4}').format(
+        sql.Identifier(csv_key), sql.Identifier(table_name), sql.Literal(''), sql.SQL(parent_sql),
+        sql.Literal(UNRESOLVED_SAMPLE_SIZE))
+    cursor.execute(query, parent_params)
+    unresolved = cursor.fetchall()
+    if len(unresolved) > 0:
+        raise UnresolvedForeignKeyError(filename, csv_key, [row[0] for row in unresolved], unresolved[0][1])
+
+
+def copy_csv_to_model(file, model, project_pk, foreign_key_mappings, filename, include_project_id=False,
+                      on_read=None):
+    """Loads a GTFS file into the table of model using COPY FROM STDIN.
+    The file is streamed into a temporary table, foreign keys are resolved with one join per key against the rows of
+    the project and everything is inserted with a single INSERT ... SELECT statement.
+    foreign_key_mappings follows the same format as the one used by CSVUploadMixin, on_read is passed to CopyStream.
+    Returns the number of inserted rows."""
+    with io.TextIOWrapper(file, encoding='utf-8-sig', newline='') as text_file, transaction.atomic(), \
+            connection.cursor() as cursor:
+        staging_table = 'staging_{0}'.format(model._meta.db_table)
+        header = copy_into_table(cursor, text_file, staging_table, filename, on_read=on_read)
+
+        # every foreign key is resolved with the natural ids of the project
+        joins = list()
+        params = list()
+        fk_columns = dict()
+        for index, fk in enumerate(foreign_key_mappings):
+            csv_key = fk['csv_key']
+            if csv_key not in header:
+                continue
+            parent_sql, parent_params = get_parent_query(fk, project_pk)
+            check_foreign_key(cursor, staging_table, csv_key,
+                              'SELECT natural_id FROM ({0}) AS parent (natural_id, id)'.format(parent_sql),
+                              parent_params, filename)
+
+            alias = sql.Identifier('fk{0}'.format(index))
+            joins.append(sql.SQL('LEFT JOIN ({0}) AS {1} (natural_id, id) ON {1}.natural_id = s.{2}').format(
+                sql.SQL(parent_sql), alias, sql.Identifier(csv_key)))
+            params += parent_params
+            fk_columns[get_column(model, fk.get('internal_key', fk['model_key']))] = \
+                sql.SQL('{0}.id').format(alias)
+
+        target_columns = list()
+        values = list()
+        for field in model._meta.concrete_fields:
+            if field.primary_key:
+                continue
+            if field.column in fk_columns:
+                values.append(fk_columns[field.column])
+            elif field.column == 'project_id' and include_project_id:
+                values.append(sql.Literal(project_pk))
+            elif field.is_relation or field.column not in header:
+                continue
+            else:
+                values.append(cast_expression(field, sql.SQL('s.{0}').format(sql.Identifier(field.column))))
+            target_columns.append(sql.Identifier(field.column))
+
+        insert_query = sql.SQL('INSERT INTO {0} ({1}) SELECT {2} FROM {3} s {4}').format(
+            sql.Identifier(model._meta.db_table), sql.SQL(', ').join(target_columns), sql.SQL(', ').join(values),
+            sql.Identifier(staging_table), sql.SQL(' ').join(joins))
+        try:
+            with transaction.atomic():
+                cursor.execute(insert_query, params)
+        except DataError as e:
+            raise ParseError('{0}: {1}'.format(filename, e))
+        row_number = cursor.rowcount
+        logger.info('{0}: {1} rows loaded with COPY'.format(filename, row_number))
+
+        return row_number
+
+
+def run_in_dependency_order(tasks, dependencies, workers):
+    """Runs the callables of tasks (a dict name -> callable) in a pool of threads, each task starts as soon as every
+    task listed in dependencies[name] has finished. Every thread uses (and closes) its own database connection.
+    Returns a dict name -> (start, end), both measured in seconds since the first task started"""
+    start_time = time.time()
+    timings = dict()
+
+    def run(name):
+        task_start = time.time() - start_time
+        try:
+            tasks[name]()
+        finally:
+            connection.close()
+        return task_start, time.time() - start_time
+
+    pending = set(tasks)
+    running = dict()
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        try:
+            while pending or running:
+                ready = [name for name in sorted(pending) if all(
+                    dependency in timings for dependency in dependencies.get(name, []) if dependency in tasks)]
+                if not ready and not running:
+                    raise ValueError('there is a dependency cycle among {0}'.format(', '.join(sorted(pending))))
+                for name in ready:
+                    pending.remove(name)
+                    running[executor.submit(run, name)] = name
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    timings[running.pop(future)] = future.result()
+        except Exception:
+            for future in running:
+                future.cancel()
+            raise
+
+    return timings
+
+
+def get_critical_path(timings, dependencies):
+    """ chain of tasks that bounded the total time: starting from the last task to finish, each step goes back to the
+    dependency that finished last """
+    path = list()
+    name = max(timings, key=lambda task: timings[task][1]) if timings else None
+    while name is not None:
+        path.append(name)
+        finished_dependencies = [dependency for dependency in dependencies.get(name, []) if dependency in timings]
+        name = max(finished_dependencies, key=lambda task: timings[task][1]) if finished_dependencies else None
+    return path[::-1]
+
+
+class StagedTable:
+    """GTFS file loaded into an unlogged staging table before being published in the live tables.
+    It is configured with the Meta class of the viewset in charge of the file, the same one used by CSVUploadMixin"""
+
+    def __init__(self, filename, meta, prefix):
+        self.filename = filename
+        self.model = meta.model
+        self.models = [meta.model]
+        self.csv_header = meta.csv_header
+        self.rename_fields = getattr(meta, 'rename_fields', dict())
+        self.include_project_id = getattr(meta, 'include_project_id', True) and \
+            'project_id' in [field.column for field in self.model._meta.concrete_fields]
+        self.foreign_key_mappings = [dict(internal_key=fk['model_key'], **fk) if 'internal_key' not in fk else fk
+                                     for fk in getattr(meta, 'foreign_key_mappings', [])]
+        # rows with a natural id keep their primary key (and the rows referencing them) when they are updated
+        self.natural_id_name = None
+        self.natural_key = None
+        if getattr(meta, 'use_internal_id', True) and hasattr(self.model.objects, 'get_internal_id_name'):
+            self.natural_id_name = self.model.objects.get_internal_id_name()
+            self.natural_key = get_column(self.model, self.natural_id_name)
+        self.table_name = '{0}_{1}'.format(prefix, filename.replace('.txt', ''))
+        self.header = list()
+        self.unchecked_foreign_keys = list()
+        self.row_number = 0
+
+    @property
+    def raw_table_name(self):
+        return '{0}_raw'.format(self.table_name)
+
+    def get_parent_models(self):
+        return [fk['model'] for fk in self.foreign_key_mappings if fk['model'] not in self.models]
+
+    def get_field(self, column):
+        column = self.rename_fields.get(column, column)
+        for field in self.model._meta.concrete_fields:
+            if not field.is_relation and column in [field.name, field.column]:
+                return field
+        return None
+
+    def stage(self, zip_file_obj, project_pk, staged_parents, progress=None):
+        """Copies the file to a staging table converting each column to its final type. Natural ids used as
+        foreign keys are kept and checked against the parent file, or the project rows if the parent file is not
+        part of the import. staged_parents is a dict model -> StagedTable, progress an ImportProgress"""
+        on_read = None
+        if progress is not None:
+            progress.start(self.filename, zip_file_obj.getinfo(self.filename).file_size)
+        with zip_file_obj.open(self.filename, 'r') as file_obj, \
+                io.TextIOWrapper(file_obj, encoding='utf-8-sig', newline='') as text_file, \
+                connection.cursor() as cursor:
+            if progress is not None:
+                on_read = progress.reporter(self.filename, file_obj)
+            header = copy_into_table(cursor, text_file, self.raw_table_name, self.filename, temporary=False,
+                                     on_read=on_read)
+
+            fk_keys = [fk['csv_key'] for fk in self.foreign_key_mappings]
+            columns = list()
+            for column in header:
+                field = self.get_field(column)
+                if column not in self.csv_header:
+                    continue
+                elif column in fk_keys:
+                    columns.append(sql.SQL('{0}').format(sql.Identifier(column)))
+                elif field is not None:
+                    columns.append(sql.SQL('{0} AS {1}').format(
+                        cast_expression(field, sql.Identifier(column)), sql.Identifier(field.column)))
+                else:
+                    continue
+                self.header.append(column)
+            try:
+                with transaction.atomic():
+                    cursor.execute(sql.SQL('CREATE UNLOGGED TABLE {0} AS SELECT {1} FROM {2}').format(
+                        sql.Identifier(self.table_name), sql.SQL(', ').join(columns),
+                        sql.Identifier(self.raw_table_name)))
+            except DataError as e:
+                raise ParseError('{0}: {1}'.format(self.filename, e))
+            self.row_number = cursor.rowcount
+            cursor.execute(sql.SQL('DROP TABLE {0}').format(sql.Identifier(self.raw_table_name)))
+            # staging tables have no statistics until they are analyzed, joins would be planned blindly
+            cursor.execute(sql.SQL('ANALYZE {0}').format(sql.Identifier(self.table_name)))
+
+            self.check_required_values(cursor)
+            self.check_unique_values(cursor)
+
+            for fk in self.foreign_key_mappings:
+                if fk['csv_key'] not in self.header or fk['model'] in self.models and fk['model'] is not self.model:
+                    # models created from this same file have every referenced row
+                    continue
+                if fk['model'] is self.model:
+                    parent_sql, parent_params = self.get_natural_id_query(fk['model'], fk['model_key'], cursor)
+                elif fk['model'] in staged_parents:
+                    parent_sql, parent_params = staged_parents[fk['model']].get_natural_id_query(
+                        fk['model'], fk['model_key'], cursor)
+                else:
+                    # rows of the project are checked when they are published, inside the final transaction
+                    self.unchecked_foreign_keys.append(fk)
+                    continue
+                check_foreign_key(cursor, self.table_name, fk['csv_key'],
+                                  'SELECT natural_id FROM ({0}) AS parent (natural_id)'.format(parent_sql),
+                                  parent_params, self.filename)
+        if progress is not None:
+            progress.finish(self.filename)
+
+    def get_staged_column(self, field):
+        """ column of the staging table that will fill field, None if the file does not have it """
+        if field.is_relation:
+            for fk in self.foreign_key_mappings:
+                if fk['csv_key'] in self.header and get_column(self.model, fk['internal_key']) == field.column:
+                    return fk['csv_key']
+            return None
+        for column in self.header:
+            if self.get_field(column) is field:
+                return field.column
+        return None
+
+    def check_required_values(self, cursor):
+        """ every field that does not accept nulls has a value in each row """
+        for field in self.model._meta.concrete_fields:
+            if field.primary_key or field.null or field.column == 'project_id' or field.get_default() is not None:
+                continue
+            column = self.get_staged_column(field)
+            if column is None:
+                if field.is_relation and field.related_model in self.models:
+                    continue
+                raise ValidationError('{0}: column "{1}" is mandatory'.format(self.filename, field.name))
+            cursor.execute(sql.SQL("SELECT count(*) FROM {0} WHERE {1} IS NULL OR {1}::text = ''").format(
+                sql.Identifier(self.table_name), sql.Identifier(column)))
+            count = cursor.fetchone()[0]
+            if count > 0:
+                raise ValidationError('{0}: column "{1}" is empty in {2} row(s)'.format(self.filename, column, count))
+
+    def check_unique_values(self, cursor):
+        """ rows are unique according to the unique_together constraints of the model """
+        for field_names in self.model._meta.unique_together:
+            columns = list()
+            for field_name in field_names:
+                field = self.model._meta.get_field(field_name)
+                if field.column == 'project_id':
+                    continue
+                columns.append(self.get_staged_column(field))
+            if None in columns or len(columns) == 0:
+                continue
+            identifiers = sql.SQL(', ').join(map(sql.Identifier, columns))
+            cursor.execute(sql.SQL('SELECT concat_ws({0}, {1}), count(*) OVER () FROM {2} GROUP BY {1} '
+                                   'HAVING count(*) > 1 ORDER BY 1 LIMIT {3}').format(
+                sql.Literal('/'), identifiers, sql.Identifier(self.table_name), sql.Literal(UNRESOLVED_SAMPLE_SIZE)))
+            duplicated = cursor.fetchall()
+            if len(duplicated) > 0:
+                raise DuplicatedRowError(self.filename, columns, [row[0] for row in duplicated], duplicated[0][1])
+
+    def get_natural_id_query(self, model, model_key, cursor):
+        column = model_key if model_key in self.header else get_column(model, model_key)
+        return 'SELECT {0} FROM {1}'.format(sql.Identifier(column).as_string(cursor.connection),
+                                            sql.Identifier(self.table_name).as_string(cursor.connection)), []
+
+    def get_project_rows(self, project_pk):
+        """ SQL (and its params) listing natural id and primary key of the rows of project """
+        query, params = self.model.objects.filter_by_project(project_pk).values_list(self.natural_id_name, 'id') \
+            .query.sql_with_params()
+        return query, list(params)
+
+    def get_project_ids(self, project_pk):
+        """ SQL (and its params) listing the primary keys of the rows of project """
+        query, params = self.model.objects.filter_by_project(project_pk).values_list('id').query.sql_with_params()
+        return query, list(params)
+
+    def get_key_columns(self, diff):
+        """Columns of the live table that identify a row of the file. Without diff only the natural id is used, with
+        diff the unique_together constraints of the model are used too ((trip_id, stop_sequence) for stop times).
+        Returns None when rows can not be identified, they are replaced"""
+        if self.natural_key is not None:
+            return [self.natural_key]
+        if not diff:
+            return None
+        for field_names in self.model._meta.unique_together:
+            fields = [self.model._meta.get_field(field_name) for field_name in field_names]
+            fields = [field for field in fields if field.column != 'project_id']
+            if len(fields) > 0 and all(self.get_staged_column(field) is not None for field in fields):
+                return [field.column for field in fields]
+        return None
+
+    def get_new_rows(self, project_pk):
+        """Query of the staged rows as they will be stored, foreign keys are resolved with the rows of the project.
+        Returns the query, its params, the live columns (the i-th one is aliased as c<i>) and the foreign keys that
+        point to the same file"""
+        joins = list()
+        params = list()
+        target_columns = list()
+        values = list()
+        self_references = list()
+        for index, fk in enumerate(self.foreign_key_mappings):
+            if fk['csv_key'] not in self.header:
+                continue
+            if fk['model'] is self.model:
+                self_references.append(fk)
+                continue
+            alias = sql.Identifier('fk{0}'.format(index))
+            parent_sql, parent_params = get_parent_query(fk, project_pk)
+            joins.append(sql.SQL('LEFT JOIN ({0}) AS {1} (natural_id, id) ON {1}.natural_id = s.{2}').format(
+                sql.SQL(parent_sql), alias, sql.Identifier(fk['csv_key'])))
+            params += parent_params
+            target_columns.append(get_column(self.model, fk['internal_key']))
+            values.append(sql.SQL('{0}.id').format(alias))
+        for column in self.header:
+            field = self.get_field(column)
+            if column not in [fk['csv_key'] for fk in self.foreign_key_mappings] and field is not None:
+                target_columns.append(field.column)
+                values.append(sql.SQL('s.{0}').format(sql.Identifier(field.column)))
+        if self.include_project_id:
+            target_columns.append('project_id')
+            values.append(sql.Literal(project_pk))
+
+        new_rows = sql.SQL('SELECT {0} FROM {1} s {2}').format(
+            sql.SQL(', ').join([sql.SQL('{0} AS {1}').format(value, self.alias(index))
+                                for index, value in enumerate(values)]),
+            sql.Identifier(self.table_name), sql.SQL(' ').join(joins))
+        return new_rows, params, target_columns, self_references
+
+    @staticmethod
+    def alias(index):
+        return sql.Identifier('c{0}'.format(index))
+
+    def key_condition(self, target_columns, key_columns):
+        """Condition that matches a live row (t) with a new one (n). When rows do not have a key (key_columns is
+        None) they are matched by their whole content"""
+        operator = sql.SQL('=')
+        if key_columns is None:
+            key_columns = [column for column in target_columns if column != 'project_id']
+            operator = sql.SQL('IS NOT DISTINCT FROM')
+        return sql.SQL(' AND ').join([sql.SQL('t.{0} {1} n.{2}').format(
+            sql.Identifier(column), operator, self.alias(target_columns.index(column))) for column in key_columns])
+
+    def delete(self, project_pk, diff=False):
+        """Deletes the rows that are going to be replaced, rows that are identified by get_key_columns and are still
+        present in the file are kept. Returns the number of deleted rows"""
+        key_columns = self.get_key_columns(diff)
+        queryset = self.model.objects.filter_by_project(project_pk)
+        if key_columns is not None and key_columns == [self.natural_key]:
+            queryset = queryset.exclude(**{'{0}__in'.format(self.natural_id_name): RawSQL(
+                'SELECT "{0}" FROM "{1}"'.format(self.natural_key, self.table_name), [])})
+        elif key_columns is not None or diff:
+            new_rows, params, target_columns, _ = self.get_new_rows(project_pk)
+            project_sql, project_params = self.get_project_ids(project_pk)
+            with connection.cursor() as cursor:
+                removed_query = sql.SQL('SELECT t.id FROM {0} t JOIN ({1}) AS p (id) ON p.id = t.id WHERE NOT EXISTS '
+                                        '(SELECT 1 FROM ({2}) AS n WHERE {3})').format(
+                    sql.Identifier(self.model._meta.db_table), sql.SQL(project_sql), new_rows,
+                    self.key_condition(target_columns, key_columns)).as_string(cursor.connection)
+            queryset = queryset.filter(id__in=RawSQL(removed_query, project_params + params))
+        _, deleted_rows = purge(queryset)
+        return deleted_rows.get(self.model._meta.label, 0)
+
+    def publish(self, cursor, project_pk, diff=False):
+        """Writes the staged rows in the live table, it has to run after the parents were published.
+        Rows identified by get_key_columns are updated in place (with diff, only if their content changed) and the
+        rest are inserted. Returns the number of inserted and updated rows"""
+        for fk in self.unchecked_foreign_keys:
+            parent_sql, parent_params = get_parent_query(fk, project_pk, with_id=False)
+            check_foreign_key(cursor, self.table_name, fk['csv_key'],
+                              'SELECT natural_id FROM ({0}) AS parent (natural_id)'.format(parent_sql),
+                              parent_params, self.filename)
+
+        new_rows, params, target_columns, self_references = self.get_new_rows(project_pk)
+        aliases = [self.alias(index) for index in range(len(target_columns))]
+
+        # new rows get the default value of the fields missing in the file, as the model would do
+        default_columns = list()
+        default_values = list()
+        for field in self.model._meta.concrete_fields:
+            if field.primary_key or field.is_relation or field.column in target_columns:
+                continue
+            default = field.get_default()
+            if default is not None:
+                default_columns.append(field.column)
+                default_values.append(sql.Literal(field.get_db_prep_save(default, connection)))
+
+        table = sql.Identifier(self.model._meta.db_table)
+        # ids of inserted rows are only needed to tell them apart from updated ones when references are solved
+        returning = sql.SQL(' RETURNING t.id' if self_references else '')
+        insert_query = sql.SQL('INSERT INTO {0} AS t ({1}) SELECT {2} FROM ({3}) AS n').format(
+            table, sql.SQL(', ').join(map(sql.Identifier, target_columns + default_columns)),
+            sql.SQL(', ').join(aliases + default_values), new_rows)
+
+        key_columns = self.get_key_columns(diff)
+        changed = 0
+        updated_ids = set()
+        if key_columns is None and not diff:
+            cursor.execute(insert_query + returning, params)
+        else:
+            project_sql, project_params = self.get_project_ids(project_pk)
+            # rows without key are never changed, they are added or removed
+            if key_columns is not None:
+                # rows are compared by the hash of their content, so only rows that changed are rewritten
+                changed_condition = sql.SQL(' AND md5(ROW({0})::text) <> md5(ROW({1})::text)').format(
+                    sql.SQL(', ').join([sql.SQL('t.{0}').format(sql.Identifier(column)) for column in target_columns]),
+                    sql.SQL(', ').join([sql.SQL('n.{0}').format(alias) for alias in aliases])) if diff else sql.SQL('')
+                cursor.execute(sql.SQL('UPDATE {0} t SET {1} FROM ({2}) AS n, ({3}) AS p (id) '
+                                       'WHERE t.id = p.id AND {4}{5}{6}').format(
+                    table, sql.SQL(', ').join([sql.SQL('{0} = n.{1}').format(sql.Identifier(column), alias)
+                                               for column, alias in zip(target_columns, aliases)]),
+                    new_rows, sql.SQL(project_sql), self.key_condition(target_columns, key_columns),
+                    changed_condition, returning), params + project_params)
+                changed = cursor.rowcount
+                updated_ids = set(row[0] for row in cursor.fetchall()) if self_references else set()
+            cursor.execute(sql.SQL('{0} WHERE NOT EXISTS (SELECT 1 FROM {1} t JOIN ({2}) AS p (id) ON p.id = t.id '
+                                   'WHERE {3}){4}').format(
+                insert_query, table, sql.SQL(project_sql), self.key_condition(target_columns, key_columns),
+                returning), params + project_params)
+        added = cursor.rowcount
+        inserted_ids = set(row[0] for row in cursor.fetchall()) if self_references else set()
+
+        # references to rows of the same file (like parent_station) are solved once every row exists
+        for fk in self_references:
+            project_sql, project_params = self.get_project_rows(project_pk)
+            parent_sql, parent_params = get_parent_query(fk, project_pk)
+            column = sql.Identifier(get_column(self.model, fk['internal_key']))
+            cursor.execute(sql.SQL(
+                'UPDATE {0} t SET {1} = p.id FROM {2} s JOIN ({3}) AS c (natural_id, id) ON c.natural_id = s.{4} '
+                'LEFT JOIN ({5}) AS p (natural_id, id) ON p.natural_id = s.{6} '
+                'WHERE t.id = c.id AND t.{1} IS DISTINCT FROM p.id RETURNING t.id').format(
+                table, column, sql.Identifier(self.table_name), sql.SQL(project_sql),
+                sql.Identifier(self.natural_key), sql.SQL(parent_sql), sql.Identifier(fk['csv_key'])),
+                project_params + parent_params)
+            updated_ids.update(row[0] for row in cursor.fetchall())
+        if self_references:
+            changed = len(updated_ids - inserted_ids)
+
+        return dict(added=added, changed=changed)
+
+    def drop(self, cursor):
+        for table_name in [self.raw_table_name, self.table_name]:
+            cursor.execute(sql.SQL('DROP TABLE IF EXISTS {0}').format(sql.Identifier(table_name)))
+
+
+class ShapesStagedTable(StagedTable):
+    """ shapes.txt creates the shapes besides their points """
+
+    def __init__(self, filename, meta, prefix):
+        super().__init__(filename, meta, prefix)
+        self.shape_model = [fk['model'] for fk in self.foreign_key_mappings if fk['csv_key'] == 'shape_id'][0]
+        self.models.append(self.shape_model)
+
+    def get_natural_id_query(self, model, model_key, cursor):
+        if model is self.shape_model:
+            return 'SELECT DISTINCT shape_id FROM {0}'.format(
+                sql.Identifier(self.table_name).as_string(cursor.connection)), []
+        return super().get_natural_id_query(model, model_key, cursor)
+
+    def delete(self, project_pk, diff=False):
+        # without diff points are always replaced, shapes are kept while their shape_id is still in the file
+        deleted_rows = super().delete(project_pk, diff)
+        purge(self.shape_model.objects.filter_by_project(project_pk).exclude(
+            shape_id__in=RawSQL('SELECT shape_id FROM "{0}"'.format(self.table_name), [])))
+        return deleted_rows
+
+    def publish(self, cursor, project_pk, diff=False):
+        shape_sql, shape_params = self.shape_model.objects.filter_by_project(project_pk).values_list('shape_id') \
+            .query.sql_with_params()
+        cursor.execute(sql.SQL('INSERT INTO {0} (project_id, shape_id) SELECT DISTINCT {1}, s.shape_id FROM {2} s '
+                               'WHERE NOT EXISTS (SELECT 1 FROM ({3}) AS c (shape_id) '
+                               'WHERE c.shape_id = s.shape_id)').format(
+            sql.Identifier(self.shape_model._meta.db_table), sql.Literal(project_pk), sql.Identifier(self.table_name),
+            sql.SQL(shape_sql)), shape_params)
+        return super().publish(cursor, project_pk, diff)
+
+
+class DeferredIndexes:
+    """Secondary indexes, unique and foreign key constraints of a live table, dropped before a large load and
+    created again once at the end instead of being maintained row by row.
+    Dropping them locks the whole table (every project) until commit, so it must happen inside the publish
+    transaction: if anything fails, the rollback brings them back"""
+
+    def __init__(self, filename, model):
+        self.filename = filename
+        self.model = model
+        self.table_name = model._meta.db_table
+        # (name, definition) of each dropped object
+        self.constraints = list()
+        self.indexes = list()
+
+    def drop(self, cursor):
+        table = sql.Identifier(self.table_name)
+        # pending checks of deferred constraints would forbid altering the tables they belong to
+        cursor.execute('SET CONSTRAINTS ALL IMMEDIATE')
+        cursor.execute("SELECT conname, pg_get_constraintdef(oid) FROM pg_constraint "
+                       "WHERE conrelid = %s::regclass AND contype IN ('u', 'f') ORDER BY conname", [self.table_name])
+        self.constraints = cursor.fetchall()
+        for name, _ in self.constraints:
+            cursor.execute(sql.SQL('ALTER TABLE {0} DROP CONSTRAINT {1}').format(table, sql.Identifier(name)))
+        # indexes of unique constraints were dropped with them
+        cursor.execute('SELECT c.relname, pg_get_indexdef(i.indexrelid) FROM pg_index i '
+                       'JOIN pg_class c ON c.oid = i.indexrelid WHERE i.indrelid = %s::regclass AND NOT i.indisprimary '
+                       'ORDER BY c.relname', [self.table_name])
+        self.indexes = cursor.fetchall()
+        for name, _ in self.indexes:
+            cursor.execute(sql.SQL('DROP INDEX {0}').format(sql.Identifier(name)))
+        logger.info('{0}: {1} constraint(s) and {2} index(es) deferred'.format(
+            self.table_name, len(self.constraints), len(self.indexes)))
+
+    def check_unique_values(self, cursor, project_pk):
+        """Rows of the project are unique according to the unique_together constraints of the model, it is checked
+        with a single GROUP BY query before the unique indexes are built again. Offending rows are reported by their
+        natural keys ((trip_id, stop_sequence) for stop times)"""
+        for field_names in self.model._meta.unique_together:
+            key_names = list()
+            for field_name in field_names:
+                field = self.model._meta.get_field(field_name)
+                if field.column == 'project_id':
+                    continue
+                if field.is_relation and hasattr(field.related_model.objects, 'get_internal_id_name'):
+                    key_names.append('{0}__{1}'.format(field.name, field.related_model.objects.get_internal_id_name()))
+                else:
+                    key_names.append(field.name)
+            duplicated_query, params = self.model.objects.filter_by_project(project_pk).values(*key_names) \
+                .annotate(repeated=models.Count('id')).filter(repeated__gt=1).order_by(*key_names) \
+                .query.sql_with_params()
+            cursor.execute('SELECT *, count(*) OVER () FROM ({0}) AS duplicated LIMIT %s'.format(duplicated_query),
+                           list(params) + [UNRESOLVED_SAMPLE_SIZE])
+            duplicated = cursor.fetchall()
+            if len(duplicated) > 0:
+                csv_keys = [key_name.split('__')[-1] for key_name in key_names]
+                raise DuplicatedRowError(self.filename, csv_keys,
+                                         ['/'.join(map(str, row[:len(key_names)])) for row in duplicated],
+                                         duplicated[0][-1])
+
+    def rebuild(self, cursor, project_pk):
+        self.check_unique_values(cursor, project_pk)
+        for _, definition in self.indexes:
+            cursor.execute(definition)
+        for name, definition in self.constraints:
+            cursor.execute(sql.SQL('ALTER TABLE {0} ADD CONSTRAINT {1} {2}').format(
+                sql.Identifier(self.table_name), sql.Identifier(name), sql.SQL(definition)))
+        self.indexes = list()
+        self.constraints = list()
+
+
+class StagedImport:
+    """Loads the files of a GTFS zip at the same time, each one on its own database connection, into staging tables
+    and then publishes all of them in the live tables of the project.
+    A file waits for the files it references (trips.txt waits for routes.txt and shapes.txt) because its foreign keys
+    are checked against their staging tables.
+    uploaders is a dict filename -> viewset, as the one used by upload_gtfs_file"""
+
+    def __init__(self, project_pk, uploaders, zip_file_obj, mandatory_files, workers=1, diff=False,
+                 defer_indexes=False, progress=None):
+        self.project_pk = project_pk
+        self.zip_file_obj = zip_file_obj
+        self.workers = workers
+        # with diff, only rows that were added, changed or removed are written
+        self.diff = diff
+        # with defer_indexes, DEFERRED_INDEX_FILES are published without indexes and constraints, see DeferredIndexes
+        self.defer_indexes = defer_indexes
+        # ImportProgress updated while files are staged
+        self.progress = progress
+        # staging tables belong to the project, leftovers of an interrupted import can be found and dropped
+        self.project_prefix = 'gtfs_staging_{0}_'.format(project_pk)
+        self.prefix = '{0}{1}'.format(self.project_prefix, uuid.uuid4().hex[:8])
+        names = zip_file_obj.namelist()
+        for filename in mandatory_files:
+            if filename not in names:
+                logger.error('file "{0}" is mandatory'.format(filename))
+                raise ValidationError('{0} file is mandatory'.format(filename))
+
+        self.tables = dict()
+        for filename, uploader in uploaders.items():
+            if filename not in names:
+                logger.info('file "{0}" does not exist in zip file'.format(filename))
+                continue
+            staged_table_class = ShapesStagedTable if filename == 'shapes.txt' else StagedTable
+            self.tables[filename] = staged_table_class(filename, uploader.Meta(), self.prefix)
+
+        self.files_by_model = dict()
+        for filename, table in self.tables.items():
+            for model in table.models:
+                self.files_by_model[model] = filename
+        self.dependencies = {filename: [self.files_by_model[model] for model in table.get_parent_models() if
+                                        model in self.files_by_model] for filename, table in self.tables.items()}
+        self.timings = dict()
+        self.publish_timings = dict()
+        # rows added, changed and removed by file
+        self.changes = dict()
+
+    def get_publish_order(self):
+        order = list()
+        pending = sorted(self.tables)
+        while pending:
+            ready = [filename for filename in pending if all(d in order for d in self.dependencies[filename])]
+            if not ready:
+                raise ValueError('there is a dependency cycle among {0}'.format(', '.join(pending)))
+            order += ready
+            pending = [filename for filename in pending if filename not in ready]
+        return order
+
+    def stage(self):
+        staged_parents = {model: self.tables[filename] for model, filename in self.files_by_model.items()}
+
+        def stage_task(table):
+            return lambda: table.stage(self.zip_file_obj, self.project_pk, staged_parents, self.progress)
+
+        tasks = {filename: stage_task(table) for filename, table in self.tables.items()}
+        self.timings = run_in_dependency_order(tasks, self.dependencies, self.workers)
+
+    def publish(self):
+        """Replaces the project rows of every staged file, it must be called inside a transaction.
+        Only row locks are taken, so readers keep seeing the previous version until commit. If an editor holds one
+        of those rows for more than settings.GTFS_IMPORT_LOCK_TIMEOUT the publication fails instead of waiting.
+        With defer_indexes the tables of DEFERRED_INDEX_FILES are locked entirely instead, until commit"""
+        order = self.get_publish_order()
+        with connection.cursor() as cursor:
+            cursor.execute('SET LOCAL lock_timeout = %s', [settings.GTFS_IMPORT_LOCK_TIMEOUT])
+            for filename in reversed(order):
+                start_time = time.time()
+                removed = self.tables[filename].delete(self.project_pk, self.diff)
+                self.changes[filename] = dict(removed=removed)
+                self.publish_timings[filename] = time.time() - start_time
+            # indexes are dropped after deletions, cascades still look up the rows to delete through them
+            deferred_indexes = dict()
+            if self.defer_indexes:
+                for filename in DEFERRED_INDEX_FILES:
+                    if filename in self.tables:
+                        start_time = time.time()
+                        deferred_indexes[filename] = DeferredIndexes(filename, self.tables[filename].model)
+                        deferred_indexes[filename].drop(cursor)
+                        self.publish_timings[filename] += time.time() - start_time
+            for filename in order:
+                start_time = time.time()
+                self.changes[filename].update(self.tables[filename].publish(cursor, self.project_pk, self.diff))
+                self.publish_timings[filename] += time.time() - start_time
+                logger.info('{0}: {1}'.format(filename, self.changes[filename]))
+            for filename, indexes in deferred_indexes.items():
+                start_time = time.time()
+                indexes.rebuild(cursor, self.project_pk)
+                self.changes[filename]['index_rebuild_duration'] = time.time() - start_time
+                self.publish_timings[filename] += self.changes[filename]['index_rebuild_duration']
+
+    def swap(self, after_publish=None):
+        """Publishes the staged files in a short transaction, retrying up to settings.GTFS_IMPORT_PUBLISH_ATTEMPTS
+        times when it could not get its locks in time. after_publish is called inside the same transaction"""
+        if self.progress is not None:
+            self.progress.set_phase(self.progress.PHASE_PUBLISHING)
+        for attempt in range(1, settings.GTFS_IMPORT_PUBLISH_ATTEMPTS + 1):
+            try:
+                with transaction.atomic():
+                    self.publish()
+                    if after_publish is not None:
+                        after_publish()
+                self.analyze()
+                return
+            except OperationalError as e:
+                if getattr(e.__cause__, 'pgcode', None) != LOCK_NOT_AVAILABLE or \
+                        attempt == settings.GTFS_IMPORT_PUBLISH_ATTEMPTS:
+                    raise
+                logger.warning('project {0} is locked by another transaction, publication will be retried ({1}/{2})'
+                               .format(self.project_pk, attempt, settings.GTFS_IMPORT_PUBLISH_ATTEMPTS))
+                self.publish_timings = dict()
+                self.changes = dict()
+                time.sleep(attempt)
+
+    def analyze(self):
+        """Refreshes the statistics of the live tables that changed. Until autovacuum catches up, the planner would
+        keep estimating the rows they had before, and the next import of the project would plan its deletions
+        against tables it believes are almost empty"""
+        with connection.cursor() as cursor:
+            for filename, table in self.tables.items():
+                if not any(self.changes.get(filename, dict()).values()):
+                    continue
+                for model in table.models:
+                    cursor.execute(sql.SQL('ANALYZE {0}').format(sql.Identifier(model._meta.db_table)))
+
+    def drop(self):
+        with connection.cursor() as cursor:
+            for table in self.tables.values():
+                table.drop(cursor)
+
+    def drop_leftovers(self):
+        """ drops staging tables of previous imports of the project that did not finish """
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT tablename FROM pg_tables WHERE tablename LIKE %s',
+                           [self.project_prefix.replace('_', '\\_') + '%'])
+            for (table_name,) in cursor.fetchall():
+                logger.info('dropping staging table {0} left by a previous import'.format(table_name))
+                cursor.execute(sql.SQL('DROP TABLE IF EXISTS {0}').format(sql.Identifier(table_name)))
+
+    def get_report(self):
+        tables = dict()
+        for filename, table in self.tables.items():
+            start, end = self.timings.get(filename, (None, None))
+            tables[filename] = dict(rows=table.row_number, staging_start=start, staging_end=end,
+                                    staging_duration=None if start is None else end - start,
+                                    publish_duration=self.publish_timings.get(filename),
+                                    **self.changes.get(filename, dict()))
+        critical_path = get_critical_path(self.timings, self.dependencies)
+        return dict(tables=tables, critical_path=critical_path,
+                    staging_duration=max([end for _, end in self.timings.values()], default=0),
+                    publish_duration=sum(self.publish_timings.values()))
+
+    def __enter__(self):
+        # a session lock (not a transaction lock) because staging happens outside of any transaction
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT pg_try_advisory_lock(%s, %s)', [IMPORT_LOCK_ID, self.project_pk])
+            if not cursor.fetchone()[0]:
+                raise ValidationError('project {0} is already importing a GTFS'.format(self.project_pk))
+        try:
+            self.drop_leftovers()
+        except Exception:
+            self.release_lock()
+            raise
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        try:
+            self.drop()
+        finally:
+            self.release_lock()
+
+    def release_lock(self):
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT pg_advisory_unlock(%s, %s)', [IMPORT_LOCK_ID, self.project_pk])
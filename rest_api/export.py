@@ -0,0 +1,278 @@
+import json
+import os
+import queue
+import shutil
+import threading
+
+from django.conf import settings
+from django.db import connection, models, transaction
+from psycopg2 import sql
+
+# version of the files written for the same rows, it has to change when the content of exported files changes. It is
+# part of the keys of the files cached by buildgtfs and of the ETags of downloads
+EXPORT_FORMAT = 1
+# first version of PostgreSQL whose float output with extra_float_digits >= 1 is the shortest text that keeps the
+# value, as repr(float) in Python
+SHORTEST_FLOAT_VERSION = 120000
+
+
+def get_field(model, path):
+    """ field reached by path (names joined with __, as in values()) starting from model """
+    names = path.split('__')
+    for name in names[:-1]:
+        model = model._meta.get_field(name).related_model
+    return model._meta.get_field(names[-1])
+
+
+def format_expression(field, column):
+    """SQL expression that writes column (whose values come from field) as the Python CSV writer does it after
+    RowFormatter: dates as YYYYMMDD, booleans as 0/1, durations as HH:MM:SS (hours go beyond 24)
+    and integral floats with a trailing .0. Empty strings become NULL so COPY does not quote them"""
+    if isinstance(field, models.ForeignKey):
+        field = field.target_field
+    if isinstance(field, models.BooleanField):
+        return sql.SQL('CAST({0} AS integer)').format(column)
+    if isinstance(field, models.DateField):
+        return sql.SQL("to_char({0}, 'YYYYMMDD')").format(column)
+    if isinstance(field, models.DurationField):
+        seconds = sql.SQL('CAST(floor(extract(epoch FROM {0})) AS bigint)').format(column)
+        hours = sql.SQL('div({0}, 3600)').format(seconds)
+        return sql.SQL("CASE WHEN {1} < 10 THEN '0' ELSE '' END || {1} || ':' || "
+                       "to_char(div(mod({0}, 3600), 60), 'FM00') || ':' || to_char(mod({0}, 60), 'FM00')").format(
+            seconds, hours)
+    if isinstance(field, models.FloatField):
+        return sql.SQL("CASE WHEN CAST({0} AS text) ~ '^-?[0-9]+$' THEN CAST({0} AS text) || '.0' "
+                       "ELSE CAST({0} AS text) END").format(column)
+    if isinstance(field, (models.CharField, models.TextField)):
+        return sql.SQL("NULLIF({0}, '')").format(column)
+    return column
+
+
+def format_date(value):
+    return value.strftime('%Y%m%d')
+
+
+def format_duration(value):
+    seconds = value.days * 86400 + value.seconds
+    return '{0:02d}:{1:02d}:{2:02d}'.format(seconds // 3600, seconds % 3600 // 60, seconds % 60)
+
+
+class RowFormatter:
+    """Converts the tuples of values_list(*fields) of model into the rows of a GTFS file. The conversion of each
+    column is chosen once from the type of its field: dates as YYYYMMDD, booleans as 0/1 and durations as HH:MM:SS
+    (hours go beyond 24 for trips that end after midnight). Columns of other types are left as they are, None is
+    written as an empty value by csv.writer"""
+
+    def __init__(self, model, fields):
+        self.converters = list()
+        for index, path in enumerate(fields):
+            converter = self.get_converter(get_field(model, path))
+            if converter is not None:
+                self.converters.append((index, converter))
+
+    @staticmethod
+    def get_converter(field):
+        if isinstance(field, models.ForeignKey):
+            field = field.target_field
+        if isinstance(field, models.BooleanField):
+            return int
+        if isinstance(field, models.DateField):
+            return format_date
+        if isinstance(field, models.DurationField):
+            return format_duration
+        return None
+
+    def format(self, row):
+        row = list(row)
+        for index, converter in self.converters:
+            value = row[index]
+            if value is not None:
+                row[index] = converter(value)
+        return row
+
+
+def get_copy_query(cursor, queryset, fields, header):
+    """COPY ... TO STDOUT statement that writes the values of fields of queryset, in its order, as a CSV file with
+    header. Values are formatted by PostgreSQL (see format_expression)"""
+    query, params = queryset.values_list(*fields).query.sql_with_params()
+    columns = [sql.Identifier('c{0}'.format(index)) for index in range(len(fields))]
+    select = sql.SQL('SELECT {0} FROM ({1}) AS t ({2})').format(
+        sql.SQL(', ').join([sql.SQL('{0} AS {1}').format(
+            format_expression(get_field(queryset.model, path), column), sql.Identifier(name))
+            for path, column, name in zip(fields, columns, header)]),
+        sql.SQL(query), sql.SQL(', ').join(columns))
+    # params are interpolated by psycopg2 because COPY does not accept bind parameters
+    select = cursor.mogrify(select.as_string(cursor.connection), params).decode('utf-8')
+    return sql.SQL('COPY ({0}) TO STDOUT WITH (FORMAT csv, HEADER)').format(sql.SQL(select))
+
+
+class CRLFWriter:
+    """Binary file-like object that writes in file_obj what COPY sends, with the line breaks between rows as \\r\\n
+    (csv.writer terminates lines with \\r\\n, COPY with \\n). Line breaks inside quoted values are kept as they are"""
+
+    def __init__(self, file_obj):
+        self.file_obj = file_obj
+        self.quoted = False
+
+    def write(self, data):
+        data = bytes(data)
+        if b'"' not in data and not self.quoted:
+            self.file_obj.write(data.replace(b'\n', b'\r\n'))
+            return
+        parts = data.split(b'"')
+        for index in range(0, len(parts)):
+            # a part is outside a quoted value when an even number of quotes was seen before it
+            if self.quoted == (index % 2 == 1):
+                parts[index] = parts[index].replace(b'\n', b'\r\n')
+        self.quoted = self.quoted != (len(parts) % 2 == 0)
+        self.file_obj.write(b'"'.join(parts))
+
+
+def set_float_digits(cursor):
+    """ floats are written with the shortest text that keeps their value, as Python does, older servers write every
+    digit needed to read them back exactly instead. It lasts until the end of the transaction """
+    extra_float_digits = 1 if connection.pg_version >= SHORTEST_FLOAT_VERSION else 3
+    cursor.execute('SET LOCAL extra_float_digits = {0}'.format(extra_float_digits))
+
+
+def copy_to_file(binary_file, queryset, fields, header):
+    """Writes in binary_file the CSV (utf-8, with header) of the values of fields of queryset, produced by PostgreSQL
+    with COPY ... TO STDOUT. The output is the same one of CSVDownloadMixin.get_rows written with csv.writer.
+    Returns the number of rows written"""
+    with transaction.atomic(), connection.cursor() as cursor:
+        set_float_digits(cursor)
+        cursor.copy_expert(get_copy_query(cursor, queryset, fields, header).as_string(cursor.connection),
+                           CRLFWriter(binary_file))
+        return cursor.rowcount
+
+
+class ChunkQueueWriter:
+    """Binary file-like object that puts what it receives in chunks, a queue, in pieces of at least chunk_size bytes.
+    The first write (the header line of COPY) goes alone. copying is cleared when COPY ends, once cancelled it drops
+    everything"""
+
+    def __init__(self, chunks, chunk_size):
+        self.chunks = chunks
+        self.chunk_size = chunk_size
+        self.buffer = bytearray()
+        self.first = True
+        self.copying = True
+        self.cancelled = False
+
+    def write(self, data):
+        if self.cancelled:
+            return
+        self.buffer += data
+        if self.first or len(self.buffer) >= self.chunk_size:
+            self.flush()
+            self.first = False
+
+    def flush(self):
+        if self.buffer and not self.cancelled:
+            self.chunks.put(bytes(self.buffer))
+        self.buffer = bytearray()
+
+
+# end of the chunks of iter_copy
+COPY_FINISHED = object()
+
+
+def iter_copy(queryset, fields, header, chunk_size, queue_size=8):
+    """Yields the CSV of copy_to_file in pieces of about chunk_size bytes while PostgreSQL writes it, the header goes
+    alone. COPY runs in a thread on the connection of the caller, at most queue_size pieces wait to be sent, so a slow
+    client holds the query instead of filling the memory. If the generator is closed before the end the query is
+    cancelled"""
+    chunks = queue.Queue(maxsize=queue_size)
+    writer = ChunkQueueWriter(chunks, chunk_size)
+    with transaction.atomic(), connection.cursor() as cursor:
+        set_float_digits(cursor)
+        query = get_copy_query(cursor, queryset, fields, header).as_string(cursor.connection)
+
+        def copy():
+            try:
+                cursor.copy_expert(query, CRLFWriter(writer))
+                writer.copying = False
+                writer.flush()
+                chunks.put(COPY_FINISHED)
+            except Exception as e:
+                chunks.put(e)
+
+        thread = threading.Thread(target=copy, name='copy-export', daemon=True)
+        thread.start()
+        finished = False
+        try:
+            while True:
+                chunk = chunks.get()
+                if chunk is COPY_FINISHED:
+                    finished = True
+                    break
+                if isinstance(chunk, Exception):
+                    finished = True
+                    raise chunk
+                yield chunk
+        finally:
+            if not finished:
+                # the client is gone, the rest of the table is not read and the thread is not left waiting
+                writer.cancelled = True
+                if writer.copying:
+                    connection.connection.cancel()
+                while thread.is_alive():
+                    try:
+                        chunks.get(timeout=0.1)
+                    except queue.Empty:
+                        pass
+            thread.join()
+
+
+def get_version_key(versions, table_models):
+    """ key that changes when the rows of any of table_models change, versions as given by TableVersion.get_versions """
+    return 'v{0}-{1}'.format(EXPORT_FORMAT, '-'.join(str(versions.get(model._meta.label, 0))
+                                                      for model in table_models))
+
+
+class BuildCache:
+    """Compressed members written by buildgtfs for the tables of a project. Each one is stored with a key made of the
+    versions (see TableVersion) of the models it was exported from, and it is reused while the key does not change.
+    A member is a file with the deflated CSV and a json file with its crc and sizes, written last"""
+
+    def __init__(self, project_pk):
+        self.directory = os.path.join(settings.GTFS_BUILD_CACHE_ROOT, str(project_pk))
+
+    def get_paths(self, name, key):
+        path = os.path.join(self.directory, '{0}.{1}'.format(name, key))
+        return path + '.deflate', path + '.json'
+
+    def get(self, name, key):
+        """ member (path, crc, file_size and compress_size, or empty) of table name with key, None if not cached """
+        data_path, info_path = self.get_paths(name, key)
+        try:
+            with open(info_path) as info_file:
+                member = json.load(info_file)
+        except FileNotFoundError:
+            return None
+        member['path'] = data_path
+        return member
+
+    def put(self, name, key, member):
+        """Moves the file of member (None for an optional table without rows) into the cache, replacing the previous
+        member of table name. Returns the cached member"""
+        os.makedirs(self.directory, exist_ok=True)
+        self.remove(name)
+        data_path, info_path = self.get_paths(name, key)
+        if member is None:
+            info = dict(empty=True)
+        else:
+            os.replace(member['path'], data_path)
+            info = dict(crc=member['crc'], file_size=member['file_size'], compress_size=member['compress_size'])
+        with open(info_path + '.tmp', 'w') as info_file:
+            json.dump(info, info_file)
+        os.replace(info_path + '.tmp', info_path)
+        return self.get(name, key)
+
+    def remove(self, name):
+        for filename in os.listdir(self.directory):
+            if filename.startswith(name + '.'):
+                os.remove(os.path.join(self.directory, filename))
+
+    def clear(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
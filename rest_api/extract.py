@@ -0,0 +1,109 @@
+import datetime
+
+from django.db.models import Q
+
+from rest_api.models import Trip, StopTime, Stop, Route, Calendar, CalendarDate, FareAttribute, FareRule
+
+WEEKDAYS = ['monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday']
+
+
+class GTFSExtract:
+    """Subset of the GTFS of a project: the trips of some routes (route_ids), the trips that stop inside an area
+    (bbox, as min_lon, min_lat, max_lon, max_lat) and the trips whose services may run between start_date and
+    end_date (both included). Trips are kept whole and every row they reference is kept with them: stop times,
+    stops and their parent stations, shapes, services, routes and agencies, plus the frequencies, transfers,
+    pathways, levels and fares that only reference kept rows.
+    Each table is restricted with subqueries (see filter), the closure is solved by PostgreSQL and ids are never
+    loaded in Python"""
+
+    def __init__(self, project_pk, route_ids=None, bbox=None, start_date=None, end_date=None):
+        if (start_date is None) != (end_date is None):
+            raise ValueError('start date and end date must be given together')
+        if start_date is not None and start_date > end_date:
+            raise ValueError('start date must not be after end date')
+        if bbox is not None and (len(bbox) != 4 or bbox[0] > bbox[2] or bbox[1] > bbox[3]):
+            raise ValueError('bbox must be min_lon, min_lat, max_lon, max_lat')
+        self.project_pk = project_pk
+        self.route_ids = route_ids
+        self.bbox = bbox
+        self.start_date = start_date
+        self.end_date = end_date
+
+    def get_trips(self):
+        trips = Trip.objects.filter_by_project(self.project_pk)
+        if self.route_ids is not None:
+            trips = trips.filter(route__route_id__in=self.route_ids)
+        if self.bbox is not None:
+            min_lon, min_lat, max_lon, max_lat = self.bbox
+            trips = trips.filter(pk__in=StopTime.objects.filter(
+                stop__project_id=self.project_pk, stop__stop_lon__range=(min_lon, max_lon),
+                stop__stop_lat__range=(min_lat, max_lat)).values('trip_id'))
+        if self.start_date is not None:
+            trips = trips.filter(Q(service_id__in=self.get_calendars().values('service_id')) |
+                                 Q(service_id__in=self.get_added_dates().values('service_id')))
+        return trips
+
+    def get_calendars(self):
+        """ calendars whose range overlaps the window and that run on one of its weekdays """
+        days = (self.end_date - self.start_date).days + 1
+        weekdays = set((self.start_date + datetime.timedelta(days=day)).weekday() for day in range(min(days, 7)))
+        runs_on_weekday = Q()
+        for weekday in sorted(weekdays):
+            runs_on_weekday |= Q(**{WEEKDAYS[weekday]: True})
+        return Calendar.objects.filter_by_project(self.project_pk).filter(
+            runs_on_weekday, start_date__lte=self.end_date, end_date__gte=self.start_date)
+
+    def get_added_dates(self):
+        return CalendarDate.objects.filter_by_project(self.project_pk).filter(
+            exception_type=1, date__range=(self.start_date, self.end_date))
+
+    def get_routes(self):
+        return Route.objects.filter(pk__in=self.get_trips().values('route_id'))
+
+    def get_stops(self):
+        used_stops = StopTime.objects.filter(trip__in=self.get_trips().values('pk')).values('stop_id')
+        parent_stations = Stop.objects.filter(pk__in=used_stops).values('parent_station_id')
+        return Stop.objects.filter(Q(pk__in=used_stops) | Q(pk__in=parent_stations))
+
+    def get_fare_rules(self):
+        # rules without a route apply to every route
+        return FareRule.objects.filter_by_project(self.project_pk).filter(
+            Q(route__isnull=True) | Q(route__in=self.get_routes().values('pk')))
+
+    def get_fare_attributes(self):
+        # fares without rules apply to the whole feed, the rest need a rule that is kept
+        return FareAttribute.objects.filter_by_project(self.project_pk).filter(
+            Q(pk__in=self.get_fare_rules().values('fare_attribute_id')) |
+            ~Q(pk__in=FareRule.objects.filter_by_project(self.project_pk).values('fare_attribute_id')),
+            agency__in=self.get_routes().values('agency_id'))
+
+    def filter(self, gtfs_filename, qs):
+        """ rows of qs (the queryset of the table gtfs_filename, see buildgtfs) that belong to the extract """
+        trips = self.get_trips().values('pk')
+        stops = self.get_stops().values('pk')
+        if gtfs_filename == 'agency':
+            return qs.filter(pk__in=self.get_routes().values('agency_id'))
+        if gtfs_filename == 'stops':
+            return qs.filter(pk__in=stops)
+        if gtfs_filename == 'routes':
+            return qs.filter(pk__in=self.get_routes().values('pk'))
+        if gtfs_filename == 'trips':
+            return qs.filter(pk__in=trips)
+        if gtfs_filename in ['stop_times', 'frequencies']:
+            return qs.filter(trip__in=trips)
+        if gtfs_filename in ['calendar', 'calendar_dates']:
+            return qs.filter(service_id__in=self.get_trips().values('service_id'))
+        if gtfs_filename == 'fare_attributes':
+            return qs.filter(pk__in=self.get_fare_attributes().values('pk'))
+        if gtfs_filename == 'fare_rules':
+            return qs.filter(pk__in=self.get_fare_rules().values('pk'),
+                             fare_attribute__in=self.get_fare_attributes().values('pk'))
+        if gtfs_filename == 'shapes':
+            return qs.filter(pk__in=self.get_trips().values('shape_id'))
+        if gtfs_filename in ['transfers', 'pathways']:
+            return qs.filter(from_stop__in=stops, to_stop__in=stops)
+        if gtfs_filename == 'levels':
+            return qs.filter(pk__in=self.get_stops().values('level_id'))
+        if gtfs_filename == 'feed_info':
+            return qs
+        raise ValueError('"{0}" is not a GTFS table'.format(gtfs_filename))
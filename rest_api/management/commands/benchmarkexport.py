@@ -0,0 +1,39 @@
+import io
+
+from rest_api.benchmark import BenchmarkCommand
+from rest_api.management.commands.buildgtfs import GTFS_FILES
+
+
+class Command(BenchmarkCommand):
+    help = 'Measure rows per second of the CSV export of each table, written by csv.writer and by PostgreSQL (COPY)'
+
+    def add_arguments(self, parser):
+        super().add_arguments(parser)
+        parser.add_argument('--tables', nargs='+', choices=list(GTFS_FILES), default=list(GTFS_FILES),
+                            help='tables to export (default: all)')
+
+    def benchmark(self, project_obj, zip_path, repeat, options):
+        for gtfs_filename in options['tables']:
+            view = GTFS_FILES[gtfs_filename]['viewset']
+            qs = view.get_qs({'project_pk': project_obj.pk})
+            _, csv_fields, export_qs = view.get_export_query(view.Meta, qs)
+            # rows fetched once, to measure the conversion alone
+            rows = list(export_qs.values_list(*csv_fields))
+            if not rows:
+                self.stdout.write('{0}: no rows'.format(gtfs_filename))
+                continue
+            writer_time = self.measure(repeat, lambda: view.write_to_file(io.StringIO(), view.Meta, qs))
+            copy_time = self.measure(repeat, lambda: view.copy_to_file(io.BytesIO(), view.Meta, qs))
+            format_time = self.measure(repeat, lambda: self.format_rows(view.Meta, export_qs.model, csv_fields, rows))
+            self.stdout.write('{0}: {1} rows, csv.writer {2:.0f} rows/s, COPY {3:.0f} rows/s (formatting only: '
+                              '{4:.0f} rows/s){5}'.format(gtfs_filename, len(rows), len(rows) / writer_time,
+                                                          len(rows) / copy_time, len(rows) / format_time,
+                                                          ', downloads use COPY' if getattr(
+                                                              view.Meta, 'export_with_copy', False) else ''))
+
+    @staticmethod
+    def format_rows(meta_class, model, fields, rows):
+        """ converts rows (tuples of values_list) as get_rows does """
+        formatter = meta_class.get_row_formatter(model, fields)
+        for row in rows:
+            formatter.format(row)
@@ -1,24 +1,197 @@
+import argparse
+import csv
+import datetime
+import hashlib
+import io
+import os
+import resource
+import shutil
+import tempfile
+import time
 import zipfile
-from io import BytesIO, StringIO
+import zlib
+from concurrent.futures import ProcessPoolExecutor
 
-from django.core.files.base import ContentFile
+from django.conf import settings
+from django.core.files.base import File
 from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
 from django.utils import timezone
 
-from rest_api.models import Project, FeedInfo
+from rest_api.export import BuildCache, get_version_key
+from rest_api.extract import GTFSExtract
+from rest_api.models import Project, FeedInfo, TableVersion
 from rest_api.views import AgencyViewSet, StopViewSet, RouteViewSet, TripViewSet, CalendarViewSet, \
     CalendarDateViewSet, FareAttributeViewSet, FareRuleViewSet, FrequencyViewSet, TransferViewSet, \
     PathwayViewSet, LevelViewSet, FeedInfoViewSet, ShapeViewSet, StopTimeViewSet
 
+GTFS_FILES = {
+    'agency': dict(viewset=AgencyViewSet, required=True),
+    'stops': dict(viewset=StopViewSet, required=True),
+    'routes': dict(viewset=RouteViewSet, required=True),
+    'trips': dict(viewset=TripViewSet, required=True),
+    'stop_times': dict(viewset=StopTimeViewSet, required=True),
+    'calendar': dict(viewset=CalendarViewSet, required=True),
+    'calendar_dates': dict(viewset=CalendarDateViewSet, required=False),
+    'fare_attributes': dict(viewset=FareAttributeViewSet, required=False),
+    'fare_rules': dict(viewset=FareRuleViewSet, required=False),
+    'shapes': dict(viewset=ShapeViewSet, required=True),
+    'frequencies': dict(viewset=FrequencyViewSet, required=False),
+    'transfers': dict(viewset=TransferViewSet, required=False),
+    'pathways': dict(viewset=PathwayViewSet, required=False),
+    'levels': dict(viewset=LevelViewSet, required=False),
+    'feed_info': dict(viewset=FeedInfoViewSet, required=True),
+}
+# tables that take longest to export, they are given to the workers first
+LARGE_GTFS_FILES = ['stop_times', 'shapes', 'trips']
+
+
+def parse_date(value):
+    try:
+        return datetime.datetime.strptime(value, '%Y%m%d').date()
+    except ValueError:
+        raise argparse.ArgumentTypeError('"{0}" is not a date in YYYYMMDD format'.format(value))
+
+
+class BuiltFile(File):
+    """ file on disk that storages can move to its destination (as an uploaded temporary file) instead of copying it """
+
+    def temporary_file_path(self):
+        return self.name
+
+
+class DeflatedMember(io.RawIOBase):
+    """Writable binary file that deflates what it receives into file_obj as zipfile does for ZIP_DEFLATED entries,
+    keeping the crc and sizes needed to add the data to an archive (see add_deflated_member)"""
+
+    def __init__(self, file_obj):
+        super().__init__()
+        self.file_obj = file_obj
+        self.compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+        self.crc = 0
+        self.file_size = 0
+        self.compress_size = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.crc = zlib.crc32(data, self.crc)
+        self.file_size += len(data)
+        self.write_compressed(self.compressor.compress(data))
+        return len(data)
+
+    def write_compressed(self, data):
+        self.compress_size += len(data)
+        self.file_obj.write(data)
+
+    def close(self):
+        if not self.closed:
+            self.write_compressed(self.compressor.flush())
+        super().close()
+
+
+def write_table(binary_file, header, first_row, rows):
+    with io.TextIOWrapper(binary_file, encoding='utf-8', newline='') as text_file:
+        writer = csv.writer(text_file)
+        writer.writerow(header)
+        if first_row is not None:
+            writer.writerow(first_row)
+        writer.writerows(rows)
+
+
+def copy_table(binary_file, view, qs):
+    with binary_file:
+        view.copy_to_file(binary_file, view.Meta, qs)
+
+
+def get_table_writer(project_pk, gtfs_filename, extract=None):
+    """Function that writes the table gtfs_filename of the project (only the rows of extract when it is given) in the
+    binary file it receives (and closes it), or None when the table is optional and has no rows. Tables marked with
+    export_with_copy are written by PostgreSQL, the rest by csv.writer while they are read"""
+    view = GTFS_FILES[gtfs_filename]['viewset']
+    required = GTFS_FILES[gtfs_filename]['required']
+    qs = view.get_qs({'project_pk': project_pk})
+    if extract is not None:
+        qs = extract.filter(gtfs_filename, qs)
+    if getattr(view.Meta, 'export_with_copy', False):
+        if not required and not qs.exists():
+            return None
+        return lambda binary_file: copy_table(binary_file, view, qs)
+
+    rows = view.get_rows(view.Meta, qs)
+    header = next(rows)
+    first_row = next(rows, None)
+    if first_row is None and not required:
+        return None
+    return lambda binary_file: write_table(binary_file, header, first_row, rows)
+
+
+def export_table(project_pk, gtfs_filename, directory, extract=None):
+    """Runs in a worker process: writes the table gtfs_filename deflated in a file of directory. Returns the path,
+    crc and sizes of the file, or None when the table is optional and has no rows"""
+    table_writer = get_table_writer(project_pk, gtfs_filename, extract)
+    if table_writer is None:
+        return None
+    path = os.path.join(directory, gtfs_filename)
+    with open(path, 'wb') as file_obj:
+        member = DeflatedMember(file_obj)
+        table_writer(io.BufferedWriter(member))
+    return dict(path=path, crc=member.crc, file_size=member.file_size, compress_size=member.compress_size)
+
+
+def add_deflated_member(zf, name, member, content_hash):
+    """Appends to zf an entry whose data was already deflated by export_table, it is copied without compressing it
+    again. zipfile does not have a public method for that, these are the steps of ZipFile.write, including its checks.
+    The name and data of the entry are added to content_hash, the hash of the content of the archive"""
+    if zf.mode != 'w' or zf.fp is None:
+        raise ValueError("add_deflated_member requires an archive open in mode 'w'")
+    if zf._writing:
+        raise ValueError("Can't write to ZIP archive while an open writing handle exists")
+    zinfo = zipfile.ZipInfo(name, date_time=time.localtime(time.time())[:6])
+    zinfo.compress_type = zipfile.ZIP_DEFLATED
+    zinfo.external_attr = 0o600 << 16
+    zinfo.CRC = member['crc']
+    zinfo.file_size = member['file_size']
+    zinfo.compress_size = member['compress_size']
+    zinfo.header_offset = zf.fp.tell()
+    zf.fp.write(zinfo.FileHeader())
+    content_hash.update('{0}:{1}:{2}:'.format(name, member['crc'], member['file_size']).encode('utf-8'))
+    with open(member['path'], 'rb') as file_obj:
+        for chunk in iter(lambda: file_obj.read(1024 * 1024), b''):
+            content_hash.update(chunk)
+            zf.fp.write(chunk)
+    zf.filelist.append(zinfo)
+    zf.NameToInfo[name] = zinfo
+    zf.start_dir = zf.fp.tell()
+    zf._didModify = True
+
 
 class Command(BaseCommand):
     help = 'Create zip file based on project'
 
     def add_arguments(self, parser):
         parser.add_argument('project_name', help='project name')
+        parser.add_argument('--workers', type=int, default=settings.GTFS_BUILD_WORKERS,
+                            help='number of processes that export tables at the same time (default: {0})'.format(
+                                settings.GTFS_BUILD_WORKERS))
+        parser.add_argument('--no-cache', action='store_false', dest='use_cache',
+                            help='export every table again, even the ones that did not change since the last build')
+        # an extract is written in --output instead of being saved as the GTFS file of the project
+        parser.add_argument('--routes', nargs='+', dest='route_ids', metavar='ROUTE_ID',
+                            help='extract: trips of these routes')
+        parser.add_argument('--bbox', nargs=4, type=float, metavar=('MIN_LON', 'MIN_LAT', 'MAX_LON', 'MAX_LAT'),
+                            help='extract: trips that stop inside this area')
+        parser.add_argument('--start-date', type=parse_date, help='extract: trips that may run from this date '
+                                                                  '(YYYYMMDD), requires --end-date')
+        parser.add_argument('--end-date', type=parse_date, help='extract: trips that may run until this date '
+                                                                '(YYYYMMDD), requires --start-date')
+        parser.add_argument('--output', help='path of the zip file, required by extracts')
 
     def handle(self, *args, **options):
         project_name = options['project_name']
+        workers = options['workers']
+        output = options.get('output')
         start_time = timezone.now()
 
         try:
@@ -26,6 +199,10 @@ class Command(BaseCommand):
         except Project.DoesNotExist:
             raise CommandError('Project with name "{0}" does not exist'.format(project_name))
 
+        extract = self.get_extract(project_obj.pk, options)
+        if extract is not None and output is None:
+            raise CommandError('--output is required to build an extract')
+
         filename = 'GTFS-{0}'.format(project_obj.name)
         try:
             filename += '-{0}'.format(project_obj.feedinfo.feed_version)
@@ -33,38 +210,96 @@ class Command(BaseCommand):
             pass
         filename += '.zip'
 
-        s = BytesIO()
-
-        files = {
-            'agency': dict(viewset=AgencyViewSet, required=True),
-            'stops': dict(viewset=StopViewSet, required=True),
-            'routes': dict(viewset=RouteViewSet, required=True),
-            'trips': dict(viewset=TripViewSet, required=True),
-            'stop_times': dict(viewset=StopTimeViewSet, required=True),
-            'calendar': dict(viewset=CalendarViewSet, required=True),
-            'calendar_dates': dict(viewset=CalendarDateViewSet, required=False),
-            'fare_attributes': dict(viewset=FareAttributeViewSet, required=False),
-            'fare_rules': dict(viewset=FareRuleViewSet, required=False),
-            'shapes': dict(viewset=ShapeViewSet, required=True),
-            'frequencies': dict(viewset=FrequencyViewSet, required=False),
-            'transfers': dict(viewset=TransferViewSet, required=False),
-            'pathways': dict(viewset=PathwayViewSet, required=False),
-            'levels': dict(viewset=LevelViewSet, required=False),
-            'feed_info': dict(viewset=FeedInfoViewSet, required=True),
-        }
-        zf = zipfile.ZipFile(s, "w", zipfile.ZIP_DEFLATED, False)
-        for gtfs_filename in files:
-            out = StringIO()
-            view = files[gtfs_filename]['viewset']
-            qs = view.get_qs({'project_pk': project_obj.pk})
-            row_number = view.write_to_file(out, view.Meta, qs)
-            if row_number > 0 or files[gtfs_filename]['required']:
-                zf.writestr('{}.txt'.format(gtfs_filename), out.getvalue())
-        zf.close()
-
-        project_obj.gtfs_file_updated_at = timezone.now()
-        project_obj.gtfs_building_duration = timezone.now() - start_time
-        project_obj.gtfs_file.save(filename, ContentFile(s.getvalue()))
+        # versions are read before any table, a write made while a table is exported bumps them for the next build.
+        # Extracts do not use the cache, their files have only part of the rows
+        cache = BuildCache(project_obj.pk)
+        keys = self.get_cache_keys(project_obj.pk)
+        members = dict()
+        if options['use_cache'] and extract is None:
+            for gtfs_filename in GTFS_FILES:
+                member = cache.get(gtfs_filename, keys[gtfs_filename])
+                if member is not None:
+                    members[gtfs_filename] = member
+        reused_tables = len(members)
 
+        # files are written on disk next to the media files, so they can be moved instead of copied
+        os.makedirs(settings.GTFS_STAGING_ROOT, exist_ok=True)
+        directory = tempfile.mkdtemp(dir=settings.GTFS_STAGING_ROOT)
+        zip_path = os.path.join(directory, 'gtfs.zip')
+        try:
+            missing_tables = [gtfs_filename for gtfs_filename in GTFS_FILES if gtfs_filename not in members]
+            for gtfs_filename, member in self.export_tables(project_obj.pk, missing_tables, directory,
+                                                            workers, extract).items():
+                if extract is None:
+                    member = cache.put(gtfs_filename, keys[gtfs_filename], member)
+                members[gtfs_filename] = member if member is not None else dict(empty=True)
+
+            # zip entries hold the time of the build, the hash only covers their names and data, so it stays the
+            # same while the project does not change (see validate_gtfs)
+            content_hash = hashlib.sha256()
+            with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED, True) as zf:
+                for gtfs_filename in GTFS_FILES:
+                    # optional tables without rows are left out of the archive
+                    if not members[gtfs_filename].get('empty', False):
+                        add_deflated_member(zf, '{}.txt'.format(gtfs_filename), members[gtfs_filename],
+                                            content_hash)
+
+            building_duration = timezone.now() - start_time
+            if output is not None:
+                filename = output
+                shutil.move(zip_path, output)
+            else:
+                project_obj.gtfs_file_updated_at = timezone.now()
+                project_obj.gtfs_file_hash = content_hash.hexdigest()
+                project_obj.gtfs_building_duration = building_duration
+                with BuiltFile(open(zip_path, 'rb'), name=zip_path) as zip_file:
+                    project_obj.gtfs_file.save(filename, zip_file)
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+
+        # ru_maxrss is given in kilobytes on linux, workers are measured as children
+        peak_memory = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                          resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) / 1024
         self.stdout.write(self.style.SUCCESS(
-            'GTFS "{0}" was created successfully in {1} seconds'.format(filename, project_obj.gtfs_building_duration)))
+            'GTFS "{0}" was created successfully in {1} seconds, {2} of {3} tables reused from the previous build '
+            '(peak memory: {4:.1f} MB)'.format(filename, building_duration, reused_tables, len(GTFS_FILES),
+                                               peak_memory)))
+
+    @staticmethod
+    def get_extract(project_pk, options):
+        """ GTFSExtract made of the filters in options, None when no filter was given """
+        filters = dict(route_ids=options.get('route_ids'), bbox=options.get('bbox'),
+                       start_date=options.get('start_date'), end_date=options.get('end_date'))
+        if all(value is None for value in filters.values()):
+            return None
+        try:
+            return GTFSExtract(project_pk, **filters)
+        except ValueError as e:
+            raise CommandError(str(e))
+
+    @staticmethod
+    def get_cache_keys(project_pk):
+        """ key of the cached file of each table, made of the versions of the models it is exported from """
+        versions = TableVersion.objects.get_versions(project_pk)
+        keys = dict()
+        for gtfs_filename, gtfs_file in GTFS_FILES.items():
+            view = gtfs_file['viewset']
+            keys[gtfs_filename] = get_version_key(versions, view.get_version_models(view.Meta))
+        return keys
+
+    @staticmethod
+    def export_tables(project_pk, gtfs_filenames, directory, workers, extract=None):
+        """Deflates the tables in files of directory (see export_table), one after another or at the same time in a
+        pool of processes, each one with its own database connection, so the build takes about as long as the
+        largest table. Returns a dict table -> member"""
+        if workers <= 1 or len(gtfs_filenames) <= 1:
+            return {gtfs_filename: export_table(project_pk, gtfs_filename, directory, extract)
+                    for gtfs_filename in gtfs_filenames}
+
+        # forked processes must open their own connections instead of sharing the ones of this process
+        connections.close_all()
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = dict()
+            for gtfs_filename in sorted(gtfs_filenames, key=lambda name: name not in LARGE_GTFS_FILES):
+                futures[gtfs_filename] = executor.submit(export_table, project_pk, gtfs_filename, directory, extract)
+            return {gtfs_filename: future.result() for gtfs_filename, future in futures.items()}
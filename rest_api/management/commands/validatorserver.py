@@ -0,0 +1,46 @@
+import json
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from rqworkers.validator import ValidatorServer, ValidatorError, ValidatorUnavailable, request_validator
+
+
+class Command(BaseCommand):
+    help = 'Run the GTFS validator for the workers of this host, listening on a unix socket'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--socket', default=settings.GTFS_VALIDATOR_SOCKET,
+                            help='path of the unix socket (default: {0})'.format(settings.GTFS_VALIDATOR_SOCKET))
+        parser.add_argument('--workers', type=int, default=settings.GTFS_VALIDATOR_WORKERS,
+                            help='validations that run at the same time (default: {0})'.format(
+                                settings.GTFS_VALIDATOR_WORKERS))
+        parser.add_argument('--timeout', type=int, default=settings.GTFS_VALIDATOR_TIMEOUT,
+                            help='seconds before a validation is killed (default: {0})'.format(
+                                settings.GTFS_VALIDATOR_TIMEOUT))
+        parser.add_argument('--metrics', action='store_true',
+                            help='print the metrics of the running server instead of starting one')
+
+    def handle(self, *args, **options):
+        socket_path = options['socket']
+        if options['metrics']:
+            try:
+                self.stdout.write(json.dumps(request_validator(dict(command='metrics'), socket_path)))
+            except ValidatorUnavailable as e:
+                raise CommandError(str(e))
+            return
+
+        if options['workers'] < 1:
+            raise CommandError('workers must be greater than 0')
+        try:
+            server = ValidatorServer(socket_path, options['workers'], options['timeout'])
+        except ValidatorError as e:
+            raise CommandError(str(e))
+        self.stdout.write('validator server listening on {0} with {1} workers'.format(socket_path,
+                                                                                     options['workers']))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
@@ -1,4 +1,8 @@
 from django.db import models
+from django.db.models import F
+from django.utils import timezone
+
+from rest_api.utils import get_dependent_models
 
 
 class FilterManager(models.Manager):
@@ -27,3 +31,21 @@ class InternalIDFilterManager(FilterManager):
 
     def get_internal_id_name(self):
         return self.id_filter
+
+
+class TableVersionManager(FilterManager):
+    def get_versions(self, project_id):
+        """ dict model label -> version, models that were never changed are not present (their version is 0) """
+        return dict(self.filter_by_project(project_id).values_list('table', 'version'))
+
+    def bump(self, project_id, changed_models, cascade=True):
+        """Increments the version of each model in changed_models. With cascade, the models that reference them are
+        incremented too: their files show the natural ids of the referenced rows, and their rows can be deleted in
+        cascade. The last modification of the project is moved to now, it is the Last-Modified of its downloads"""
+        if cascade:
+            changed_models = get_dependent_models(changed_models)
+        tables = sorted(model._meta.label for model in changed_models)
+        self.bulk_create([self.model(project_id=project_id, table=table) for table in tables], ignore_conflicts=True)
+        self.filter_by_project(project_id).filter(table__in=tables).update(version=F('version') + 1)
+        project_model = self.model._meta.get_field('project').related_model
+        project_model.objects.filter(pk=project_id).update(last_modification=timezone.now())
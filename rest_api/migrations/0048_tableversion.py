@@ -0,0 +1,26 @@
+# Generated by Django 3.2.24 on 2026-10-17 00:45
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rest_api', '0047_rename_continuous_dropoff_stoptime_continuous_drop_off'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TableVersion',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('table', models.CharField(max_length=50)),
+                ('version', models.IntegerField(default=0)),
+                ('project', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='rest_api.project')),
+            ],
+            options={
+                'unique_together': {('project', 'table')},
+            },
+        ),
+    ]
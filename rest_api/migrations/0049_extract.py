@@ -0,0 +1,33 @@
+# Generated by Django 3.2.24 on 2026-10-17 00:59
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+import rest_api.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rest_api', '0048_tableversion'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Extract',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('route_ids', models.JSONField(default=None, null=True)),
+                ('bbox', models.JSONField(default=None, null=True)),
+                ('start_date', models.DateField(default=None, null=True)),
+                ('end_date', models.DateField(default=None, null=True)),
+                ('status', models.CharField(choices=[('queued', 'Queued'), ('building', 'Building'), ('finished', 'Finished'), ('error', 'Error')], default='queued', max_length=20)),
+                ('job_id', models.UUIDField(null=True)),
+                ('error_message', models.TextField(default=None, null=True)),
+                ('file', models.FileField(null=True, upload_to=rest_api.models.extract_upload_to)),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('building_duration', models.DurationField(default=None, null=True)),
+                ('project', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='rest_api.project')),
+            ],
+        ),
+    ]
@@ -0,0 +1,41 @@
+# Generated by Django 3.2.24 on 2026-10-17 01:06
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rest_api', '0049_extract'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='project',
+            name='gtfs_validation_run',
+            field=models.IntegerField(default=None, null=True),
+        ),
+        migrations.CreateModel(
+            name='ValidationNotice',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('run', models.IntegerField()),
+                ('filename', models.CharField(max_length=50, null=True)),
+                ('code', models.CharField(max_length=100)),
+                ('level', models.CharField(max_length=20)),
+                ('entity_id', models.TextField(null=True)),
+                ('title', models.TextField(null=True)),
+                ('description', models.TextField(null=True)),
+                ('project', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='rest_api.project')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='validationnotice',
+            index=models.Index(fields=['project', 'run', 'level', 'code'], name='rest_api_va_project_95e994_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='validationnotice',
+            index=models.Index(fields=['project', 'run', 'filename'], name='rest_api_va_project_8ced2b_idx'),
+        ),
+    ]
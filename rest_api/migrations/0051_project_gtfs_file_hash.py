@@ -0,0 +1,23 @@
+# Generated by Django 3.2.24 on 2026-10-17 01:14
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rest_api', '0050_validationnotice'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='project',
+            name='gtfs_file_hash',
+            field=models.CharField(default=None, max_length=64, null=True),
+        ),
+        migrations.AddField(
+            model_name='project',
+            name='gtfs_validation_cache',
+            field=models.JSONField(default=None, null=True),
+        ),
+    ]
@@ -11,6 +11,10 @@ def gtfs_update_to(instance, filename):
     return os.path.join(str(instance.pk), filename)
 
 
+def extract_upload_to(instance, filename):
+    return os.path.join(str(instance.project_id), 'extracts', filename)
+
+
 def get_empty_envelope():
     return {
         'type': 'Feature',
@@ -63,6 +67,11 @@ class Project(models.Model):
     gtfs_validation_error_number = models.IntegerField(default=None, null=True)
     gtfs_validation_warning_number = models.IntegerField(default=None, null=True)
     gtfs_validation_duration = models.DurationField(default=None, null=True)
+    # notices of the last finished validation are the ValidationNotice rows of this run
+    gtfs_validation_run = models.IntegerField(default=None, null=True)
+    # hash of the content of gtfs_file and the result of its last validation (see validate_gtfs)
+    gtfs_file_hash = models.CharField(max_length=64, default=None, null=True)
+    gtfs_validation_cache = models.JSONField(default=None, null=True)
     building_and_validation_job_id = models.UUIDField(null=True)
     envelope = models.JSONField(default=get_empty_envelope)
     # validation error message per table
@@ -407,3 +416,73 @@ class Frequency(models.Model):
 
     class Meta:
         unique_together = ['trip', 'start_time']
+
+
+class TableVersion(models.Model):
+    """ number of times the rows of a model changed in a project, buildgtfs reuses the files of unchanged tables """
+    project = models.ForeignKey(Project, on_delete=models.CASCADE)
+    # label of the model, as rest_api.StopTime
+    table = models.CharField(max_length=50)
+    version = models.IntegerField(default=0)
+
+    objects = TableVersionManager()
+
+    def __str__(self):
+        return '{0}: {1}'.format(self.table, self.version)
+
+    class Meta:
+        unique_together = ['project', 'table']
+
+
+class Extract(models.Model):
+    """ subset of the GTFS of a project (see rest_api.extract.GTFSExtract), built by a background job """
+    project = models.ForeignKey(Project, on_delete=models.CASCADE)
+    route_ids = models.JSONField(default=None, null=True)
+    # min_lon, min_lat, max_lon, max_lat
+    bbox = models.JSONField(default=None, null=True)
+    start_date = models.DateField(default=None, null=True)
+    end_date = models.DateField(default=None, null=True)
+    STATUS_QUEUED = 'queued'
+    STATUS_BUILDING = 'building'
+    STATUS_FINISHED = 'finished'
+    STATUS_ERROR = 'error'
+    status_choices = (
+        (STATUS_QUEUED, 'Queued'),
+        (STATUS_BUILDING, 'Building'),
+        (STATUS_FINISHED, 'Finished'),
+        (STATUS_ERROR, 'Error'),
+    )
+    status = models.CharField(max_length=20, choices=status_choices, default=STATUS_QUEUED)
+    job_id = models.UUIDField(null=True)
+    error_message = models.TextField(default=None, null=True)
+    file = models.FileField(upload_to=extract_upload_to, null=True)
+    created_at = models.DateTimeField(default=timezone.now)
+    building_duration = models.DurationField(default=None, null=True)
+
+    objects = FilterManager()
+
+    def __str__(self):
+        return 'Extract {0} of {1}'.format(self.pk, self.project)
+
+
+class ValidationNotice(models.Model):
+    """ problem found by validate_gtfs in the GTFS of a project, one row per notice of each validation run """
+    project = models.ForeignKey(Project, on_delete=models.CASCADE)
+    run = models.IntegerField()
+    filename = models.CharField(max_length=50, null=True)
+    code = models.CharField(max_length=100)
+    level = models.CharField(max_length=20)
+    entity_id = models.TextField(null=True)
+    title = models.TextField(null=True)
+    description = models.TextField(null=True)
+
+    objects = FilterManager()
+
+    def __str__(self):
+        return '{0} {1}: {2}'.format(self.level, self.code, self.entity_id)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['project', 'run', 'level', 'code']),
+            models.Index(fields=['project', 'run', 'filename']),
+        ]
@@ -9,3 +9,14 @@ class BinaryRenderer(BaseRenderer):
 
     def render(self, data, accepted_media_type=None, renderer_context=None):
         return data
+
+
+class GzipCSVRenderer(BaseRenderer):
+    """ CSV downloads compressed as a .csv.gz file, requested with ?format=csv.gz """
+    media_type = 'application/gzip'
+    format = 'csv.gz'
+    charset = None
+    render_style = 'binary'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        return data
@@ -4,7 +4,10 @@ from rest_framework import serializers
 from rest_framework.exceptions import ValidationError
 
 from rest_api import validators
+from rest_api.extract import GTFSExtract
 from rest_api.models import *
+from rest_api.purge import purge
+from rqworkers.utils import get_job_progress
 
 
 class UserSerializer(serializers.ModelSerializer):
@@ -170,6 +173,7 @@ class DetailedShapeSerializer(NestedModelSerializer):
         for point in points:
             shape_points.append(ShapePoint(shape=shape, **point))
         ShapePoint.objects.bulk_create(shape_points)
+        TableVersion.objects.bump(shape.project_id, [ShapePoint], cascade=False)
         return shape
 
     def update(self, instance, validated_data):
@@ -179,8 +183,9 @@ class DetailedShapeSerializer(NestedModelSerializer):
             shape_points = list()
             for point in points:
                 shape_points.append(ShapePoint(shape=instance, **point))
-            ShapePoint.objects.filter(shape=instance).delete()
+            purge(ShapePoint.objects.filter(shape=instance))
             ShapePoint.objects.bulk_create(shape_points)
+            TableVersion.objects.bump(instance.project_id, [ShapePoint], cascade=False)
         try:
             super().update(instance, validated_data)
         except IntegrityError as err:
@@ -302,6 +307,7 @@ class TripSerializer(NestedModelSerializer):
                 if 'stop_times' in validated_data:
                     stop_times = map(lambda st: StopTime(trip=instance, **st), validated_data['stop_times'])
                     StopTime.objects.bulk_create(stop_times)
+                    TableVersion.objects.bump(instance.project_id, [StopTime], cascade=False)
                 return instance
         except IntegrityError as error:
             raise ValidationError(error)
@@ -311,9 +317,10 @@ class TripSerializer(NestedModelSerializer):
             with transaction.atomic():
                 instance = super().update(instance, self.simplify_data(validated_data))
                 if 'stop_times' in validated_data:
-                    StopTime.objects.filter(trip=instance).delete()
+                    purge(StopTime.objects.filter(trip=instance))
                     stop_times = map(lambda st: StopTime(trip=instance, **st), validated_data['stop_times'])
                     StopTime.objects.bulk_create(stop_times)
+                    TableVersion.objects.bump(instance.project_id, [StopTime], cascade=False)
                 return instance
         except IntegrityError as error:
             raise ValidationError(error)
@@ -380,14 +387,49 @@ class FrequencySerializer(serializers.ModelSerializer):
 class ProjectSerializer(serializers.ModelSerializer):
     feedinfo = FeedInfoSerializer(read_only=True)
     gtfs_validation = serializers.SerializerMethodField('get_gtfs_validation')
+    loading_gtfs_progress = serializers.SerializerMethodField('get_loading_gtfs_progress')
 
     def get_gtfs_validation(self, obj):
+        # message only holds the error of a failed validation, notices are listed by ValidationNoticeViewSet
         result = dict(error_number=obj.gtfs_validation_error_number, message=obj.gtfs_validation_message,
                       warning_number=obj.gtfs_validation_warning_number, duration=obj.gtfs_validation_duration)
         return result
 
+    def get_loading_gtfs_progress(self, obj):
+        # progress lives in the meta of the job (redis), it is only read while the project is loading
+        if obj.creation_status != Project.CREATION_STATUS_LOADING_GTFS:
+            return None
+        return get_job_progress(obj.loading_gtfs_job_id)
+
     class Meta:
         model = Project
         fields = ['project_id', 'name', 'feedinfo', 'last_modification', 'gtfs_file_updated_at',
                   'gtfs_building_and_validation_status', 'gtfs_building_duration', 'envelope', 'creation_status',
-                  'loading_gtfs_error_message', 'gtfs_validation']
+                  'loading_gtfs_error_message', 'gtfs_validation', 'loading_gtfs_progress']
+
+
+class ValidationNoticeSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = ValidationNotice
+        fields = ['id', 'filename', 'code', 'level', 'entity_id', 'title', 'description']
+
+
+class ExtractSerializer(serializers.ModelSerializer):
+    route_ids = serializers.ListField(child=serializers.CharField(), allow_empty=False, allow_null=True,
+                                      required=False)
+    bbox = serializers.ListField(child=serializers.FloatField(), min_length=4, max_length=4, allow_null=True,
+                                 required=False)
+
+    def validate(self, attrs):
+        try:
+            GTFSExtract(None, attrs.get('route_ids'), attrs.get('bbox'), attrs.get('start_date'),
+                        attrs.get('end_date'))
+        except ValueError as e:
+            raise ValidationError(str(e))
+        return attrs
+
+    class Meta:
+        model = Extract
+        fields = ['id', 'route_ids', 'bbox', 'start_date', 'end_date', 'status', 'error_message', 'file',
+                  'created_at', 'building_duration']
+        read_only_fields = ['status', 'error_message', 'file', 'created_at', 'building_duration']
@@ -1,2 +1,4 @@
 from rest_api.tests.basic_table_tests import *
 from rest_api.tests.csv_table_tests import *
+from rest_api.tests.command_buildgtfs_tests import *
+from rest_api.tests.validation_tests import *
@@ -462,8 +462,9 @@ class ShapeTableTest(BaseTableTest):
             'shape_id': shape_id
         }
         id = self.get_id(shape_id)
-        # 1 extra query to erase the shapepoints (cascade)
-        with self.assertNumQueries(5):
+        # 1 extra query to erase the shapepoints (cascade) and 3 to bump the versions of the changed tables and the
+        # last modification of the project
+        with self.assertNumQueries(8):
             json_response = self.delete(self.project.project_id, id, self.client, dict())
         self.assertEqual(Shape.objects.filter(**data).count(), 0)
 
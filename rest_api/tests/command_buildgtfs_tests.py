@@ -1,8 +1,27 @@
+import csv
+import datetime
+import hashlib
+import io
 import os
+import shutil
+import tempfile
+import uuid
+import zipfile
+from io import StringIO
+
+from unittest import mock
 
 from django.core.management import call_command, CommandError
+from django.test import SimpleTestCase, TransactionTestCase, override_settings
+from django.urls import reverse
+from rest_framework import status
+from rest_framework.test import APIClient
 
+from rest_api.export import BuildCache
+from rest_api.management.commands.buildgtfs import GTFS_FILES, DeflatedMember, add_deflated_member, export_table
+from rest_api.models import Calendar, Level, Stop, StopTime, TableVersion, Trip, Extract
 from rest_api.tests.test_helpers import BaseTestCase
+from rqworkers.jobs import build_gtfs_extract
 
 
 class TestBuildGTFS(BaseTestCase):
@@ -12,6 +31,7 @@ class TestBuildGTFS(BaseTestCase):
         self.command_name = 'buildgtfs'
 
     def tearDown(self):
+        BuildCache(self.project_obj.pk).clear()
         # delete test files
         if self.project_obj.gtfs_file:
             parent_path = os.path.sep.join(self.project_obj.gtfs_file.path.split(os.path.sep)[:-1])
@@ -44,3 +64,269 @@ class TestBuildGTFS(BaseTestCase):
         self.assertIsNotNone(self.project_obj.gtfs_building_duration)
         self.assertIsNotNone(self.project_obj.gtfs_file_updated_at)
         self.assertIsNotNone(self.project_obj.gtfs_file)
+
+    def test_run_command_streams_tables_into_zip(self):
+        staging_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, staging_root)
+        out = StringIO()
+        with override_settings(GTFS_STAGING_ROOT=staging_root), \
+                mock.patch('rest_api.management.commands.buildgtfs.tempfile.mkdtemp',
+                           wraps=tempfile.mkdtemp) as mock_mkdtemp:
+            call_command(self.command_name, self.project_obj.name, stdout=out)
+
+        self.assertIn('peak memory', out.getvalue())
+        self.project_obj.refresh_from_db()
+        with zipfile.ZipFile(self.project_obj.gtfs_file.path) as zf:
+            names = zf.namelist()
+            with io.TextIOWrapper(zf.open('stop_times.txt'), encoding='utf-8') as stop_times_file:
+                rows = list(csv.reader(stop_times_file))
+        for required_name in ['agency.txt', 'stops.txt', 'routes.txt', 'trips.txt', 'stop_times.txt', 'calendar.txt',
+                              'shapes.txt', 'feed_info.txt']:
+            self.assertIn(required_name, names)
+        self.assertEqual(len(rows) - 1, StopTime.objects.filter_by_project(self.project_obj.pk).count())
+        # the temporary archive was written in the staging root and moved to the storage
+        mock_mkdtemp.assert_called_once_with(dir=staging_root)
+        self.assertEqual([], os.listdir(staging_root))
+
+    def test_optional_tables_without_rows_are_left_out(self):
+        Level.objects.filter_by_project(self.project_obj.pk).delete()
+
+        call_command(self.command_name, self.project_obj.name, stdout=StringIO())
+
+        self.project_obj.refresh_from_db()
+        with zipfile.ZipFile(self.project_obj.gtfs_file.path) as zf:
+            self.assertNotIn('levels.txt', zf.namelist())
+
+    def build_and_get_exported_tables(self, *args):
+        with mock.patch('rest_api.management.commands.buildgtfs.export_table', wraps=export_table) as mock_export:
+            call_command(self.command_name, self.project_obj.name, *args, stdout=StringIO())
+        self.project_obj.refresh_from_db()
+        return sorted(call[0][1] for call in mock_export.call_args_list)
+
+    def read_gtfs_file(self, name):
+        with zipfile.ZipFile(self.project_obj.gtfs_file.path) as zf:
+            return zf.read(name).decode('utf-8')
+
+    def test_unchanged_tables_are_not_exported_again(self):
+        self.assertListEqual(self.build_and_get_exported_tables(), sorted(GTFS_FILES))
+        previous_stop_times = self.read_gtfs_file('stop_times.txt')
+
+        self.assertListEqual(self.build_and_get_exported_tables(), [])
+
+        calendar = Calendar.objects.filter_by_project(self.project_obj.pk).first()
+        url = reverse('project-calendars-detail', kwargs=dict(project_pk=self.project_obj.pk, pk=calendar.pk))
+        response = APIClient().patch(url, dict(monday=not calendar.monday), format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        self.assertListEqual(self.build_and_get_exported_tables(), ['calendar'])
+        self.assertIn('{0},{1}'.format(calendar.service_id, int(not calendar.monday)),
+                      self.read_gtfs_file('calendar.txt'))
+        self.assertEqual(self.read_gtfs_file('stop_times.txt'), previous_stop_times)
+        self.assertListEqual(self.build_and_get_exported_tables('--no-cache'), sorted(GTFS_FILES))
+
+    def test_content_hash(self):
+        call_command(self.command_name, self.project_obj.name)
+        self.project_obj.refresh_from_db()
+        first_hash = self.project_obj.gtfs_file_hash
+        self.assertEqual(64, len(first_hash))
+
+        # same content with or without the tables of the cache
+        call_command(self.command_name, self.project_obj.name, '--no-cache')
+        self.project_obj.refresh_from_db()
+        self.assertEqual(first_hash, self.project_obj.gtfs_file_hash)
+
+        Calendar.objects.filter_by_project(self.project_obj.pk).update(monday=False)
+        TableVersion.objects.bump(self.project_obj.pk, [Calendar])
+        call_command(self.command_name, self.project_obj.name)
+        self.project_obj.refresh_from_db()
+        self.assertNotEqual(first_hash, self.project_obj.gtfs_file_hash)
+
+    def test_tables_that_reference_a_changed_natural_id_are_exported_again(self):
+        self.build_and_get_exported_tables()
+        stop = Stop.objects.filter_by_project(self.project_obj.pk).filter(stoptime__isnull=False).first()
+        url = reverse('project-stops-detail', kwargs=dict(project_pk=self.project_obj.pk, pk=stop.pk))
+        client = APIClient()
+
+        response = client.patch(url, dict(stop_name='renamed stop'), format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertListEqual(self.build_and_get_exported_tables(), ['stops'])
+
+        response = client.patch(url, dict(stop_id='renamed_stop_id'), format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        exported_tables = self.build_and_get_exported_tables()
+        for table in ['stops', 'stop_times', 'transfers', 'pathways']:
+            self.assertIn(table, exported_tables)
+        self.assertNotIn('trips', exported_tables)
+        self.assertIn(',renamed_stop_id,', self.read_gtfs_file('stop_times.txt'))
+
+
+class TestAddDeflatedMember(SimpleTestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.zip_path = os.path.join(self.directory, 'gtfs.zip')
+        self.member = self.create_member(b'stop_id,stop_name\r\n' * 100)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def create_member(self, content):
+        path = os.path.join(self.directory, 'member')
+        with open(path, 'wb') as file_obj:
+            member = DeflatedMember(file_obj)
+            member.write(content)
+            member.close()
+        return dict(path=path, crc=member.crc, file_size=member.file_size, compress_size=member.compress_size)
+
+    def test_archive_can_be_read_again(self):
+        # sizes over the ZIP64 threshold need the extra fields of ZIP64 in the headers
+        large_member = dict(self.member, file_size=zipfile.ZIP64_LIMIT + 1)
+        with zipfile.ZipFile(self.zip_path, 'w', zipfile.ZIP_DEFLATED, True) as zf:
+            add_deflated_member(zf, 'stops.txt', self.member, hashlib.sha256())
+            add_deflated_member(zf, 'large.txt', large_member, hashlib.sha256())
+            zf.writestr('after.txt', 'a member written by zipfile')
+
+        with zipfile.ZipFile(self.zip_path) as zf:
+            self.assertIsNone(zf.testzip())
+            self.assertEqual(['stops.txt', 'large.txt', 'after.txt'], zf.namelist())
+            self.assertEqual(zipfile.ZIP64_LIMIT + 1, zf.getinfo('large.txt').file_size)
+            self.assertEqual(b'stop_id,stop_name\r\n' * 100, zf.read('stops.txt'))
+
+    def test_archive_must_be_open_for_writing(self):
+        with zipfile.ZipFile(self.zip_path, 'w') as zf:
+            zf.writestr('stops.txt', 'stop_id')
+            with zf.open('other.txt', 'w'):
+                with self.assertRaises(ValueError):
+                    add_deflated_member(zf, 'stops.txt', self.member, hashlib.sha256())
+
+        with zipfile.ZipFile(self.zip_path, 'a') as zf:
+            with self.assertRaises(ValueError):
+                add_deflated_member(zf, 'stops.txt', self.member, hashlib.sha256())
+
+
+class TestBuildGTFSWithWorkers(TransactionTestCase):
+
+    def setUp(self):
+        self.project_obj = BaseTestCase.create_data()[0]
+        self.command_name = 'buildgtfs'
+
+    def build(self, workers):
+        call_command(self.command_name, self.project_obj.name, workers=workers, stdout=StringIO())
+        self.project_obj.refresh_from_db()
+        try:
+            with zipfile.ZipFile(self.project_obj.gtfs_file.path) as zf:
+                self.assertIsNone(zf.testzip())
+                return {name: zf.read(name) for name in zf.namelist()}
+        finally:
+            self.project_obj.gtfs_file.delete()
+            BuildCache(self.project_obj.pk).clear()
+
+    def test_tables_exported_by_workers_match_sequential_build(self):
+        sequential_files = self.build(1)
+        parallel_files = self.build(3)
+
+        self.assertListEqual(list(parallel_files), list(sequential_files))
+        self.assertDictEqual(parallel_files, sequential_files)
+
+
+class TestBuildGTFSExtract(BaseTestCase):
+
+    def setUp(self):
+        self.project_obj = self.create_data()[0]
+        self.command_name = 'buildgtfs'
+        self.directory = tempfile.mkdtemp()
+        self.output = os.path.join(self.directory, 'extract.zip')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+        for extract_obj in Extract.objects.filter_by_project(self.project_obj.pk):
+            if extract_obj.file:
+                extract_obj.file.delete(save=False)
+
+    def build_extract(self, **options):
+        call_command(self.command_name, self.project_obj.name, output=self.output, stdout=StringIO(), **options)
+        with zipfile.ZipFile(self.output) as zf:
+            return {name[:-len('.txt')]: list(csv.DictReader(io.TextIOWrapper(zf.open(name), encoding='utf-8')))
+                    for name in zf.namelist()}
+
+    def test_extract_of_routes(self):
+        tables = self.build_extract(route_ids=['route0'])
+
+        self.assertListEqual([row['trip_id'] for row in tables['trips']], ['trip0'])
+        self.assertListEqual([row['route_id'] for row in tables['routes']], ['route0'])
+        self.assertListEqual([row['agency_id'] for row in tables['agency']], ['agency_0'])
+        self.assertListEqual([row['service_id'] for row in tables['calendar']], ['mon-fri'])
+        self.assertEqual(len(tables['stop_times']), 11)
+        self.assertSetEqual(set(row['stop_id'] for row in tables['stops']),
+                            set(row['stop_id'] for row in tables['stop_times']))
+        self.assertEqual(len(tables['frequencies']), 1)
+        self.assertEqual(len(tables['transfers']), 1)
+        # the fare without rules applies to every route, the other one only to route3
+        self.assertListEqual([row['fare_id'] for row in tables['fare_attributes']], ['test_fare_attr'])
+        for table in ['fare_rules', 'pathways', 'levels']:
+            self.assertNotIn(table, tables)
+        self.assertEqual(len(tables['feed_info']), 1)
+        # the project and its cached files are not touched
+        self.project_obj.refresh_from_db()
+        self.assertFalse(self.project_obj.gtfs_file)
+        self.assertFalse(os.path.exists(BuildCache(self.project_obj.pk).directory))
+
+    def test_extract_of_an_area(self):
+        tables = self.build_extract(bbox=[70.58, 33.40, 70.60, 33.50])
+
+        self.assertListEqual([row['trip_id'] for row in tables['trips']], ['trip2'])
+        self.assertListEqual([row['route_id'] for row in tables['routes']], ['route2'])
+        # trips are kept whole, with the stops outside the area
+        self.assertEqual(len(tables['stops']), 11)
+
+    def test_extract_of_a_service_window(self):
+        # the weekday service runs on saturday 2020-09-19 because of an added date
+        tables = self.build_extract(start_date=datetime.date(2020, 9, 19), end_date=datetime.date(2020, 9, 20))
+        self.assertEqual(len(tables['trips']), Trip.objects.filter_by_project(self.project_obj.pk).count())
+        self.assertListEqual([row['service_id'] for row in tables['calendar']], ['mon-fri'])
+
+        tables = self.build_extract(start_date=datetime.date(2021, 1, 4), end_date=datetime.date(2021, 1, 8))
+        for table in ['trips', 'stop_times', 'stops', 'routes', 'agency', 'calendar']:
+            self.assertListEqual(tables[table], [])
+
+    def test_extract_arguments(self):
+        with self.assertRaisesMessage(CommandError, '--output is required to build an extract'):
+            call_command(self.command_name, self.project_obj.name, route_ids=['route0'])
+        with self.assertRaisesMessage(CommandError, 'start date and end date must be given together'):
+            call_command(self.command_name, self.project_obj.name, '--start-date', '20200101', '--output',
+                         self.output)
+        with self.assertRaises(CommandError):
+            call_command(self.command_name, self.project_obj.name, '--start-date', '2020-01-01', '--end-date',
+                         '20200102', '--output', self.output)
+
+    @mock.patch('rest_api.views.build_gtfs_extract')
+    def test_create_extract(self, mock_build_gtfs_extract):
+        job_id = uuid.uuid4()
+        type(mock_build_gtfs_extract.delay.return_value).id = mock.PropertyMock(return_value=job_id)
+        url = reverse('project-extracts-list', kwargs=dict(project_pk=self.project_obj.pk))
+        client = APIClient()
+
+        response = client.post(url, dict(bbox=[70.6, 33.5, 70.5, 33.6]), format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        mock_build_gtfs_extract.delay.assert_not_called()
+
+        response = client.post(url, dict(route_ids=['route0'], start_date='2020-01-01', end_date='2020-01-31'),
+                               format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.data['status'], Extract.STATUS_QUEUED)
+        extract_obj = Extract.objects.get(pk=response.data['id'])
+        mock_build_gtfs_extract.delay.assert_called_once_with(extract_obj.pk)
+        self.assertEqual(extract_obj.job_id, job_id)
+
+        # the job runs here without a queue
+        build_gtfs_extract(extract_obj.pk)
+        extract_obj.refresh_from_db()
+        self.assertEqual(extract_obj.status, Extract.STATUS_FINISHED)
+        with zipfile.ZipFile(extract_obj.file.path) as zf:
+            self.assertIn(b'trip0', zf.read('trips.txt'))
+            self.assertNotIn(b'trip1', zf.read('trips.txt'))
+
+        url = reverse('project-extracts-download', kwargs=dict(project_pk=self.project_obj.pk, pk=extract_obj.pk))
+        response = client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_302_FOUND)
+        self.assertEqual(response.url, extract_obj.file.url)
@@ -1,8 +1,19 @@
-from datetime import date
-
+import gzip
+import threading
+from datetime import date, timedelta
+from io import BytesIO, StringIO
+from unittest import mock
+
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.urls import reverse
+from rest_framework import status
+
+from rest_api.export import iter_copy, CRLFWriter
+from rest_api.management.commands.buildgtfs import GTFS_FILES, Command
 from rest_api.models import Shape, Calendar, Level, CalendarDate, Stop, Pathway, Transfer, Agency, Route, \
-    FareAttribute, Trip, StopTime, ShapePoint, Frequency, FeedInfo
+    FareAttribute, Trip, StopTime, ShapePoint, Frequency, FeedInfo, Project, TableVersion
 from rest_api.tests.test_helpers import CSVTestCase, CSVTestMixin
+from rest_api.views import CSVDownloadMixin, CalendarViewSet, ShapeViewSet, StopTimeViewSet
 
 
 class CalendarsCSVTest(CSVTestMixin, CSVTestCase):
@@ -88,6 +99,20 @@ class StopsCSVTest(CSVTestMixin, CSVTestCase):
             'stop_lon': 10.0
         }
 
+    def test_upload_with_unknown_columns_and_short_rows(self):
+        url = reverse('project-stops-upload', kwargs={'project_pk': self.project.project_id})
+        content = b'stop_lon,unknown,stop_id,stop_lat,stop_name,stop_code\n1.5,x,stop_new,2.5,New\n' \
+                  b'3.5,y,stop_other,4.5,Other,code\n'
+        uploaded_file = SimpleUploadedFile('stops', content, content_type='application/octet-stream')
+
+        self._make_request(self.client, self.PUT_REQUEST, url, {'file': uploaded_file}, status.HTTP_200_OK,
+                           json_process=False,
+                           HTTP_CONTENT_DISPOSITION='attachment; filename=stops.csv')
+
+        stops = Stop.objects.filter_by_project(self.project.project_id).order_by('stop_id')
+        self.assertEqual([(s.stop_id, s.stop_lat, s.stop_lon, s.stop_name, s.stop_code) for s in stops],
+                         [('stop_new', 2.5, 1.5, 'New', None), ('stop_other', 4.5, 3.5, 'Other', 'code')])
+
 
 class PathwaysCSVTest(CSVTestMixin, CSVTestCase):
     class Meta:
@@ -295,6 +320,28 @@ class ShapeCSVTest(CSVTestMixin, CSVTestCase):
                                                                                          shape__shape_id=k)
             self.assertEquals(query.count(), 0)
 
+    def test_download_queries_do_not_depend_on_shapes(self):
+        qs = ShapeViewSet.get_qs({'project_pk': self.project.project_id})
+        with self.assertNumQueries(1):
+            rows = list(ShapeViewSet.get_rows(ShapeViewSet.Meta, qs))
+        self.assertEqual(len(rows) - 1, ShapePoint.objects.filter_by_project(self.project.project_id).count())
+
+        for i in range(20):
+            shape = Shape.objects.create(project=self.project, shape_id='extra_shape_{0:02d}'.format(i))
+            ShapePoint.objects.bulk_create([ShapePoint(shape=shape, shape_pt_sequence=sequence, shape_pt_lat=i,
+                                                       shape_pt_lon=sequence) for sequence in [3, 1, 2]])
+        qs = ShapeViewSet.get_qs({'project_pk': self.project.project_id})
+        with self.assertNumQueries(1):
+            rows = list(ShapeViewSet.get_rows(ShapeViewSet.Meta, qs))
+
+        self.assertEqual(rows[0], ['shape_id', 'shape_pt_lat', 'shape_pt_lon', 'shape_pt_sequence'])
+        self.assertEqual(len(rows) - 1, ShapePoint.objects.filter_by_project(self.project.project_id).count())
+        # rows are ordered by shape and then by sequence
+        keys = [(row[0], row[3]) for row in rows[1:]]
+        self.assertEqual(keys, sorted(keys))
+        self.assertEqual(rows[1:4], [['extra_shape_00', 0.0, 1.0, 1], ['extra_shape_00', 0.0, 2.0, 2],
+                                     ['extra_shape_00', 0.0, 3.0, 3]])
+
 
 class StopTimesCSVTest(CSVTestMixin, CSVTestCase):
     class Meta:
@@ -336,6 +383,34 @@ class StopTimesCSVTest(CSVTestMixin, CSVTestCase):
 
         }
 
+    @mock.patch.object(CSVDownloadMixin, 'DOWNLOAD_BUFFER_SIZE', 200)
+    @mock.patch.object(CSVDownloadMixin, 'DOWNLOAD_CHUNK_SIZE', 2)
+    def test_download_is_streamed_in_chunks(self):
+        url = reverse('project-stoptimes-download', kwargs={'project_pk': self.project.project_id})
+
+        chunks = [chunk.decode('utf-8') for chunk in self.client.get(url, {}).streaming_content]
+
+        # the header goes first and alone
+        self.assertEqual(chunks[0], ','.join(StopTimeViewSet.Meta.csv_header) + '\r\n')
+        self.assertGreater(len(chunks), 2)
+        self.assertEqual(len(''.join(chunks).splitlines()) - 1,
+                         StopTime.objects.filter_by_project(self.project.project_id).count())
+
+    def test_upload_with_unresolved_foreign_keys(self):
+        url = reverse('project-stoptimes-upload', kwargs={'project_pk': self.project.project_id})
+        content = b'trip_id,stop_id,stop_sequence\ntrip0,stop_0,1\nwrong_trip,stop_0,2\nother_trip,stop_1,1\n'
+        uploaded_file = SimpleUploadedFile('stoptimes', content, content_type='application/octet-stream')
+        previous_count = StopTime.objects.filter_by_project(self.project.project_id).count()
+
+        json_response = self._make_request(self.client, self.PUT_REQUEST, url, {'file': uploaded_file},
+                                           status.HTTP_400_BAD_REQUEST,
+                                           HTTP_CONTENT_DISPOSITION='attachment; filename=stoptimes.csv')
+
+        self.assertEqual(json_response['field'], 'trip_id')
+        self.assertEqual(json_response['values'], ['other_trip', 'wrong_trip'])
+        self.assertEqual(json_response['count'], '2')
+        self.assertEqual(StopTime.objects.filter_by_project(self.project.project_id).count(), previous_count)
+
 
 class FrequencyCSVTest(CSVTestMixin, CSVTestCase):
     class Meta:
@@ -386,3 +461,205 @@ class FeedInfoCSVTest(CSVTestMixin, CSVTestCase):
     def test_download(self):
         FeedInfo.objects.filter_by_project(self.project.project_id).update(feed_id='Test Feed 0')
         super().test_download()
+
+
+class CopyExportTest(CSVTestCase):
+
+    @staticmethod
+    def python_csv(view, qs):
+        out = StringIO()
+        view.write_to_file(out, view.Meta, qs)
+        return out.getvalue().encode('utf-8')
+
+    @staticmethod
+    def copy_csv(view, qs):
+        out = BytesIO()
+        view.copy_to_file(out, view.Meta, qs)
+        return out.getvalue()
+
+    def test_copy_matches_python_writer_for_every_table(self):
+        for gtfs_filename, gtfs_file in GTFS_FILES.items():
+            view = gtfs_file['viewset']
+            qs = view.get_qs({'project_pk': self.project.project_id})
+            self.assertEqual(self.copy_csv(view, qs), self.python_csv(view, qs), gtfs_filename)
+
+    def test_copy_matches_python_writer_with_special_values(self):
+        stop_times = list(StopTime.objects.filter_by_project(self.project.project_id).order_by('pk'))
+        values = [
+            dict(arrival_time=timedelta(hours=25, minutes=3, seconds=7), departure_time=timedelta(hours=8),
+                 stop_headsign='Line, "quoted"\nnext', shape_dist_traveled=12.0, timepoint=1),
+            dict(arrival_time=timedelta(hours=123, seconds=59), departure_time=timedelta(0), stop_headsign='',
+                 shape_dist_traveled=1 / 3, pickup_type=0),
+            dict(arrival_time=timedelta(minutes=1), stop_headsign='"', shape_dist_traveled=-3.5e-05),
+        ]
+        for stop_time, stop_time_values in zip(stop_times, values):
+            StopTime.objects.filter(pk=stop_time.pk).update(**stop_time_values)
+        ShapePoint.objects.filter_by_project(self.project.project_id).update(shape_pt_lat=-33.456987654321,
+                                                                             shape_pt_lon=-70.0)
+
+        for view in [StopTimeViewSet, ShapeViewSet]:
+            qs = view.get_qs({'project_pk': self.project.project_id})
+            self.assertEqual(self.copy_csv(view, qs), self.python_csv(view, qs))
+        stop_times_csv = self.copy_csv(StopTimeViewSet, StopTimeViewSet.get_qs({'project_pk': self.project.project_id}))
+        self.assertIn(b',25:03:07,08:00:00,"Line, ""quoted""\nnext",', stop_times_csv)
+        self.assertIn(b',123:00:59,00:00:00,,0,', stop_times_csv)
+
+    def test_download_uses_copy(self):
+        url = reverse('project-shapes-download', kwargs={'project_pk': self.project.project_id})
+        qs = ShapeViewSet.get_qs({'project_pk': self.project.project_id})
+
+        with mock.patch('rest_api.views.iter_copy', wraps=iter_copy) as mock_iter_copy:
+            response = self.client.get(url)
+            content = b''.join(response.streaming_content)
+
+        mock_iter_copy.assert_called_once()
+        self.assertEqual(content, self.python_csv(ShapeViewSet, qs))
+
+    def test_download_sends_the_header_before_copy_finishes(self):
+        url = reverse('project-stoptimes-download', kwargs={'project_pk': self.project.project_id})
+        qs = StopTimeViewSet.get_qs({'project_pk': self.project.project_id})
+        release = threading.Event()
+
+        class BlockedWriter(CRLFWriter):
+            """ COPY waits after each piece it writes until the test lets it go on """
+
+            def write(self, data):
+                super().write(data)
+                release.wait(10)
+
+        try:
+            with mock.patch('rest_api.export.CRLFWriter', BlockedWriter):
+                content = iter(self.client.get(url).streaming_content)
+                first_chunk = next(content)
+                copy_threads = [thread for thread in threading.enumerate() if thread.name == 'copy-export']
+
+                self.assertEqual(','.join(StopTimeViewSet.Meta.csv_header).encode('utf-8') + b'\r\n', first_chunk)
+                self.assertEqual(1, len(copy_threads))
+                self.assertTrue(copy_threads[0].is_alive())
+                release.set()
+                rest = b''.join(content)
+        finally:
+            release.set()
+
+        self.assertEqual(first_chunk + rest, self.python_csv(StopTimeViewSet, qs))
+        self.assertFalse(copy_threads[0].is_alive())
+
+    @mock.patch.object(CSVDownloadMixin, 'DOWNLOAD_BUFFER_SIZE', 10)
+    def test_closed_download_stops_copy(self):
+        qs = StopTimeViewSet.get_qs({'project_pk': self.project.project_id})
+        content = StopTimeViewSet.stream_csv(StopTimeViewSet.Meta, qs)
+        next(content)
+        copy_threads = [thread for thread in threading.enumerate() if thread.name == 'copy-export']
+
+        # as the response does when the client goes away
+        content.close()
+
+        self.assertFalse(copy_threads[0].is_alive())
+        # the connection can still be used
+        self.assertLess(0, StopTime.objects.filter_by_project(self.project.project_id).count())
+
+    def test_row_formatter_is_compiled_once_per_meta(self):
+        qs = CalendarViewSet.get_qs({'project_pk': self.project.project_id})
+        _, csv_fields, qs = CalendarViewSet.get_export_query(CalendarViewSet.Meta, qs)
+        formatter = CalendarViewSet.Meta.get_row_formatter(qs.model, csv_fields)
+
+        with mock.patch('rest_api.views.RowFormatter') as mock_row_formatter:
+            rows = list(CalendarViewSet.get_rows(CalendarViewSet.Meta, qs))
+        mock_row_formatter.assert_not_called()
+
+        self.assertEqual(len(rows) - 1, qs.count())
+        self.assertEqual(formatter.format(('regular days', True, False, None, True, True, False, False,
+                                           date(2020, 1, 2), date(2020, 12, 31))),
+                         ['regular days', 1, 0, None, 1, 1, 0, 0, '20200102', '20201231'])
+
+
+class ConditionalDownloadTest(CSVTestCase):
+
+    def download(self, endpoint, data=None, **headers):
+        url = reverse('project-{}-download'.format(endpoint), kwargs={'project_pk': self.project.project_id})
+        return self.client.get(url, data, **headers)
+
+    def test_download_has_validators(self):
+        response = self.download('stoptimes')
+        b''.join(response.streaming_content)
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertRegex(response['ETag'], r'^"{0}-stoptimes-v\d+-\d+-csv"$'.format(self.project.project_id))
+        self.assertIn('Last-Modified', response)
+
+    def test_current_version_is_not_downloaded_again(self):
+        etag = self.download('stoptimes')['ETag']
+
+        with mock.patch.object(StopTimeViewSet, 'stream_csv') as mock_stream_csv:
+            response = self.download('stoptimes', HTTP_IF_NONE_MATCH=etag)
+        mock_stream_csv.assert_not_called()
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(response['ETag'], etag)
+
+    def test_etag_changes_when_the_table_changes(self):
+        stop_times_etag = self.download('stoptimes')['ETag']
+        shapes_etag = self.download('shapes')['ETag']
+        last_modification = Project.objects.get(pk=self.project.project_id).last_modification
+
+        TableVersion.objects.bump(self.project.project_id, [ShapePoint], cascade=False)
+
+        self.assertGreater(Project.objects.get(pk=self.project.project_id).last_modification, last_modification)
+        self.assertEqual(self.download('stoptimes', HTTP_IF_NONE_MATCH=stop_times_etag).status_code,
+                         status.HTTP_304_NOT_MODIFIED)
+        response = self.download('shapes', HTTP_IF_NONE_MATCH=shapes_etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(response['ETag'], shapes_etag)
+
+    def test_etag_changes_when_removed_shapes_delete_trips(self):
+        trip = Trip.objects.filter_by_project(self.project.project_id).first()
+        trip.shape = Shape.objects.get(project=self.project, shape_id='shape_2')
+        trip.save()
+        TableVersion.objects.bump(self.project.project_id, [Trip])
+        etags = {endpoint: self.download(endpoint)['ETag'] for endpoint in ['trips', 'stoptimes', 'frequencies']}
+        cache_keys = Command.get_cache_keys(self.project.project_id)
+
+        # shapes.csv without shape_2
+        url = reverse('project-shapes-upload', kwargs={'project_pk': self.project.project_id})
+        with open('rest_api/tests/csv/upload_delete/shapes.csv', 'rb') as file_obj:
+            uploaded_file = SimpleUploadedFile('shapes', file_obj.read(), content_type='application/octet-stream')
+        self._make_request(self.client, self.PUT_REQUEST, url, {'file': uploaded_file}, status.HTTP_200_OK,
+                           json_process=False, HTTP_CONTENT_DISPOSITION='attachment; filename=shapes.csv')
+
+        self.assertFalse(Trip.objects.filter(pk=trip.pk).exists())
+        for endpoint, etag in etags.items():
+            response = self.download(endpoint, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertNotEqual(response['ETag'], etag)
+        new_cache_keys = Command.get_cache_keys(self.project.project_id)
+        for gtfs_filename in ['shapes', 'trips', 'stop_times', 'frequencies']:
+            self.assertNotEqual(new_cache_keys[gtfs_filename], cache_keys[gtfs_filename])
+        self.assertEqual(new_cache_keys['stops'], cache_keys['stops'])
+
+
+class CompressedDownloadTest(CSVTestCase):
+
+    def download(self, endpoint, data=None, **headers):
+        url = reverse('project-{}-download'.format(endpoint), kwargs={'project_pk': self.project.project_id})
+        response = self.client.get(url, data, **headers)
+        return response, b''.join(response.streaming_content)
+
+    def test_download_is_compressed_when_the_client_accepts_gzip(self):
+        for endpoint in ['stoptimes', 'calendars']:
+            response, content = self.download(endpoint)
+            compressed_response, compressed_content = self.download(endpoint, HTTP_ACCEPT_ENCODING='gzip, deflate')
+
+            self.assertNotIn('Content-Encoding', response)
+            self.assertEqual(compressed_response['Content-Encoding'], 'gzip')
+            self.assertEqual(compressed_response['Content-Type'], 'text/csv')
+            self.assertIn('Accept-Encoding', compressed_response['Vary'])
+            self.assertNotEqual(compressed_response['ETag'], response['ETag'])
+            self.assertEqual(gzip.decompress(compressed_content), content)
+
+    def test_download_csv_gz_file(self):
+        _, content = self.download('stoptimes')
+        response, compressed_content = self.download('stoptimes', {'format': 'csv.gz'}, HTTP_ACCEPT_ENCODING='gzip')
+
+        self.assertNotIn('Content-Encoding', response)
+        self.assertEqual(response['Content-Type'], 'application/gzip')
+        self.assertEqual(response['Content-Disposition'], 'attachment; filename="stoptimes.csv.gz"')
+        self.assertEqual(gzip.decompress(compressed_content), content)
@@ -9,9 +9,10 @@ from unittest import mock
 from django.core.files import File
 from django.core.files.base import ContentFile
 from django.core.files.uploadedfile import SimpleUploadedFile
-from django.db import models
+from django.db import models, transaction
 from django.test import TestCase
 from django.urls import reverse
+from django.utils import timezone
 from rest_framework import status
 from rest_framework.test import APIClient
 from rq.exceptions import NoSuchJobError
@@ -19,7 +20,10 @@ from rq.worker import WorkerStatus
 
 from rest_api.models import Project, Calendar, FeedInfo, Agency, Stop, Route, Trip, Frequency, StopTime, Level, Shape, \
     ShapePoint, CalendarDate, Pathway, Transfer, FareAttribute, FareRule
+from rest_api.purge import purge
 from rest_api.serializers import ProjectSerializer
+from rest_api.utils import get_file_hash, remove_staged_file
+from rqworkers.jobs import IMPORT_MODE_DIFF
 
 
 class BaseTestCase(TestCase):
@@ -395,6 +399,63 @@ class ProjectAPITest(BaseTestCase):
         self.projects_delete(self.client, id)
         self.assertEqual(Project.objects.filter(project_id=id).count(), 0)
 
+    def test_delete_project_with_data(self):
+        # project names are unique
+        for project_obj in Project.objects.all():
+            Project.objects.filter(pk=project_obj.pk).update(name='{0} (first)'.format(project_obj.name))
+        other_project = self.create_data()[0]
+        gtfs_models = [Calendar, CalendarDate, FeedInfo, Level, Stop, Pathway, Transfer, Shape, ShapePoint, Agency,
+                       Route, FareAttribute, FareRule, Trip, StopTime, Frequency]
+        other_counts = {model: model.objects.filter_by_project(other_project.pk).count() for model in gtfs_models}
+
+        self.projects_delete(self.client, self.project.pk)
+
+        self.assertFalse(Project.objects.filter(pk=self.project.pk).exists())
+        for model in gtfs_models:
+            self.assertEqual(model.objects.filter_by_project(self.project.pk).count(), 0, model.__name__)
+            self.assertEqual(model.objects.filter_by_project(other_project.pk).count(), other_counts[model],
+                             model.__name__)
+
+    def test_purge_matches_django_delete(self):
+        querysets = [Stop.objects.filter_by_project(self.project.pk).filter(stop_id='stop_1'),
+                     Shape.objects.filter_by_project(self.project.pk),
+                     Route.objects.filter_by_project(self.project.pk).exclude(route_id='route0'),
+                     Level.objects.filter_by_project(self.project.pk),
+                     StopTime.objects.filter_by_project(self.project.pk)]
+        for queryset in querysets:
+            with transaction.atomic():
+                expected_result = queryset.all().delete()
+                expected_stops = list(Stop.objects.order_by('id').values_list('id', 'level_id', 'parent_station_id'))
+                expected_fare_rules = list(FareRule.objects.order_by('id').values_list('id', 'route_id'))
+                transaction.set_rollback(True)
+            with transaction.atomic():
+                self.assertEqual(purge(queryset.all()), expected_result)
+                self.assertListEqual(list(Stop.objects.order_by('id').values_list('id', 'level_id',
+                                                                                  'parent_station_id')),
+                                     expected_stops)
+                self.assertListEqual(list(FareRule.objects.order_by('id').values_list('id', 'route_id')),
+                                     expected_fare_rules)
+                transaction.set_rollback(True)
+
+    def test_purge_parent_station_keeps_its_children(self):
+        station = Stop.objects.create(project=self.project, stop_id='station', stop_lat=0, stop_lon=0,
+                                      location_type=1)
+        other_station = Stop.objects.create(project=self.project, stop_id='other_station', stop_lat=0, stop_lon=0,
+                                            location_type=1)
+        Stop.objects.filter(project=self.project, stop_id__in=['stop_1', 'stop_2']).update(parent_station=station)
+        # a station deleted with its parent
+        other_station.parent_station = station
+        other_station.save()
+
+        # committed, so deferred foreign keys are checked
+        with transaction.atomic():
+            result = purge(Stop.objects.filter(pk__in=[station.pk, other_station.pk]))
+
+        self.assertEqual((2, {'rest_api.Stop': 2}), result)
+        children = Stop.objects.filter(project=self.project, stop_id__in=['stop_1', 'stop_2'])
+        self.assertEqual(2, children.count())
+        self.assertEqual([None, None], [child.parent_station_id for child in children])
+
     def test_patch(self):
         # One to get one to update
         with self.assertNumQueries(3):
@@ -421,7 +482,13 @@ class ProjectAPITest(BaseTestCase):
         self.assertEqual(new_project_obj.loading_gtfs_job_id, job_id)
         self.assertDictEqual(json_response, ProjectSerializer(new_project_obj).data)
         self.assertEqual(new_project_obj.creation_status, Project.CREATION_STATUS_LOADING_GTFS)
-        mock_upload_gtfs.delay.assert_called_with(new_project_obj.pk, zip_content.encode('utf-8'))
+        # job receives the path of the staged file and its hash instead of the content
+        zip_path, zip_hash = mock_upload_gtfs.delay.call_args[0][1:]
+        mock_upload_gtfs.delay.assert_called_with(new_project_obj.pk, zip_path, zip_hash)
+        with open(zip_path, 'rb') as staged_file:
+            self.assertEqual(staged_file.read(), zip_content.encode('utf-8'))
+        self.assertEqual(zip_hash, get_file_hash(zip_path))
+        remove_staged_file(zip_path)
 
     @mock.patch('rest_api.views.upload_gtfs_file_when_project_is_created')
     def test_projects_create_project_from_gtfs_action_without_gtfs_file(self, mock_upload_gtfs):
@@ -534,14 +601,38 @@ class ProjectAPITest(BaseTestCase):
 
     @mock.patch('rest_api.views.upload_gtfs_file_when_project_is_created')
     def test_upload_gtfs_file(self, mock_upload_gtfs_file_when_project_is_created):
+        job_id = uuid.uuid4()
+        type(mock_upload_gtfs_file_when_project_is_created.delay.return_value).id = job_id
         current_dir = pathlib.Path(__file__).parent.absolute()
         with open(os.path.join(current_dir, '..', '..', 'rqworkers', 'tests', 'cat.jpg'), 'rb') as fp:
             json_response = self.projects_upload_gtfs_file_action(self.client, self.project.pk, fp)
 
         mock_upload_gtfs_file_when_project_is_created.delay.assert_called_once()
+        self.assertEqual(mock_upload_gtfs_file_when_project_is_created.delay.call_args[0][3], IMPORT_MODE_DIFF)
+        remove_staged_file(mock_upload_gtfs_file_when_project_is_created.delay.call_args[0][1])
         self.project.refresh_from_db()
+        self.assertEqual(self.project.loading_gtfs_job_id, job_id)
         self.assertDictEqual(json_response, ProjectSerializer(self.project).data)
 
+    @mock.patch('rest_api.serializers.get_job_progress')
+    def test_retrieve_project_while_gtfs_is_loading(self, mock_get_job_progress):
+        progress = dict(phase='loading', current_files=['stop_times.txt'], files={
+            'stop_times.txt': dict(status='loading', rows=1000, bytes_read=50000, total_bytes=100000,
+                                   rows_per_second=500, eta=2, elapsed_time=2)})
+        mock_get_job_progress.return_value = progress
+        self.project.loading_gtfs_job_id = uuid.uuid4()
+        self.project.save()
+
+        json_response = self.projects_retrieve(self.client, self.project.pk)
+        self.assertIsNone(json_response['loading_gtfs_progress'])
+        mock_get_job_progress.assert_not_called()
+
+        self.project.creation_status = Project.CREATION_STATUS_LOADING_GTFS
+        self.project.save()
+        json_response = self.projects_retrieve(self.client, self.project.pk)
+        self.assertDictEqual(json_response['loading_gtfs_progress'], progress)
+        mock_get_job_progress.assert_called_once_with(self.project.loading_gtfs_job_id)
+
     def test_download_gtfs_file_but_file_does_not_exist(self):
         json_response = self.projects_download_action(self.client, self.project.pk,
                                                       status_code=status.HTTP_400_BAD_REQUEST)
@@ -558,6 +649,29 @@ class ProjectAPITest(BaseTestCase):
         if len(os.listdir(parent_path)) == 0:
             os.rmdir(parent_path)
 
+    def test_download_gtfs_file_not_modified(self):
+        self.project.gtfs_file.save('test_file', ContentFile('content'))
+        self.project.gtfs_file_updated_at = timezone.now()
+        self.project.save()
+        url = reverse('project-download', kwargs=dict(pk=self.project.pk))
+        etag = self.client.get(url)['ETag']
+
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+        # a new build changes the ETag
+        self.project.gtfs_file_updated_at = timezone.now()
+        self.project.save()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_302_FOUND)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertIn('Last-Modified', response)
+
+        parent_path = os.path.sep.join(self.project.gtfs_file.path.split(os.path.sep)[:-1])
+        self.project.gtfs_file.delete()
+        if len(os.listdir(parent_path)) == 0:
+            os.rmdir(parent_path)
+
 
 class BaseTableTest(BaseTestCase):
     lookup_field = "id"
@@ -735,9 +849,10 @@ class CSVTestMixin:
 
         response = self.client.get(url, {})
 
+        self.assertTrue(response.streaming)
         with open('rest_api/tests/csv/download/{}.csv'.format(filename), 'rb') as expected_file:
             expected = expected_file.read().strip().splitlines()
-        output = response.content.strip().splitlines()
+        output = b''.join(response.streaming_content).strip().splitlines()
         self.assertEquals(len(output), len(expected))
         for i in range(len(output)):
             self.assertEquals(output[i], expected[i])
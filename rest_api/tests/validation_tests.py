@@ -0,0 +1,136 @@
+import datetime
+
+from django.urls import reverse
+from rest_framework import status
+from rest_framework.test import APIClient
+
+from rest_api.models import Calendar, Project, Stop, StopTime, Trip, ValidationNotice
+from rest_api.tests.test_helpers import BaseTestCase
+from rest_api.validation import validate_project, ERROR, WARNING
+
+
+class ValidateProjectTest(BaseTestCase):
+
+    def setUp(self):
+        self.project_obj = self.create_data()[0]
+
+    def get_notices(self, code):
+        return [notice for notice in validate_project(self.project_obj.pk) if notice[1] == code]
+
+    def test_test_data(self):
+        notices = validate_project(self.project_obj.pk)
+
+        self.assertIn(['levels.txt', 'duplicate_key', ERROR, 'test_level'], [notice[:4] for notice in notices])
+        self.assertEqual(['stop_delete', 'test_stop'],
+                         sorted(notice[3] for notice in notices if notice[1] == 'unused_stop'))
+        self.assertEqual(2, len([notice for notice in notices if notice[1] == 'unused_shape']))
+        self.assertEqual(0, len([notice for notice in notices if notice[0] in ['trips.txt', 'stop_times.txt']]))
+
+    def test_service_not_found(self):
+        Trip.objects.filter(project=self.project_obj, trip_id='trip0').update(service_id='holidays')
+
+        notices = self.get_notices('service_not_found')
+
+        self.assertEqual([['trips.txt', 'service_not_found', ERROR, 'trip0']], [notice[:4] for notice in notices])
+
+    def test_reference_to_another_project(self):
+        other_project = Project.objects.get(name='Empty Project')
+        stop_obj = Stop.objects.create(project=other_project, stop_id='foreign', stop_lat=0, stop_lon=0)
+        stop_time_obj = StopTime.objects.filter(trip__project=self.project_obj, trip__trip_id='trip0').first()
+        stop_time_obj.stop = stop_obj
+        stop_time_obj.save()
+
+        notices = self.get_notices('reference_to_another_project')
+
+        self.assertEqual([['stop_times.txt', 'trip0:{0}'.format(stop_time_obj.stop_sequence)]],
+                         [notice[:1] + notice[3:4] for notice in notices])
+
+    def test_stop_times(self):
+        stop_times = list(StopTime.objects.filter(trip__project=self.project_obj, trip__trip_id='trip0').
+                          order_by('stop_sequence'))
+        for index, stop_time_obj in enumerate(stop_times):
+            stop_time_obj.arrival_time = datetime.timedelta(minutes=index * 2)
+            stop_time_obj.departure_time = datetime.timedelta(minutes=index * 2 + 1)
+        # leaves before arriving at the second stop and arrives to the third before leaving the second
+        stop_times[1].departure_time = datetime.timedelta(minutes=1)
+        stop_times[2].arrival_time = datetime.timedelta(minutes=4)
+        stop_times[2].departure_time = datetime.timedelta(minutes=5)
+        stop_times[3].arrival_time = datetime.timedelta(minutes=3)
+        for stop_time_obj in stop_times:
+            stop_time_obj.save()
+
+        self.assertEqual(['trip0:{0}'.format(stop_times[1].stop_sequence)],
+                         [notice[3] for notice in self.get_notices('departure_before_arrival')])
+        self.assertEqual(['trip0:{0}'.format(stop_times[3].stop_sequence)],
+                         [notice[3] for notice in self.get_notices('decreasing_time')])
+
+    def test_stop_sequence_not_increasing(self):
+        stop_time_obj = StopTime.objects.filter(trip__project=self.project_obj, trip__trip_id='trip0').first()
+        stop_time_obj.stop_sequence = -1
+        stop_time_obj.save()
+
+        notices = self.get_notices('stop_sequence_not_increasing')
+
+        self.assertEqual(['trip0:-1'], [notice[3] for notice in notices])
+
+    def test_calendars(self):
+        Calendar.objects.filter(project=self.project_obj, service_id='sat-sun').update(
+            saturday=False, sunday=False)
+        Calendar.objects.filter(project=self.project_obj, service_id='mon-fri').update(
+            start_date=datetime.date(2021, 1, 1))
+
+        self.assertEqual([['calendar.txt', 'service_never_active', WARNING, 'sat-sun']],
+                         [notice[:4] for notice in self.get_notices('service_never_active')])
+        self.assertEqual([['calendar.txt', 'start_and_end_date_out_of_order', ERROR, 'mon-fri']],
+                         [notice[:4] for notice in self.get_notices('start_and_end_date_out_of_order')])
+
+    def test_other_projects_are_not_checked(self):
+        empty_project = Project.objects.get(name='Empty Project')
+
+        self.assertEqual([], validate_project(empty_project.pk))
+
+
+class ValidationNoticeAPITest(BaseTestCase):
+
+    def setUp(self):
+        self.project_obj = self.create_data()[0]
+        self.project_obj.gtfs_validation_run = 2
+        self.project_obj.save()
+        notices = [('stops.txt', 'unused_stop', 'WARNING', 'stop_{0}'.format(i)) for i in range(15)] + \
+                  [('levels.txt', 'duplicate_key', 'ERROR', 'test_level')]
+        for filename, code, level, entity_id in notices:
+            ValidationNotice.objects.create(project=self.project_obj, run=2, filename=filename, code=code, level=level,
+                                            entity_id=entity_id)
+        # notices of a run that is not finished yet
+        ValidationNotice.objects.create(project=self.project_obj, run=3, filename='trips.txt', code='a', level='ERROR')
+        self.url = reverse('project-validationnotices-list', kwargs=dict(project_pk=self.project_obj.pk))
+
+    def test_list(self):
+        response = APIClient().get(self.url)
+
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        self.assertEqual(16, response.data['pagination']['total'])
+        self.assertEqual(10, len(response.data['results']))
+        self.assertEqual('stop_0', response.data['results'][0]['entity_id'])
+
+    def test_list_filtered(self):
+        response = APIClient().get(self.url, dict(level='ERROR'))
+
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        self.assertEqual(['test_level'], [notice['entity_id'] for notice in response.data['results']])
+
+    def test_summary(self):
+        url = reverse('project-validationnotices-summary', kwargs=dict(project_pk=self.project_obj.pk))
+
+        response = APIClient().get(url)
+
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        self.assertEqual([dict(filename='levels.txt', code='duplicate_key', level='ERROR', count=1),
+                          dict(filename='stops.txt', code='unused_stop', level='WARNING', count=15)], response.data)
+
+    def test_project_does_not_exist(self):
+        url = reverse('project-validationnotices-list', kwargs=dict(project_pk=-1))
+
+        response = APIClient().get(url)
+
+        self.assertEqual(status.HTTP_404_NOT_FOUND, response.status_code)
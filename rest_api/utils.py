@@ -1,3 +1,9 @@
+import hashlib
+import os
+import tempfile
+import threading
+import time
+
 from gtfseditor import settings
 
 DAYS = ['monday',
@@ -14,11 +20,286 @@ def log(*args, **kwargs):
         print(*args, **kwargs)
 
 
-def create_foreign_key_hashmap(chunk, model, project_pk, csv_key, model_key):
-    ids = set(map(lambda entry: entry[csv_key], filter(lambda entry: csv_key in entry, chunk)))
-    mapping = dict()
-    for row in model.objects.filter_by_project(project_pk).filter(**{model_key + '__in': ids}).values_list(model_key,
-                                                                                                           'id'):
-        mapping[row[0]] = row[1]
+def get_file_hash(file_path, chunk_size=1024 * 1024):
+    content_hash = hashlib.sha256()
+    with open(file_path, 'rb') as file_obj:
+        for chunk in iter(lambda: file_obj.read(chunk_size), b''):
+            content_hash.update(chunk)
+    return content_hash.hexdigest()
+
+
+def stage_uploaded_file(uploaded_file, suffix='.zip'):
+    """Writes an uploaded file chunk by chunk in the staging directory, so workers can read it from disk.
+    Returns the path of the staged file and the sha256 hash of its content"""
+    os.makedirs(settings.GTFS_STAGING_ROOT, exist_ok=True)
+    content_hash = hashlib.sha256()
+    file_descriptor, file_path = tempfile.mkstemp(suffix=suffix, dir=settings.GTFS_STAGING_ROOT)
+    try:
+        with os.fdopen(file_descriptor, 'wb') as staged_file:
+            for chunk in uploaded_file.chunks():
+                content_hash.update(chunk)
+                staged_file.write(chunk)
+    except Exception:
+        os.remove(file_path)
+        raise
+    return file_path, content_hash.hexdigest()
+
+
+def remove_staged_file(file_path):
+    """ removes a file created by stage_uploaded_file, files outside the staging directory are never touched """
+    staging_root = os.path.join(os.path.abspath(settings.GTFS_STAGING_ROOT), '')
+    if os.path.abspath(file_path).startswith(staging_root):
+        try:
+            os.remove(file_path)
+        except FileNotFoundError:
+            pass
+
+
+def get_dependent_models(models):
+    """ set with models and every model that references them, directly or through other models """
+    dependent_models = set(models)
+    pending = list(models)
+    while pending:
+        for relation in pending.pop()._meta.related_objects:
+            if relation.related_model not in dependent_models:
+                dependent_models.add(relation.related_model)
+                pending.append(relation.related_model)
+    return dependent_models
+
+
+class ImportSession:
+    """Natural id -> primary key maps of a project shared by every uploader of an import.
+    Each map is loaded with one query the first time it is needed and then kept up to date with the rows
+    inserted or deleted by the uploaders, so chunks and files resolve their foreign keys without querying again."""
+
+    def __init__(self, project_pk):
+        self.project_pk = project_pk
+        self.maps = dict()
+        # number of queries issued to fill the maps
+        self.queries = 0
+        # number of lookups answered by an already loaded map, each one was a query before
+        self.queries_avoided = 0
+        # number of ids resolved (hits) or not found (misses) in the maps
+        self.hits = 0
+        self.misses = 0
+
+    def get_map(self, model, model_key):
+        key = (model, model_key)
+        if key in self.maps:
+            self.queries_avoided += 1
+        else:
+            self.queries += 1
+            self.maps[key] = dict(model.objects.filter_by_project(self.project_pk).values_list(model_key, 'id'))
+        return self.maps[key]
+
+    def get_submap(self, model, model_key, ids):
+        id_map = self.get_map(model, model_key)
+        mapping = dict()
+        ids = [natural_id for natural_id in ids if natural_id is not None]
+        for natural_id in ids:
+            if natural_id in id_map:
+                mapping[natural_id] = id_map[natural_id]
+        self.hits += len(mapping)
+        self.misses += len(ids) - len(mapping)
+        return mapping
+
+    def add(self, model, objs):
+        """ registers objects that were inserted in the maps of their model that are already loaded """
+        for (map_model, model_key), id_map in self.maps.items():
+            if map_model is model:
+                for obj in objs:
+                    id_map[getattr(obj, model_key)] = obj.pk
+
+    def retain(self, model, model_key, natural_ids):
+        """ removes from the maps of model the rows whose natural id is not in natural_ids (they were deleted) """
+        key = (model, model_key)
+        if key in self.maps:
+            self.maps[key] = {k: v for k, v in self.maps[key].items() if k in natural_ids}
+        self.invalidate(model, keep=key)
+
+    def invalidate(self, model, keep=None):
+        """ drops the maps of model and of every model whose rows could have been deleted in cascade """
+        models = get_dependent_models([model])
+        for key in list(self.maps):
+            if key[0] in models and key != keep:
+                del self.maps[key]
+
+    def stats(self):
+        return dict(queries=self.queries, queries_avoided=self.queries_avoided, hits=self.hits, misses=self.misses)
+
+
+class ImportProgress:
+    """Rows and bytes processed of each file of an import, files can be loaded at the same time from several threads.
+    callback receives the state (see get_state) when a file starts or finishes and, while it is loaded, at most once
+    every interval seconds, so it can be stored somewhere else (the meta of the running job) without slowing down the
+    import"""
+
+    PHASE_LOADING = 'loading'
+    PHASE_PUBLISHING = 'publishing'
+
+    STATUS_LOADING = 'loading'
+    STATUS_FINISHED = 'finished'
+
+    def __init__(self, callback=None, interval=1.0):
+        self.callback = callback
+        self.interval = interval
+        self.phase = self.PHASE_LOADING
+        self.files = dict()
+        self.lock = threading.Lock()
+        self.last_notification = 0
+
+    def start(self, filename, total_bytes):
+        with self.lock:
+            self.files[filename] = dict(status=self.STATUS_LOADING, rows=0, bytes_read=0, total_bytes=total_bytes,
+                                        start_time=time.time(), end_time=None)
+            self.notify(force=True)
+
+    def update(self, filename, rows, bytes_read):
+        """ rows and bytes_read are the totals processed so far, not the ones since the previous update """
+        with self.lock:
+            self.files[filename].update(rows=rows, bytes_read=bytes_read)
+            self.notify()
+
+    def reporter(self, filename, file_obj):
+        """ function that receives the rows processed of filename, bytes are taken from the position of file_obj """
+        return lambda rows: self.update(filename, rows, file_obj.tell())
+
+    def finish(self, filename):
+        with self.lock:
+            file_progress = self.files[filename]
+            file_progress.update(status=self.STATUS_FINISHED, bytes_read=file_progress['total_bytes'],
+                                 end_time=time.time())
+            self.notify(force=True)
+
+    def set_phase(self, phase):
+        with self.lock:
+            self.phase = phase
+            self.notify(force=True)
+
+    def get_state(self):
+        now = time.time()
+        files = dict()
+        for filename, file_progress in self.files.items():
+            elapsed_time = (file_progress['end_time'] or now) - file_progress['start_time']
+            rows_per_second = file_progress['rows'] / elapsed_time if elapsed_time > 0 else None
+            eta = None
+            if file_progress['status'] == self.STATUS_FINISHED:
+                eta = 0
+            elif file_progress['bytes_read'] > 0:
+                # rows are not known in advance, the remaining time is estimated with the bytes left
+                eta = (file_progress['total_bytes'] - file_progress['bytes_read']) * elapsed_time / \
+                    file_progress['bytes_read']
+            files[filename] = dict(status=file_progress['status'], rows=file_progress['rows'],
+                                   bytes_read=file_progress['bytes_read'], total_bytes=file_progress['total_bytes'],
+                                   rows_per_second=rows_per_second, eta=eta, elapsed_time=elapsed_time)
+        return dict(phase=self.phase, files=files,
+                    current_files=sorted(filename for filename, file_progress in self.files.items()
+                                         if file_progress['status'] == self.STATUS_LOADING))
+
+    def notify(self, force=False):
+        now = time.time()
+        if self.callback is not None and (force or now - self.last_notification >= self.interval):
+            self.last_notification = now
+            self.callback(self.get_state())
+
+
+def create_foreign_key_hashmap(ids, model, project_pk, model_key, session=None):
+    if session is not None:
+        mapping = session.get_submap(model, model_key, ids)
+    else:
+        mapping = dict()
+        for row in model.objects.filter_by_project(project_pk).filter(**{model_key + '__in': ids}).values_list(
+                model_key, 'id'):
+            mapping[row[0]] = row[1]
     mapping[None] = None
     return mapping
+
+
+def get_model_field(model, name):
+    """ concrete field of model whose name or attname (column without _id for foreign keys) is name """
+    for field in model._meta.concrete_fields:
+        if name in [field.name, field.attname]:
+            return field
+    raise ValueError('{0} does not have a field named "{1}"'.format(model.__name__, name))
+
+
+class RowTransformer:
+    """Converts rows read with csv.reader into tuples with the value of every concrete field of the model, in the
+    order expected by Model(*values). It is compiled once per file from the CSV header and the Meta class of the
+    viewset (see CSVUploadMixin): columns that are not in csv_header are left out, '' becomes None,
+    upload_preprocess functions are applied, foreign keys are translated and rename_fields is honored.
+    Foreign key maps change with each chunk, they are given with set_foreign_key_map."""
+
+    def __init__(self, meta, header, project_pk):
+        self.model = meta.model
+        self.width = len(header)
+        preprocess_funcs = getattr(meta, 'upload_preprocess', dict())
+        rename_fields = getattr(meta, 'rename_fields', dict())
+        columns = {column: index for index, column in enumerate(header) if column in meta.csv_header}
+
+        getters = dict()
+        # csv_key -> (column index, model, model_key, current map)
+        self.foreign_keys = dict()
+        for fk in getattr(meta, 'foreign_key_mappings', []):
+            if fk['csv_key'] not in columns:
+                continue
+            index = columns.pop(fk['csv_key'])
+            field = get_model_field(self.model, fk.get('internal_key', fk['model_key']))
+            id_map = dict()
+            self.foreign_keys[fk['csv_key']] = (index, fk['model'], fk['model_key'], id_map)
+            getters[field.attname] = self.compile_foreign_key(index, id_map)
+        for column, index in columns.items():
+            field = get_model_field(self.model, rename_fields.get(column, column))
+            getters[field.attname] = self.compile_column(index, preprocess_funcs.get(column))
+        if getattr(meta, 'include_project_id', True):
+            getters['project_id'] = self.compile_constant(project_pk)
+
+        fields = self.model._meta.concrete_fields
+        self.getters = [getters[field.attname] if field.attname in getters else self.compile_default(field)
+                        for field in fields]
+        self.pk_index = fields.index(self.model._meta.pk)
+        self.natural_id_index = None
+        if getattr(meta, 'use_internal_id', True):
+            natural_field = get_model_field(self.model, self.model.objects.get_internal_id_name())
+            self.natural_id_index = fields.index(natural_field)
+
+    @staticmethod
+    def compile_column(index, preprocess_func=None):
+        if preprocess_func is None:
+            return lambda row: row[index] or None
+        return lambda row: preprocess_func(row[index]) if row[index] else None
+
+    @staticmethod
+    def compile_foreign_key(index, id_map):
+        # an unknown id raises KeyError, as an invalid foreign key
+        return lambda row: id_map[row[index] or None]
+
+    @staticmethod
+    def compile_constant(value):
+        return lambda row: value
+
+    def compile_default(self, field):
+        if field is self.model._meta.pk:
+            return self.compile_constant(None)
+        if callable(field.default):
+            return lambda row: field.get_default()
+        return self.compile_constant(field.get_default())
+
+    def get_ids(self, chunk, csv_key):
+        """ natural ids referenced by column csv_key in chunk """
+        index = self.foreign_keys[csv_key][0]
+        return set(row[index] or None for row in chunk)
+
+    def set_foreign_key_map(self, csv_key, mapping):
+        id_map = self.foreign_keys[csv_key][3]
+        id_map.clear()
+        id_map.update(mapping)
+
+    def transform(self, row):
+        if len(row) < self.width:
+            # missing trailing values are empty, as csv.DictReader does
+            row = row + [''] * (self.width - len(row))
+        return tuple([getter(row) for getter in self.getters])
+
+    def with_pk(self, values, pk):
+        return values[:self.pk_index] + (pk,) + values[self.pk_index + 1:]
@@ -0,0 +1,142 @@
+from django.db import connection
+from psycopg2 import sql
+
+from rest_api.models import Agency, Stop, Route, Trip, StopTime, Calendar, CalendarDate, Shape, FareAttribute, \
+    FareRule, Level, Pathway
+
+ERROR = 'ERROR'
+WARNING = 'WARNING'
+
+# names used by the queries of the checks
+TABLES = dict(agency=Agency, stop=Stop, route=Route, trip=Trip, stop_time=StopTime, calendar=Calendar,
+              calendar_date=CalendarDate, shape=Shape, fare_attribute=FareAttribute, fare_rule=FareRule, level=Level,
+              pathway=Pathway)
+
+# stop times are identified by trip and stop sequence
+STOP_TIME_ID = "tr.trip_id || ':' || st.stop_sequence"
+
+
+class Check:
+    """Rule of the GTFS reference checked with one query on the tables of a project. The query selects the id of
+    each entity that breaks the rule, it receives the project as %(project_pk)s and names tables as {trip},
+    {stop_time}, ... (see TABLES)"""
+
+    def __init__(self, filename, code, level, title, description, query):
+        self.filename = filename
+        self.code = code
+        self.level = level
+        self.title = title
+        self.description = description
+        self.query = query
+
+    def get_entity_ids(self, cursor, project_pk):
+        tables = {name: sql.Identifier(model._meta.db_table) for name, model in TABLES.items()}
+        cursor.execute(sql.SQL(self.query.replace('{STOP_TIME_ID}', STOP_TIME_ID)).format(**tables),
+                       dict(project_pk=project_pk))
+        return [row[0] for row in cursor.fetchall()]
+
+
+CHECKS = [
+    # references. Foreign keys are checked by the database, but not that they stay in the project
+    Check('trips.txt', 'service_not_found', ERROR, 'Service not found',
+          'service_id of the trip is not in calendar.txt nor in calendar_dates.txt', '''
+          SELECT t.trip_id FROM {trip} t
+          WHERE t.project_id = %(project_pk)s
+            AND NOT EXISTS (SELECT 1 FROM {calendar} c
+                            WHERE c.project_id = t.project_id AND c.service_id = t.service_id)
+            AND NOT EXISTS (SELECT 1 FROM {calendar_date} d
+                            WHERE d.project_id = t.project_id AND d.service_id = t.service_id)'''),
+    Check('trips.txt', 'reference_to_another_project', ERROR, 'Reference to another project',
+          'route or shape of the trip belongs to another project', '''
+          SELECT t.trip_id FROM {trip} t
+          JOIN {route} r ON r.id = t.route_id
+          JOIN {agency} a ON a.id = r.agency_id
+          LEFT JOIN {shape} s ON s.id = t.shape_id
+          WHERE t.project_id = %(project_pk)s AND (a.project_id <> t.project_id OR s.project_id <> t.project_id)'''),
+    Check('stop_times.txt', 'reference_to_another_project', ERROR, 'Reference to another project',
+          'stop of the stop time belongs to another project', '''
+          SELECT {STOP_TIME_ID} FROM {stop_time} st
+          JOIN {trip} tr ON tr.id = st.trip_id
+          JOIN {stop} s ON s.id = st.stop_id
+          WHERE tr.project_id = %(project_pk)s AND s.project_id <> tr.project_id'''),
+    Check('stops.txt', 'wrong_parent_station', ERROR, 'Wrong parent station',
+          'parent_station of the stop is not a station (location_type 1) of the project', '''
+          SELECT s.stop_id FROM {stop} s
+          JOIN {stop} p ON p.id = s.parent_station_id
+          WHERE s.project_id = %(project_pk)s
+            AND (p.project_id <> s.project_id OR p.location_type IS DISTINCT FROM 1)'''),
+    Check('fare_rules.txt', 'zone_not_found', ERROR, 'Zone not found',
+          'origin_id, destination_id or contains_id of the fare rule is not the zone_id of a stop', '''
+          SELECT fa.fare_id FROM {fare_rule} fr
+          JOIN {fare_attribute} fa ON fa.id = fr.fare_attribute_id
+          WHERE fa.project_id = %(project_pk)s
+            AND EXISTS (SELECT 1 FROM unnest(ARRAY[fr.origin_id, fr.destination_id, fr.contains_id]) AS z (zone_id)
+                        WHERE z.zone_id <> ''
+                          AND NOT EXISTS (SELECT 1 FROM {stop} s
+                                          WHERE s.project_id = fa.project_id AND s.zone_id = z.zone_id))'''),
+    # stop times
+    Check('stop_times.txt', 'stop_sequence_not_increasing', ERROR, 'Stop sequence not increasing',
+          'stop_sequence is negative or repeated in the trip', '''
+          SELECT entity_id FROM (
+            SELECT {STOP_TIME_ID} AS entity_id, st.stop_sequence,
+                   lag(st.stop_sequence) OVER (PARTITION BY st.trip_id ORDER BY st.stop_sequence, st.id) AS previous
+            FROM {stop_time} st JOIN {trip} tr ON tr.id = st.trip_id
+            WHERE tr.project_id = %(project_pk)s) AS s
+          WHERE stop_sequence < 0 OR stop_sequence <= previous'''),
+    Check('stop_times.txt', 'departure_before_arrival', ERROR, 'Departure before arrival',
+          'departure_time of the stop time is before its arrival_time', '''
+          SELECT {STOP_TIME_ID} FROM {stop_time} st JOIN {trip} tr ON tr.id = st.trip_id
+          WHERE tr.project_id = %(project_pk)s AND st.departure_time < st.arrival_time'''),
+    Check('stop_times.txt', 'decreasing_time', ERROR, 'Decreasing time',
+          'arrival_time of the stop time is before the departure from a previous stop of the trip', '''
+          SELECT entity_id FROM (
+            SELECT {STOP_TIME_ID} AS entity_id, COALESCE(st.arrival_time, st.departure_time) AS time,
+                   max(COALESCE(st.departure_time, st.arrival_time)) OVER (
+                       PARTITION BY st.trip_id ORDER BY st.stop_sequence
+                       ROWS BETWEEN UNBOUNDED PRECEDING AND 1 PRECEDING) AS previous_time
+            FROM {stop_time} st JOIN {trip} tr ON tr.id = st.trip_id
+            WHERE tr.project_id = %(project_pk)s) AS s
+          WHERE time < previous_time'''),
+    # natural keys that are not unique in the database
+    Check('routes.txt', 'duplicate_key', ERROR, 'Duplicate key', 'route_id is used by more than one route', '''
+          SELECT r.route_id FROM {route} r JOIN {agency} a ON a.id = r.agency_id
+          WHERE a.project_id = %(project_pk)s GROUP BY r.route_id HAVING count(*) > 1'''),
+    Check('levels.txt', 'duplicate_key', ERROR, 'Duplicate key', 'level_id is used by more than one level', '''
+          SELECT l.level_id FROM {level} l
+          WHERE l.project_id = %(project_pk)s GROUP BY l.level_id HAVING count(*) > 1'''),
+    Check('pathways.txt', 'duplicate_key', ERROR, 'Duplicate key', 'pathway_id is used by more than one pathway', '''
+          SELECT p.pathway_id FROM {pathway} p JOIN {stop} s ON s.id = p.from_stop_id
+          WHERE s.project_id = %(project_pk)s GROUP BY p.pathway_id HAVING count(*) > 1'''),
+    # services
+    Check('calendar.txt', 'start_and_end_date_out_of_order', ERROR, 'Start and end date out of order',
+          'start_date of the service is after its end_date', '''
+          SELECT c.service_id FROM {calendar} c WHERE c.project_id = %(project_pk)s AND c.start_date > c.end_date'''),
+    Check('calendar.txt', 'service_never_active', WARNING, 'Service never active',
+          'the service does not run on any day of the week and has no added dates in calendar_dates.txt', '''
+          SELECT c.service_id FROM {calendar} c
+          WHERE c.project_id = %(project_pk)s
+            AND NOT (c.monday OR c.tuesday OR c.wednesday OR c.thursday OR c.friday OR c.saturday OR c.sunday)
+            AND NOT EXISTS (SELECT 1 FROM {calendar_date} d
+                            WHERE d.project_id = c.project_id AND d.service_id = c.service_id
+                              AND d.exception_type = 1)'''),
+    # unused entities
+    Check('stops.txt', 'unused_stop', WARNING, 'Unused stop', 'the stop is not used by any stop time', '''
+          SELECT s.stop_id FROM {stop} s
+          WHERE s.project_id = %(project_pk)s AND COALESCE(s.location_type, 0) = 0
+            AND NOT EXISTS (SELECT 1 FROM {stop_time} st WHERE st.stop_id = s.id)'''),
+    Check('shapes.txt', 'unused_shape', WARNING, 'Unused shape', 'the shape is not used by any trip', '''
+          SELECT s.shape_id FROM {shape} s
+          WHERE s.project_id = %(project_pk)s AND NOT EXISTS (SELECT 1 FROM {trip} t WHERE t.shape_id = s.id)'''),
+]
+
+
+def validate_project(project_pk, checks=None):
+    """Runs checks (by default CHECKS) on the tables of the project, one set based query each, without building the
+    GTFS file. Returns the notices as lists [filename, code, level, entity id, title, description], the same columns
+    reported by the GTFS validator"""
+    notices = list()
+    with connection.cursor() as cursor:
+        for check in CHECKS if checks is None else checks:
+            for entity_id in check.get_entity_ids(cursor, project_pk):
+                notices.append([check.filename, check.code, check.level, entity_id, check.title, check.description])
+    return notices
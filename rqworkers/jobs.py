@@ -1,36 +1,65 @@
-import csv
 import glob
+import itertools
 import json
 import logging
 import os
+import re
 import shutil
 import subprocess
+import tempfile
 import zipfile
-from io import StringIO
+from contextlib import closing
 from time import sleep
 
 from django.conf import settings
 from django.core.exceptions import FieldDoesNotExist
-from django.core.files.base import ContentFile
 from django.core.management import call_command
 from django.db import transaction, IntegrityError
+from django.db.models import Max
 from django.utils import timezone
 from django_rq import job
 from rest_framework.exceptions import ParseError, ValidationError
+from rq import get_current_job
 
-from rest_api.models import Project
+from rest_api.bulkload import StagedImport
+from rest_api.models import Project, TableVersion, Extract, ValidationNotice
+from rest_api.utils import ImportSession, ImportProgress, get_file_hash, remove_staged_file
+from rest_api.validation import validate_project, ERROR, WARNING
+from rqworkers.validator import validate_with_server, get_validator_arguments, get_output_path, ValidatorUnavailable
+from rqworkers.workspace import workspace
 
 logger = logging.getLogger(__name__)
 
 
-@job(settings.GTFSEDITOR_QUEUE_NAME, timeout=60 * 60 * 12)
-def upload_gtfs_file(project_pk, zip_file):
+# files are loaded one after another with the upload logic of each viewset
+IMPORT_MODE_UPLOADERS = 'uploaders'
+# independent files are loaded at the same time in staging tables and published together at the end
+IMPORT_MODE_STAGED = 'staged'
+# as staged, but only rows that are new, changed or not present anymore are written
+IMPORT_MODE_DIFF = 'diff'
+# as staged, but shape points and stop times are written without indexes, which are built once at the end. Both
+# tables stay locked for every project until the import finishes, it pays off on first loads of large feeds
+IMPORT_MODE_BULK = 'bulk'
+
+# notices of a validation are inserted in batches of this size
+NOTICE_BATCH_SIZE = 5000
+# fields of Project filled by validate_gtfs with the number of errors and warnings
+VALIDATION_COUNTERS = [field.name for field in Project._meta.fields
+                       if field.name.endswith('_error_number') or field.name.endswith('_warning_number')]
+# whitespace between the tokens of a JSON document
+JSON_WHITESPACE = re.compile(r'\s*')
+
+MANDATORY_FILES = ['agency.txt', 'stops.txt', 'routes.txt', 'trips.txt', 'stop_times.txt', 'calendar.txt',
+                   'shapes.txt', 'feed_info.txt']
+
+
+def get_uploaders():
     # to avoid circular references
     from rest_api.views import AgencyViewSet, StopViewSet, RouteViewSet, TripViewSet, CalendarViewSet, \
         CalendarDateViewSet, \
         FareRuleViewSet, FareAttributeViewSet, FrequencyViewSet, TransferViewSet, PathwayViewSet, LevelViewSet, \
         FeedInfoViewSet, ShapeViewSet, StopTimeViewSet
-    uploaders = {
+    return {
         'agency.txt': AgencyViewSet,
         'stops.txt': StopViewSet,
         'routes.txt': RouteViewSet,
@@ -47,30 +76,91 @@ def upload_gtfs_file(project_pk, zip_file):
         'shapes.txt': ShapeViewSet,
         'stop_times.txt': StopTimeViewSet,
     }
+
+
+def update_project_after_upload(project_pk):
+    project_obj = Project.objects.get(pk=project_pk)
+    project_obj.last_modification = timezone.now()
+    project_obj.envelope = project_obj.get_envelope()
+    project_obj.save()
+    # every table of the project could have changed
+    TableVersion.objects.bump(project_pk, [relation.related_model for relation in Project._meta.related_objects
+                                           if relation.related_model not in [TableVersion, Extract, ValidationNotice]])
+
+
+def get_import_progress():
+    """ progress of the import that is written in the meta of the running job, if there is one, as "progress" """
+    current_job = get_current_job()
+    if current_job is None:
+        return ImportProgress()
+
+    def save_progress(state):
+        current_job.meta['progress'] = state
+        current_job.save_meta()
+
+    return ImportProgress(save_progress, interval=settings.GTFS_IMPORT_PROGRESS_INTERVAL)
+
+
+def load_with_uploaders(project_pk, zip_file_obj, progress):
+    uploaders = get_uploaders()
+    # natural id maps are shared by every file of the import
+    session = ImportSession(project_pk)
+    with transaction.atomic():
+        # file order matters
+        for uploader_filename in ['agency.txt', 'stops.txt', 'routes.txt', 'shapes.txt', 'trips.txt',
+                                  'stop_times.txt', 'calendar.txt', 'calendar_dates.txt', 'fare_rules.txt',
+                                  'fare_attributes.txt', 'frequencies.txt', 'transfers.txt', 'pathways.txt',
+                                  'levels.txt', 'feed_info.txt']:
+            uploader = uploaders[uploader_filename]
+            try:
+                with zip_file_obj.open(uploader_filename, 'r') as file_obj:
+                    progress.start(uploader_filename, zip_file_obj.getinfo(uploader_filename).file_size)
+                    uploader()._perform_upload(file_obj, project_pk, session,
+                                               progress.reporter(uploader_filename, file_obj))
+                    progress.finish(uploader_filename)
+            except KeyError:
+                if uploader_filename in MANDATORY_FILES:
+                    logger.error('file "{0}" is mandatory'.format(uploader_filename))
+                    raise ValidationError('{0} file is mandatory'.format(uploader_filename))
+                else:
+                    logger.info('file "{0}" does not exist in zip file'.format(uploader_filename))
+        update_project_after_upload(project_pk)
+    logger.info('foreign key resolution: {0}'.format(session.stats()))
+
+
+def load_with_staging_tables(project_pk, zip_file_obj, progress, workers, diff=False, defer_indexes=False):
+    with StagedImport(project_pk, get_uploaders(), zip_file_obj, MANDATORY_FILES, workers, diff,
+                      defer_indexes, progress) as staged_import:
+        staged_import.stage()
+        staged_import.swap(after_publish=lambda: update_project_after_upload(project_pk))
+        report = staged_import.get_report()
+    for filename in sorted(report['tables'], key=lambda name: report['tables'][name]['staging_start']):
+        logger.info('{0}: {1}'.format(filename, report['tables'][filename]))
+    logger.info('staging: {0:.2f}s, publish: {1:.2f}s, critical path: {2}'.format(
+        report['staging_duration'], report['publish_duration'], ' -> '.join(report['critical_path'])))
+    return report
+
+
+@job(settings.GTFSEDITOR_QUEUE_NAME, timeout=60 * 60 * 12)
+def upload_gtfs_file(project_pk, zip_file, mode=None, workers=None):
+    """zip_file can be the path of the zip file or a binary file object, it is never loaded in memory.
+    mode is IMPORT_MODE_STAGED, IMPORT_MODE_DIFF, IMPORT_MODE_BULK or IMPORT_MODE_UPLOADERS, by default
+    settings.GTFS_IMPORT_MODE is used. In staged, diff and bulk modes, it returns the time spent and the rows added,
+    changed and removed in each table.
+    Rows, bytes, speed and remaining time of each file are written in the meta of the job while it runs"""
+    mode = mode or settings.GTFS_IMPORT_MODE
+    if mode not in [IMPORT_MODE_UPLOADERS, IMPORT_MODE_STAGED, IMPORT_MODE_DIFF, IMPORT_MODE_BULK]:
+        raise ValueError('import mode "{0}" does not exist'.format(mode))
     try:
-        with zipfile.ZipFile(ContentFile(zip_file), 'r') as zip_file_obj:
+        with zipfile.ZipFile(zip_file, 'r') as zip_file_obj:
             try:
-                with transaction.atomic():
-                    # file order matters
-                    for uploader_filename in ['agency.txt', 'stops.txt', 'routes.txt', 'shapes.txt', 'trips.txt',
-                                              'stop_times.txt', 'calendar.txt', 'calendar_dates.txt', 'fare_rules.txt',
-                                              'fare_attributes.txt', 'frequencies.txt', 'transfers.txt', 'pathways.txt',
-                                              'levels.txt', 'feed_info.txt']:
-                        uploader = uploaders[uploader_filename]
-                        try:
-                            with zip_file_obj.open(uploader_filename, 'r') as file_obj:
-                                uploader()._perform_upload(file_obj, project_pk)
-                        except KeyError:
-                            if uploader_filename in ['agency.txt', 'stops.txt', 'routes.txt', 'trips.txt',
-                                                     'stop_times.txt', 'calendar.txt', 'shapes.txt', 'feed_info.txt']:
-                                logger.error('file "{0}" is mandatory'.format(uploader_filename))
-                                raise ValidationError('{0} file is mandatory'.format(uploader_filename))
-                            else:
-                                logger.info('file "{0}" does not exist in zip file'.format(uploader_filename))
-                    project_obj = Project.objects.get(pk=project_pk)
-                    project_obj.last_modification = timezone.now()
-                    project_obj.envelope = project_obj.get_envelope()
-                    project_obj.save()
+                progress = get_import_progress()
+                if mode in [IMPORT_MODE_STAGED, IMPORT_MODE_DIFF, IMPORT_MODE_BULK]:
+                    return load_with_staging_tables(project_pk, zip_file_obj, progress,
+                                                    workers or settings.GTFS_IMPORT_WORKERS,
+                                                    diff=mode == IMPORT_MODE_DIFF,
+                                                    defer_indexes=mode == IMPORT_MODE_BULK)
+                load_with_uploaders(project_pk, zip_file_obj, progress)
             except IntegrityError as e:
                 logger.error('error while zip file was loading: {0}'.format(e))
                 transaction.rollback()
@@ -80,49 +170,167 @@ def upload_gtfs_file(project_pk, zip_file):
 
 
 @job(settings.GTFSEDITOR_QUEUE_NAME, timeout=60 * 60 * 12)
-def upload_gtfs_file_when_project_is_created(project_pk, zip_file):
+def upload_gtfs_file_when_project_is_created(project_pk, zip_path, zip_hash=None, mode=None):
+    """zip_path is a file staged by the web server, it is removed when the job finishes.
+    mode is passed to upload_gtfs_file, its report is the result of the job"""
+    report = None
     try:
         # wait for job id
         sleep(2)
         if Project.objects.filter(pk=project_pk, loading_gtfs_job_id__isnull=True).exists():
             raise ValueError('job id was not assigned')
+        if zip_hash is not None and get_file_hash(zip_path) != zip_hash:
+            raise ValueError('staged GTFS file is corrupted')
 
-        upload_gtfs_file(project_pk, zip_file)
+        report = upload_gtfs_file(project_pk, zip_path, mode=mode)
         Project.objects.filter(pk=project_pk).update(creation_status=Project.CREATION_STATUS_FROM_GTFS,
                                                      last_modification=timezone.now())
     except Exception as e:
         Project.objects.filter(pk=project_pk).update(loading_gtfs_error_message=str(e),
                                                      creation_status=Project.CREATION_STATUS_ERROR_LOADING_GTFS)
+    finally:
+        remove_staged_file(zip_path)
 
+    return report
 
-def validate_gtfs(project_obj):
-    """ run validation tools for a GTFS """
-    start_time = timezone.now()
 
-    try:
+class JSONReader:
+    """ decodes one by one the values of a JSON document read in chunks from file_obj """
+
+    def __init__(self, file_obj, chunk_size):
+        self.file_obj = file_obj
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+        self.buffer = ''
+        self.position = 0
+        self.finished = False
+
+    def read(self):
+        """ appends the next chunk to the buffer, dropping what was already decoded. False at the end of the file """
+        chunk = self.file_obj.read(self.chunk_size)
+        self.buffer = self.buffer[self.position:] + chunk
+        self.position = 0
+        self.finished = not chunk
+        return not self.finished
+
+    def peek(self):
+        """ next character that is not whitespace, '' at the end of the file """
+        while True:
+            self.position = JSON_WHITESPACE.match(self.buffer, self.position).end()
+            if self.position < len(self.buffer) or not self.read():
+                return self.buffer[self.position:self.position + 1]
+
+    def expect(self, character):
+        if self.peek() != character:
+            raise ValueError('expected "{0}" at position {1} of the JSON buffer'.format(character, self.position))
+        self.position += 1
+
+    def decode(self):
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.position)
+            except ValueError:
+                # value is cut at the end of the buffer
+                if not self.read():
+                    raise
+                continue
+            # a number at the end of the buffer could go on in the next chunk
+            if end == len(self.buffer) and not self.finished and self.read():
+                continue
+            self.position = end
+            return value
+
+
+def iter_json_array(file_obj, key, chunk_size=64 * 1024):
+    """Yields one by one the items of the array stored as key in the top level JSON object of file_obj. The file is
+    read in chunks and never held whole in memory, the values of other keys are decoded and skipped"""
+    reader = JSONReader(file_obj, chunk_size)
+    reader.expect('{')
+    while reader.peek() != '}':
+        name = reader.decode()
+        reader.expect(':')
+        if name == key:
+            reader.expect('[')
+            if reader.peek() == ']':
+                return
+            while True:
+                yield reader.decode()
+                if reader.peek() == ']':
+                    return
+                reader.expect(',')
+        reader.decode()
+        if reader.peek() == ',':
+            reader.expect(',')
+
+
+def run_gtfs_validator(project_obj):
+    """Runs the GTFS validator (jar) on the GTFS file of the project and yields its notices as validate_project.
+    The validator server runs it when it is listening (see rqworkers.validator), otherwise it is called here. Every
+    run has a workspace of its own (see rqworkers.workspace), runs of the same project do not share files"""
+    if not project_obj.gtfs_file:
+        raise ValueError('GTFS file does not exist')
+
+    with workspace('validation-{0}-'.format(project_obj.pk)) as directory:
         try:
-            shutil.rmtree(os.path.join('tmp', str(project_obj.pk)))
-        except IOError:
-            pass
+            validate_with_server(project_obj.gtfs_file.path, directory)
+        except ValidatorUnavailable:
+            # call gtfs validator
+            subprocess.call(get_validator_arguments(project_obj.gtfs_file.path, get_output_path(directory)),
+                            cwd=directory)
+
+        for filepath in glob.glob(os.path.join(get_output_path(directory), '*.json')):
+            with open(filepath) as file_obj:
+                # first result is not a notice
+                for row in itertools.islice(iter_json_array(file_obj, 'results'), 1, None):
+                    yield [row['filename'], row['code'], row['level'], row['entityId'], row['title'],
+                           row['description']]
 
-        if not project_obj.gtfs_file:
-            raise ValueError('GTFS file does not exist')
 
-        arguments = ['java', '-jar', os.path.join('gtfsvalidators', 'gtfs-validator-v1.4.0_cli.jar'),
-                     '-i', project_obj.gtfs_file.path,
-                     '-o', os.path.join('tmp', str(project_obj.pk)),
-                     '--abort_on_error', 'false']
-        # call gtfs validator
-        subprocess.call(arguments)
+def get_validation_notices(project_obj):
+    """ notices of the validators of GTFS_VALIDATORS. The native checks (see rest_api.validation) run first on the
+    tables of the project, the GTFS validator only runs on the GTFS file when they did not find errors """
+    notices = []
+    if 'native' in settings.GTFS_VALIDATORS:
+        notices = validate_project(project_obj.pk)
+        yield from notices
+    if 'jar' in settings.GTFS_VALIDATORS and not any(notice[2] == ERROR for notice in notices):
+        yield from run_gtfs_validator(project_obj)
 
+
+def get_cached_validation(project_obj):
+    """ result of the last validation of the project when it validated the same content with the same validators """
+    cache = project_obj.gtfs_validation_cache
+    if project_obj.gtfs_file_hash is None or cache is None:
+        return None
+    if cache['hash'] != project_obj.gtfs_file_hash or cache['validators'] != list(settings.GTFS_VALIDATORS):
+        return None
+    return cache
+
+
+def validate_gtfs(project_obj):
+    """Run validation tools for a GTFS. Notices are saved as ValidationNotice rows of a new run while they are read,
+    the run replaces the previous one when the validation finishes.
+    A GTFS file with the same content hash as the last validated one is not validated again, its counters and
+    notices are kept"""
+    start_time = timezone.now()
+    cache = get_cached_validation(project_obj)
+    if cache is not None:
+        for field_name, value in cache['counters'].items():
+            setattr(project_obj, field_name, value)
+        project_obj.gtfs_validation_run = cache['run']
+        project_obj.gtfs_validation_message = None
+        project_obj.gtfs_validation_duration = timezone.now() - start_time
+        project_obj.save()
+        return
+
+    run = max(project_obj.gtfs_validation_run or 0, ValidationNotice.objects.filter_by_project(
+        project_obj.pk).aggregate(run=Max('run'))['run'] or 0) + 1
+
+    try:
         error_number = 0
         warning_number = 0
 
-        in_memory_csv = StringIO()
-        spamwriter = csv.writer(in_memory_csv, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
-        header = ['filename', 'code', 'level', 'entity id', 'title', 'description']
-        spamwriter.writerow(header)
-
         project_obj.agency_error_number = 0
         project_obj.stops_error_number = 0
         project_obj.routes_error_number = 0
@@ -154,42 +362,48 @@ def validate_gtfs(project_obj):
         project_obj.levels_warning_number = 0
         project_obj.feed_info_warning_number = 0
 
-        for filepath in glob.glob(os.path.join('tmp', str(project_obj.pk), '*.json')):
-            with open(filepath) as file_obj:
-                json_file = json.load(file_obj)
-                for row in json_file['results'][1:]:
-                    if row['level'] == 'WARNING':
-                        warning_number += 1
-                        try:
-                            if row['filename'] is not None:
-                                field_name = '{0}_warning_number'.format(row['filename'].replace('.txt', ''))
-                                project_obj._meta.get_field(field_name)
-                                setattr(project_obj, field_name, getattr(project_obj, field_name) + 1)
-                        except FieldDoesNotExist:
-                            pass
-                    if row['level'] == 'ERROR':
-                        error_number += 1
-                        try:
-                            if row['filename'] is not None:
-                                field_name = '{0}_error_number'.format(row['filename'].replace('.txt', ''))
-                                project_obj._meta.get_field(field_name)
-                                setattr(project_obj, field_name, getattr(project_obj, field_name) + 1)
-                        except FieldDoesNotExist:
-                            pass
-
-                    spamwriter.writerow([
-                        row['filename'],
-                        row['code'],
-                        row['level'],
-                        row['entityId'],
-                        row['title'],
-                        row['description']
-                    ])
-
-        project_obj.gtfs_validation_message = in_memory_csv.getvalue()
+        batch = []
+        # the generator is closed on errors too, it removes the workspace of the validator
+        with closing(get_validation_notices(project_obj)) as notices:
+            for notice in notices:
+                filename, code, level, entity_id, title, description = notice
+                if level == WARNING:
+                    warning_number += 1
+                    try:
+                        if filename is not None:
+                            field_name = '{0}_warning_number'.format(filename.replace('.txt', ''))
+                            project_obj._meta.get_field(field_name)
+                            setattr(project_obj, field_name, getattr(project_obj, field_name) + 1)
+                    except FieldDoesNotExist:
+                        pass
+                if level == ERROR:
+                    error_number += 1
+                    try:
+                        if filename is not None:
+                            field_name = '{0}_error_number'.format(filename.replace('.txt', ''))
+                            project_obj._meta.get_field(field_name)
+                            setattr(project_obj, field_name, getattr(project_obj, field_name) + 1)
+                    except FieldDoesNotExist:
+                        pass
+
+                batch.append(ValidationNotice(project_id=project_obj.pk, run=run, filename=filename, code=code,
+                                              level=level, entity_id=entity_id, title=title, description=description))
+                if len(batch) >= NOTICE_BATCH_SIZE:
+                    ValidationNotice.objects.bulk_create(batch)
+                    batch = []
+        ValidationNotice.objects.bulk_create(batch)
+
+        project_obj.gtfs_validation_message = None
+        project_obj.gtfs_validation_run = run
         project_obj.gtfs_validation_error_number = error_number
         project_obj.gtfs_validation_warning_number = warning_number
+        project_obj.gtfs_validation_cache = None
+        if project_obj.gtfs_file_hash is not None:
+            project_obj.gtfs_validation_cache = dict(
+                hash=project_obj.gtfs_file_hash, validators=list(settings.GTFS_VALIDATORS), run=run,
+                counters={field_name: getattr(project_obj, field_name) for field_name in VALIDATION_COUNTERS})
     except Exception as e:
+        ValidationNotice.objects.filter_by_project(project_obj.pk).filter(run=run).delete()
         project_obj.gtfs_validation_message = str(e)
         logger.error(e)
         raise e
@@ -197,10 +411,7 @@ def validate_gtfs(project_obj):
         project_obj.gtfs_validation_duration = timezone.now() - start_time
         project_obj.save()
 
-        try:
-            shutil.rmtree('input')
-        except IOError:
-            pass
+    ValidationNotice.objects.filter_by_project(project_obj.pk).exclude(run=run).delete()
 
 
 @job(settings.GTFSEDITOR_QUEUE_NAME, timeout=60 * 60 * 12)
@@ -235,3 +446,40 @@ def build_and_validate_gtfs_file(project_pk):
         project_obj.save()
 
         logger.info('duration: {0}'.format(timezone.now() - start_time))
+
+
+@job(settings.GTFSEDITOR_QUEUE_NAME, timeout=60 * 60 * 12)
+def build_gtfs_extract(extract_pk):
+    # to avoid circular references
+    from rest_api.management.commands.buildgtfs import BuiltFile
+
+    start_time = timezone.now()
+    extract_obj = Extract.objects.select_related('project').get(pk=extract_pk)
+    extract_obj.status = Extract.STATUS_BUILDING
+    extract_obj.save()
+
+    options = dict(route_ids=extract_obj.route_ids, bbox=extract_obj.bbox, start_date=extract_obj.start_date,
+                   end_date=extract_obj.end_date)
+    os.makedirs(settings.GTFS_STAGING_ROOT, exist_ok=True)
+    directory = tempfile.mkdtemp(dir=settings.GTFS_STAGING_ROOT)
+    try:
+        zip_path = os.path.join(directory, 'extract.zip')
+        call_command('buildgtfs', extract_obj.project.name, output=zip_path,
+                     **{key: value for key, value in options.items() if value is not None})
+        with BuiltFile(open(zip_path, 'rb'), name=zip_path) as zip_file:
+            extract_obj.file.save('GTFS-{0}-extract-{1}.zip'.format(extract_obj.project.name, extract_obj.pk),
+                                  zip_file, save=False)
+        extract_obj.status = Extract.STATUS_FINISHED
+    except Exception as e:
+        logger.error(e)
+        extract_obj.status = Extract.STATUS_ERROR
+        extract_obj.error_message = str(e)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+        # the extract could have been deleted while it was built, it is not created again
+        Extract.objects.filter(pk=extract_pk).update(status=extract_obj.status,
+                                                     error_message=extract_obj.error_message,
+                                                     file=extract_obj.file.name or None,
+                                                     building_duration=timezone.now() - start_time)
+
+        logger.info('duration: {0}'.format(timezone.now() - start_time))
@@ -1,18 +1,33 @@
+import datetime
 import json
 import os
 import pathlib
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
 import uuid
+import zipfile
+from io import BytesIO, StringIO
 from unittest import mock
 
 from django.core.files.base import ContentFile
-from django.test import TransactionTestCase
+from django.db import connection, transaction, OperationalError
+from django.test import SimpleTestCase, TransactionTestCase, override_settings
 from rest_framework.exceptions import ParseError, ValidationError
 
+from rest_api.bulkload import UnresolvedForeignKeyError, DuplicatedRowError, DeferredIndexes, IMPORT_LOCK_ID
 from rest_api.models import Agency, Stop, Route, Trip, Calendar, CalendarDate, FareAttribute, FareRule, \
-    Frequency, Transfer, Pathway, Level, FeedInfo, ShapePoint, StopTime, Project, Shape
+    Frequency, Transfer, Pathway, Level, FeedInfo, ShapePoint, StopTime, Project, Shape, ValidationNotice
 from rest_api.tests.test_helpers import BaseTestCase
+from rest_api.utils import ImportSession, stage_uploaded_file, remove_staged_file
 from rqworkers.jobs import validate_gtfs, upload_gtfs_file, build_and_validate_gtfs_file, \
-    upload_gtfs_file_when_project_is_created
+    upload_gtfs_file_when_project_is_created, IMPORT_MODE_UPLOADERS, IMPORT_MODE_STAGED, \
+    IMPORT_MODE_DIFF, IMPORT_MODE_BULK, iter_json_array, run_gtfs_validator
+from rqworkers.validator import ValidatorServer, ValidatorError, ValidatorUnavailable, request_validator, \
+    validate_with_server
+from rqworkers.workspace import workspace
 
 
 class TestValidateGTFS(BaseTestCase):
@@ -20,6 +35,7 @@ class TestValidateGTFS(BaseTestCase):
     def setUp(self):
         self.project_obj = self.create_data()[0]
 
+    @override_settings(GTFS_VALIDATORS=['jar'])
     def test_project_does_not_have_gtfs_file(self):
         with self.assertRaisesMessage(ValueError, 'GTFS file does not exist'):
             validate_gtfs(self.project_obj)
@@ -30,6 +46,7 @@ class TestValidateGTFS(BaseTestCase):
         self.assertEqual(self.project_obj.gtfs_validation_message, 'GTFS file does not exist')
         self.assertIsNotNone(self.project_obj.gtfs_validation_duration)
 
+    @override_settings(GTFS_VALIDATORS=['jar'])
     @mock.patch('rqworkers.jobs.subprocess')
     @mock.patch('rqworkers.jobs.glob')
     @mock.patch('rqworkers.jobs.open', mock.mock_open(
@@ -53,12 +70,12 @@ class TestValidateGTFS(BaseTestCase):
 
         mock_subprocess.call.assert_called_once()
         self.project_obj.refresh_from_db()
-        expected_message = 'filename,code,level,entity id,title,description' + os.linesep + \
-                           'a.txt,1,WARNING,no id,problem,there is a problem' + os.linesep + \
-                           'b.txt,2,ERROR,no id,problem,there is a problem' + os.linesep + \
-                           'agency.txt,2,ERROR,no id,problem,there is a problem' + os.linesep + \
-                           'stop_times.txt,2,WARNING,no id,problem,there is a problem' + os.linesep
-        self.assertEqual(self.project_obj.gtfs_validation_message, expected_message)
+        expected_notices = [('a.txt', '1', 'WARNING', 'no id'), ('b.txt', '2', 'ERROR', 'no id'),
+                            ('agency.txt', '2', 'ERROR', 'no id'), ('stop_times.txt', '2', 'WARNING', 'no id')]
+        notices = ValidationNotice.objects.filter(project=self.project_obj, run=self.project_obj.gtfs_validation_run)
+        self.assertListEqual(expected_notices,
+                             list(notices.order_by('id').values_list('filename', 'code', 'level', 'entity_id')))
+        self.assertIsNone(self.project_obj.gtfs_validation_message)
         self.assertEqual(self.project_obj.gtfs_validation_error_number, 2)
         self.assertEqual(self.project_obj.gtfs_validation_warning_number, 2)
         self.assertEqual(self.project_obj.agency_error_number, 1)
@@ -70,6 +87,198 @@ class TestValidateGTFS(BaseTestCase):
         if len(os.listdir(parent_path)) == 0:
             os.rmdir(parent_path)
 
+    @mock.patch('rqworkers.jobs.subprocess')
+    def test_native_errors_skip_gtfs_validator(self, mock_subprocess):
+        # test data has a duplicated level_id, unused stops and unused shapes
+        validate_gtfs(self.project_obj)
+
+        mock_subprocess.call.assert_not_called()
+        self.project_obj.refresh_from_db()
+        self.assertEqual(self.project_obj.gtfs_validation_error_number, 1)
+        self.assertEqual(self.project_obj.gtfs_validation_warning_number, 4)
+        self.assertEqual(self.project_obj.levels_error_number, 1)
+        self.assertEqual(self.project_obj.stops_warning_number, 2)
+        self.assertEqual(self.project_obj.shapes_warning_number, 2)
+        self.assertTrue(ValidationNotice.objects.filter(project=self.project_obj, code='duplicate_key',
+                                                        entity_id='test_level').exists())
+
+    def test_new_run_replaces_previous_notices(self):
+        validate_gtfs(self.project_obj)
+        first_run = self.project_obj.gtfs_validation_run
+
+        validate_gtfs(self.project_obj)
+
+        self.project_obj.refresh_from_db()
+        self.assertEqual(first_run + 1, self.project_obj.gtfs_validation_run)
+        self.assertEqual({self.project_obj.gtfs_validation_run},
+                         set(ValidationNotice.objects.filter(project=self.project_obj).values_list('run', flat=True)))
+        self.assertEqual(5, ValidationNotice.objects.filter(project=self.project_obj).count())
+
+    @override_settings(GTFS_VALIDATORS=['native'])
+    def test_same_content_is_not_validated_again(self):
+        self.project_obj.gtfs_file_hash = 'a' * 64
+        validate_gtfs(self.project_obj)
+        run = self.project_obj.gtfs_validation_run
+        # as ProjectViewSet.build_and_validate_gtfs_file before a new validation
+        self.project_obj.gtfs_validation_run = None
+        self.project_obj.gtfs_validation_error_number = None
+        self.project_obj.levels_error_number = 0
+        self.project_obj.save()
+
+        with mock.patch('rqworkers.jobs.validate_project') as mock_validate_project:
+            validate_gtfs(self.project_obj)
+            mock_validate_project.assert_not_called()
+
+        self.project_obj.refresh_from_db()
+        self.assertEqual(run, self.project_obj.gtfs_validation_run)
+        self.assertEqual(1, self.project_obj.gtfs_validation_error_number)
+        self.assertEqual(1, self.project_obj.levels_error_number)
+        self.assertEqual(5, ValidationNotice.objects.filter(project=self.project_obj, run=run).count())
+
+        # other content or other validators
+        self.project_obj.gtfs_file_hash = 'b' * 64
+        validate_gtfs(self.project_obj)
+        self.assertEqual(run + 1, self.project_obj.gtfs_validation_run)
+        with override_settings(GTFS_VALIDATORS=['native', 'jar']), \
+                mock.patch('rqworkers.jobs.validate_project', return_value=[]) as mock_validate_project:
+            with self.assertRaisesMessage(ValueError, 'GTFS file does not exist'):
+                validate_gtfs(self.project_obj)
+            mock_validate_project.assert_called_once()
+
+    def test_iter_json_array(self):
+        results = [{'code': str(i), 'description': 'a "quoted", [long] description ' * i} for i in range(50)]
+        file_obj = StringIO(json.dumps({'summary': {'results': 1}, 'results': results}))
+
+        self.assertEqual(results, list(iter_json_array(file_obj, 'results', chunk_size=7)))
+        self.assertEqual([], list(iter_json_array(StringIO('{"results": []}'), 'results')))
+        self.assertEqual([], list(iter_json_array(StringIO('{"summary": 1}'), 'results')))
+
+    def test_iter_json_array_only_reads_the_top_level_key(self):
+        # "results" is also a value, a nested key and part of a string before the array
+        document = '{"title": "results", "notice": {"results": [0], "description": "\\"results\\": [1]"}, ' \
+                   '"count": 12345, "results": [{"results": []}, 67890, "results"], "other": [2]}'
+        for chunk_size in [1, 7, 4096]:
+            self.assertEqual([{'results': []}, 67890, 'results'],
+                             list(iter_json_array(StringIO(document), 'results', chunk_size=chunk_size)))
+
+
+class TestValidatorServer(SimpleTestCase):
+
+    def setUp(self):
+        self.socket_dir = tempfile.mkdtemp()
+        self.socket_path = os.path.join(self.socket_dir, 'validator.sock')
+        self.server = ValidatorServer(self.socket_path, 1, 10)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.thread.join()
+        self.server.server_close()
+        shutil.rmtree(self.socket_dir)
+
+    @mock.patch('rqworkers.validator.subprocess.run')
+    def test_validate(self, mock_run):
+        validate_with_server('input.zip', 'output', self.socket_path)
+
+        arguments = mock_run.call_args[0][0]
+        self.assertEqual(os.path.abspath('input.zip'), arguments[arguments.index('-i') + 1])
+        self.assertEqual(10, mock_run.call_args[1]['timeout'])
+        metrics = request_validator(dict(command='metrics'), self.socket_path)
+        self.assertEqual(1, metrics['finished'])
+        self.assertEqual(0, metrics['running'])
+
+    @mock.patch('rqworkers.validator.subprocess.run', side_effect=subprocess.TimeoutExpired('java', 10))
+    def test_timeout(self, mock_run):
+        with self.assertRaisesMessage(ValidatorError, 'GTFS validator did not finish in time'):
+            validate_with_server('input.zip', 'output', self.socket_path)
+
+        self.assertEqual(1, request_validator(dict(command='metrics'), self.socket_path)['timed_out'])
+
+    def test_server_already_running(self):
+        with self.assertRaises(ValidatorError):
+            ValidatorServer(self.socket_path, 1, 10)
+
+    def test_server_is_not_running(self):
+        with self.assertRaises(ValidatorUnavailable):
+            validate_with_server('input.zip', 'output', os.path.join(self.socket_dir, 'other.sock'))
+
+    @mock.patch('rqworkers.jobs.subprocess')
+    @mock.patch('rqworkers.validator.subprocess.run')
+    def test_validate_gtfs_uses_server(self, mock_run, mock_subprocess):
+        project_obj = Project(pk=1, name='project', gtfs_file='project.zip')
+
+        with override_settings(GTFS_VALIDATOR_SOCKET=self.socket_path, GTFS_WORKSPACE_ROOT=self.socket_dir):
+            list(run_gtfs_validator(project_obj))
+
+        mock_run.assert_called_once()
+        mock_subprocess.call.assert_not_called()
+
+
+class TestValidationWorkspaces(SimpleTestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.running = 0
+        self.max_running = 0
+        self.max_workspaces = 0
+        self.lock = threading.Lock()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def fake_validator(self, arguments, cwd):
+        """ writes a report whose only notice names the validated file, slowly enough to overlap with other runs """
+        with self.lock:
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+            workspaces = [name for name in os.listdir(self.root) if os.path.isdir(os.path.join(self.root, name))]
+            self.max_workspaces = max(self.max_workspaces, len(workspaces))
+        input_path = arguments[arguments.index('-i') + 1]
+        output_path = arguments[arguments.index('-o') + 1]
+        self.assertTrue(output_path.startswith(cwd))
+        os.makedirs(output_path)
+        time.sleep(0.2)
+        with open(os.path.join(output_path, 'report.json'), 'w') as file_obj:
+            json.dump({'results': [{}, {'filename': 'agency.txt', 'code': 'code', 'level': 'ERROR',
+                                        'entityId': input_path, 'title': '', 'description': ''}]}, file_obj)
+        with self.lock:
+            self.running -= 1
+
+    def test_parallel_validations(self):
+        projects = [Project(pk=1, name='project', gtfs_file='project-{0}.zip'.format(i)) for i in range(6)]
+        results = dict()
+
+        def validate(project_obj):
+            results[project_obj.gtfs_file.name] = [notice[3] for notice in run_gtfs_validator(project_obj)]
+
+        with override_settings(GTFS_WORKSPACE_ROOT=self.root, GTFS_WORKSPACE_SLOTS=3,
+                               GTFS_VALIDATOR_SOCKET=os.path.join(self.root, 'none.sock')), \
+                mock.patch('rqworkers.jobs.subprocess.call', side_effect=self.fake_validator):
+            threads = [threading.Thread(target=validate, args=(project_obj,)) for project_obj in projects]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        # every run only read its own report, even for the same project
+        for project_obj in projects:
+            self.assertEqual([project_obj.gtfs_file.path], results[project_obj.gtfs_file.name])
+        # runs overlap, but the slots keep them (and their workspaces) to 3 at a time
+        self.assertLessEqual(self.max_running, 3)
+        self.assertLessEqual(self.max_workspaces, 3)
+        # only the slot locks are left
+        self.assertEqual(['.slot-0.lock', '.slot-1.lock', '.slot-2.lock'], sorted(os.listdir(self.root)))
+
+    def test_workspace_is_removed_on_errors(self):
+        with override_settings(GTFS_WORKSPACE_ROOT=self.root):
+            with self.assertRaises(ValueError):
+                with workspace('run-') as directory:
+                    open(os.path.join(directory, 'file'), 'w').close()
+                    raise ValueError()
+
+            self.assertFalse(os.path.exists(directory))
+
 
 @mock.patch('rqworkers.jobs.validate_gtfs')
 class TestBuildAndValidateGTFSFile(BaseTestCase):
@@ -123,8 +332,7 @@ class UploadGTFSFileJob(TransactionTestCase):
         previous_last_modification = self.project_obj.last_modification
 
         with self.assertRaises(ParseError, msg='File is not a zip file'):
-            with open(os.path.join(pathlib.Path(__file__).parent.absolute(), 'cat.jpg'), 'rb') as file_obj:
-                upload_gtfs_file(self.project_obj.pk, file_obj.read())
+            upload_gtfs_file(self.project_obj.pk, os.path.join(pathlib.Path(__file__).parent.absolute(), 'cat.jpg'))
 
         self.project_obj.refresh_from_db()
         self.assertEqual(self.project_obj.last_modification, previous_last_modification)
@@ -132,7 +340,7 @@ class UploadGTFSFileJob(TransactionTestCase):
     def test_upload_gtfs_file(self):
         previous_last_modification = self.project_obj.last_modification
         with open(os.path.join(pathlib.Path(__file__).parent.absolute(), 'gtfs.zip'), 'rb') as file_obj:
-            upload_gtfs_file(self.project_obj.pk, file_obj.read())
+            upload_gtfs_file(self.project_obj.pk, file_obj)
 
         self.project_obj.refresh_from_db()
         self.assertNotEqual(self.project_obj.last_modification, previous_last_modification)
@@ -154,11 +362,250 @@ class UploadGTFSFileJob(TransactionTestCase):
         self.assertEqual(ShapePoint.objects.count(), 4537)
         self.assertEqual(StopTime.objects.count(), 71755)
 
+    def test_upload_gtfs_file_shares_id_maps_between_files(self):
+        sessions = list()
+
+        def create_session(project_pk):
+            sessions.append(ImportSession(project_pk))
+            return sessions[-1]
+
+        with mock.patch('rqworkers.jobs.ImportSession', side_effect=create_session):
+            upload_gtfs_file(self.project_obj.pk, os.path.join(pathlib.Path(__file__).parent.absolute(), 'gtfs.zip'),
+                             mode=IMPORT_MODE_UPLOADERS)
+
+        self.assertEqual(len(sessions), 1)
+        session = sessions[0]
+        self.assertGreater(session.hits, 0)
+        self.assertGreater(session.queries_avoided, 0)
+        # maps kept by the session match the stored rows
+        for (model, model_key), id_map in session.maps.items():
+            self.assertDictEqual(id_map, dict(model.objects.filter_by_project(self.project_obj.pk).values_list(
+                model_key, 'id')))
+
+    def get_stored_data(self):
+        return dict(
+            stops=set(Stop.objects.values_list('stop_id', 'stop_name', 'stop_lat', 'stop_lon', 'parent_station')),
+            routes=set(Route.objects.values_list('route_id', 'agency__agency_id', 'route_type')),
+            trips=set(Trip.objects.values_list('trip_id', 'route__route_id', 'shape__shape_id', 'service_id')),
+            shape_points=set(ShapePoint.objects.values_list('shape__shape_id', 'shape_pt_sequence', 'shape_pt_lat')),
+            stop_times=set(StopTime.objects.values_list('trip__trip_id', 'stop__stop_id', 'stop_sequence',
+                                                        'arrival_time', 'departure_time')),
+            calendars=set(Calendar.objects.values_list('service_id', 'monday', 'start_date', 'end_date')),
+            feed_info=set(FeedInfo.objects.values_list('feed_publisher_name', 'feed_start_date', 'feed_id')))
+
+    def test_upload_gtfs_file_with_staging_tables(self):
+        zip_path = os.path.join(pathlib.Path(__file__).parent.absolute(), 'gtfs.zip')
+        upload_gtfs_file(self.project_obj.pk, zip_path, mode=IMPORT_MODE_UPLOADERS)
+        expected_data = self.get_stored_data()
+        stop_pks = dict(Stop.objects.values_list('stop_id', 'id'))
+
+        report = upload_gtfs_file(self.project_obj.pk, zip_path, mode=IMPORT_MODE_STAGED, workers=3)
+
+        self.assertDictEqual(self.get_stored_data(), expected_data)
+        # rows with natural id keep their primary key
+        self.assertDictEqual(dict(Stop.objects.values_list('stop_id', 'id')), stop_pks)
+        self.assertEqual(StopTime.objects.count(), 71755)
+        self.assertEqual(report['tables']['stop_times.txt']['rows'], 71755)
+        self.assertEqual(report['critical_path'][-1], 'stop_times.txt')
+        # trips wait for routes and shapes
+        self.assertGreaterEqual(report['tables']['trips.txt']['staging_start'],
+                                report['tables']['routes.txt']['staging_end'])
+        self.assertGreaterEqual(report['tables']['trips.txt']['staging_start'],
+                                report['tables']['shapes.txt']['staging_end'])
+
+    def test_upload_gtfs_file_with_staging_tables_and_unresolved_foreign_keys(self):
+        zip_file = self.create_zip_file({
+            'stop_times.txt': self.append_row(b'wrong_trip,08:00:00,08:00:00,wrong_stop,1')
+        })
+
+        with self.assertRaises(UnresolvedForeignKeyError) as context:
+            upload_gtfs_file(self.project_obj.pk, zip_file, mode=IMPORT_MODE_STAGED)
+
+        self.assertEqual(context.exception.values, ['wrong_trip'])
+        # nothing was published and staging tables were dropped
+        self.assertEqual(Stop.objects.count(), 0)
+        self.assertEqual(self.count_staging_tables(), 0)
+
+    def create_zip_file(self, transformations):
+        """ copy of gtfs.zip where the content of each file of transformations is changed by its function """
+        zip_path = os.path.join(pathlib.Path(__file__).parent.absolute(), 'gtfs.zip')
+        new_zip = BytesIO()
+        with zipfile.ZipFile(zip_path) as source, zipfile.ZipFile(new_zip, 'w') as destination:
+            for name in source.namelist():
+                content = source.read(name)
+                if name in transformations:
+                    content = transformations[name](content)
+                destination.writestr(name, content)
+        new_zip.seek(0)
+        return new_zip
+
+    @staticmethod
+    def append_row(row):
+        return lambda content: content.rstrip(b'\r\n') + b'\r\n' + row + b'\r\n'
+
+    def count_staging_tables(self):
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT count(*) FROM pg_tables WHERE tablename LIKE 'gtfs_staging_%%'")
+            return cursor.fetchone()[0]
+
+    def test_upload_gtfs_file_with_staging_tables_and_duplicated_rows(self):
+        zip_file = self.create_zip_file({'stop_times.txt': self.append_row(b'286,08:03:00,08:03:00,PV-88-15,1')})
+
+        with self.assertRaises(DuplicatedRowError) as context:
+            upload_gtfs_file(self.project_obj.pk, zip_file, mode=IMPORT_MODE_STAGED)
+
+        self.assertEqual(context.exception.csv_keys, ['trip_id', 'stop_sequence'])
+        self.assertEqual(context.exception.values, ['286/1'])
+        self.assertEqual(StopTime.objects.count(), 0)
+        self.assertEqual(self.count_staging_tables(), 0)
+
+    def test_upload_gtfs_file_with_staging_tables_while_other_import_is_running(self):
+        other_connection = connection.copy()
+        try:
+            with other_connection.cursor() as cursor:
+                cursor.execute('SELECT pg_advisory_lock(%s, %s)', [IMPORT_LOCK_ID, self.project_obj.pk])
+            with self.assertRaisesMessage(ValidationError, 'is already importing a GTFS'):
+                upload_gtfs_file(self.project_obj.pk, self.create_zip_file({}), mode=IMPORT_MODE_STAGED)
+        finally:
+            other_connection.close()
+
+        self.assertEqual(Stop.objects.count(), 0)
+
+    def test_upload_gtfs_file_with_staging_tables_drops_leftovers(self):
+        with connection.cursor() as cursor:
+            cursor.execute('CREATE UNLOGGED TABLE gtfs_staging_{0}_0a1b2c3d_stops (stop_id text)'.format(
+                self.project_obj.pk))
+
+        upload_gtfs_file(self.project_obj.pk, self.create_zip_file({}), mode=IMPORT_MODE_STAGED)
+
+        self.assertEqual(self.count_staging_tables(), 0)
+        self.assertEqual(Stop.objects.count(), 477)
+
+    @override_settings(GTFS_IMPORT_LOCK_TIMEOUT='100ms', GTFS_IMPORT_PUBLISH_ATTEMPTS=1)
+    def test_upload_gtfs_file_with_staging_tables_does_not_wait_for_editors(self):
+        upload_gtfs_file(self.project_obj.pk, self.create_zip_file({}), mode=IMPORT_MODE_STAGED)
+        Stop.objects.filter(stop_id='PV-88-15').update(stop_name='edited name')
+
+        other_connection = connection.copy()
+        try:
+            with other_connection.cursor() as cursor:
+                # an editor is in the middle of a transaction that changed the stop
+                cursor.execute('BEGIN')
+                cursor.execute('SELECT id FROM rest_api_stop WHERE stop_id = %s FOR UPDATE', ['PV-88-15'])
+                with self.assertRaises(OperationalError):
+                    upload_gtfs_file(self.project_obj.pk, self.create_zip_file({}), mode=IMPORT_MODE_STAGED)
+                cursor.execute('ROLLBACK')
+        finally:
+            other_connection.close()
+
+        self.assertEqual(Stop.objects.get(stop_id='PV-88-15').stop_name, 'edited name')
+        self.assertEqual(self.count_staging_tables(), 0)
+
+    def test_upload_gtfs_file_with_diff(self):
+        report = upload_gtfs_file(self.project_obj.pk, self.create_zip_file({}), mode=IMPORT_MODE_DIFF)
+        self.assertEqual(report['tables']['stops.txt']['added'], 477)
+        self.assertEqual(report['tables']['stop_times.txt']['added'], 71755)
+        expected_data = self.get_stored_data()
+
+        # nothing changed
+        report = upload_gtfs_file(self.project_obj.pk, self.create_zip_file({}), mode=IMPORT_MODE_DIFF)
+        for filename, table_report in report['tables'].items():
+            self.assertEqual((table_report['added'], table_report['changed'], table_report['removed']), (0, 0, 0),
+                             filename)
+        self.assertDictEqual(self.get_stored_data(), expected_data)
+
+        stop_time_pk = StopTime.objects.get(trip__trip_id='286', stop_sequence=2).pk
+        last_modification = Project.objects.get(pk=self.project_obj.pk).last_modification
+        zip_file = self.create_zip_file({
+            'stops.txt': lambda content: content.replace(b'Alonso De Ercilla esq. Ollantay', b'Alonso De Ercilla'),
+            'stop_times.txt': lambda content: self.append_row(b'286,23:00:00,23:00:00,PV-88-15,100')(
+                content.replace(b'286,08:03:00,08:03:00,PV-88-15,1\r\n', b'286,08:03:30,08:03:30,PV-88-15,1\r\n')
+                .replace(b'\r\n1438,19:18:10,19:18:10,PV-52-1,48', b''))
+        })
+        report = upload_gtfs_file(self.project_obj.pk, zip_file, mode=IMPORT_MODE_DIFF)
+
+        self.assertDictEqual({key: report['tables']['stops.txt'][key] for key in ['added', 'changed', 'removed']},
+                             dict(added=0, changed=1, removed=0))
+        self.assertDictEqual({key: report['tables']['stop_times.txt'][key] for key in ['added', 'changed', 'removed']},
+                             dict(added=1, changed=1, removed=1))
+        self.assertEqual(report['tables']['trips.txt']['changed'], 0)
+        self.assertEqual(Stop.objects.get(stop_id='PV-8-1').stop_name, 'Alonso De Ercilla')
+        self.assertEqual(StopTime.objects.count(), 71755)
+        self.assertFalse(StopTime.objects.filter(trip__trip_id='1438', stop_sequence=48).exists())
+        self.assertEqual(StopTime.objects.get(trip__trip_id='286', stop_sequence=1).arrival_time,
+                         datetime.timedelta(hours=8, minutes=3, seconds=30))
+        # rows that did not change were not rewritten
+        self.assertEqual(StopTime.objects.get(trip__trip_id='286', stop_sequence=2).pk, stop_time_pk)
+        self.assertGreater(Project.objects.get(pk=self.project_obj.pk).last_modification, last_modification)
+
+    def get_indexes(self, model):
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT indexdef FROM pg_indexes WHERE tablename = %s ORDER BY indexdef',
+                           [model._meta.db_table])
+            indexes = [row[0] for row in cursor.fetchall()]
+            cursor.execute('SELECT pg_get_constraintdef(oid) FROM pg_constraint WHERE conrelid = %s::regclass '
+                           'ORDER BY 1', [model._meta.db_table])
+            return indexes + [row[0] for row in cursor.fetchall()]
+
+    def test_upload_gtfs_file_with_deferred_indexes(self):
+        zip_path = os.path.join(pathlib.Path(__file__).parent.absolute(), 'gtfs.zip')
+        upload_gtfs_file(self.project_obj.pk, zip_path, mode=IMPORT_MODE_STAGED)
+        expected_data = self.get_stored_data()
+        expected_indexes = {model: self.get_indexes(model) for model in [ShapePoint, StopTime]}
+
+        report = upload_gtfs_file(self.project_obj.pk, zip_path, mode=IMPORT_MODE_BULK)
+
+        self.assertDictEqual(self.get_stored_data(), expected_data)
+        for model, indexes in expected_indexes.items():
+            self.assertListEqual(self.get_indexes(model), indexes)
+        self.assertIn('index_rebuild_duration', report['tables']['stop_times.txt'])
+        self.assertIn('index_rebuild_duration', report['tables']['shapes.txt'])
+        self.assertNotIn('index_rebuild_duration', report['tables']['stops.txt'])
+
+    def test_deferred_indexes_report_duplicated_rows(self):
+        upload_gtfs_file(self.project_obj.pk, self.create_zip_file({}), mode=IMPORT_MODE_STAGED)
+        indexes = self.get_indexes(StopTime)
+        stop_time = StopTime.objects.get(trip__trip_id='286', stop_sequence=1)
+
+        with self.assertRaises(DuplicatedRowError) as context, transaction.atomic(), \
+                connection.cursor() as cursor:
+            deferred_indexes = DeferredIndexes('stop_times.txt', StopTime)
+            deferred_indexes.drop(cursor)
+            stop_time.pk = None
+            stop_time.save()
+            deferred_indexes.rebuild(cursor, self.project_obj.pk)
+
+        self.assertEqual(context.exception.csv_keys, ['trip_id', 'stop_sequence'])
+        self.assertEqual(context.exception.values, ['286/1'])
+        self.assertEqual(context.exception.count, 1)
+        # indexes came back with the rollback
+        self.assertListEqual(self.get_indexes(StopTime), indexes)
+
+    @mock.patch('rqworkers.jobs.get_current_job')
+    def test_upload_gtfs_file_reports_progress_in_job_meta(self, mock_get_current_job):
+        current_job = mock_get_current_job.return_value
+        for mode in [IMPORT_MODE_STAGED, IMPORT_MODE_UPLOADERS]:
+            current_job.meta = dict()
+            current_job.save_meta.reset_mock()
+            upload_gtfs_file(self.project_obj.pk, self.create_zip_file({}), mode=mode)
+
+            progress = current_job.meta['progress']
+            self.assertEqual(progress['current_files'], [])
+            self.assertEqual(progress['phase'], 'publishing' if mode == IMPORT_MODE_STAGED else 'loading')
+            stop_times = progress['files']['stop_times.txt']
+            self.assertEqual(stop_times['status'], 'finished')
+            self.assertEqual(stop_times['rows'], 71755)
+            self.assertEqual(stop_times['bytes_read'], stop_times['total_bytes'])
+            self.assertEqual(stop_times['eta'], 0)
+            self.assertGreater(stop_times['rows_per_second'], 0)
+            # each file was saved at least when it started and when it finished
+            self.assertGreaterEqual(current_job.save_meta.call_count, 2 * len(progress['files']))
+
     def test_file_is_mandatory(self):
         previous_last_modification = self.project_obj.last_modification
         with self.assertRaises(ValidationError, msg='agency.txt file is mandatory'):
-            with open(os.path.join(pathlib.Path(__file__).parent.absolute(), 'wrong_gtfs.zip'), 'rb') as file_obj:
-                upload_gtfs_file(self.project_obj.pk, file_obj.read())
+            upload_gtfs_file(self.project_obj.pk,
+                             os.path.join(pathlib.Path(__file__).parent.absolute(), 'wrong_gtfs.zip'))
 
         self.project_obj.refresh_from_db()
         self.assertEqual(self.project_obj.last_modification, previous_last_modification)
@@ -168,7 +615,7 @@ class UploadGTFSFileJob(TransactionTestCase):
         route_obj = Route.objects.create(agency=agency_obj, route_id='route_id', route_type=1)
 
         with open(os.path.join(pathlib.Path(__file__).parent.absolute(), 'gtfs.zip'), 'rb') as file_obj:
-            upload_gtfs_file(self.project_obj.pk, file_obj.read())
+            upload_gtfs_file(self.project_obj.pk, file_obj)
 
         self.assertEqual(Agency.objects.count(), 1)
         self.assertEqual(Route.objects.count(), 11)
@@ -182,27 +629,41 @@ class TestUploadGTFSWhenProjectIsCreated(BaseTestCase):
         self.project_obj = Project.objects.create(name='project', creation_status=Project.CREATION_STATUS_LOADING_GTFS)
         self.project_obj.loading_gtfs_job_id = uuid.uuid4()
         self.project_obj.save()
+        self.zip_path, self.zip_hash = stage_uploaded_file(ContentFile(b'data'))
+
+    def tearDown(self):
+        remove_staged_file(self.zip_path)
 
     @mock.patch('rqworkers.jobs.upload_gtfs_file')
     def test_upload_gtfs(self, mock_upload_gtfs_file):
-        zip_data = 'data'
-        upload_gtfs_file_when_project_is_created(self.project_obj.pk, zip_data)
+        upload_gtfs_file_when_project_is_created(self.project_obj.pk, self.zip_path, self.zip_hash)
 
-        mock_upload_gtfs_file.assert_called_with(self.project_obj.pk, zip_data)
+        mock_upload_gtfs_file.assert_called_with(self.project_obj.pk, self.zip_path, mode=None)
         mock_upload_gtfs_file.assert_called_once()
         self.project_obj.refresh_from_db()
         self.assertEqual(self.project_obj.creation_status, Project.CREATION_STATUS_FROM_GTFS)
         self.assertEqual(self.project_obj.loading_gtfs_error_message, None)
+        # staged file is removed after the job
+        self.assertFalse(os.path.exists(self.zip_path))
 
     @mock.patch('rqworkers.jobs.upload_gtfs_file')
     def test_upload_gtfs_but_error_is_raise(self, mock_upload_gtfs_file):
         error_message = 'something goes wrong'
         mock_upload_gtfs_file.side_effect = ValueError(error_message)
-        zip_data = 'data'
-        upload_gtfs_file_when_project_is_created(self.project_obj.pk, zip_data)
+        upload_gtfs_file_when_project_is_created(self.project_obj.pk, self.zip_path, self.zip_hash)
 
-        mock_upload_gtfs_file.assert_called_with(self.project_obj.pk, zip_data)
+        mock_upload_gtfs_file.assert_called_with(self.project_obj.pk, self.zip_path, mode=None)
         mock_upload_gtfs_file.assert_called_once()
         self.project_obj.refresh_from_db()
         self.assertEqual(self.project_obj.creation_status, Project.CREATION_STATUS_ERROR_LOADING_GTFS)
         self.assertEqual(self.project_obj.loading_gtfs_error_message, error_message)
+        self.assertFalse(os.path.exists(self.zip_path))
+
+    @mock.patch('rqworkers.jobs.upload_gtfs_file')
+    def test_upload_gtfs_with_wrong_hash(self, mock_upload_gtfs_file):
+        upload_gtfs_file_when_project_is_created(self.project_obj.pk, self.zip_path, 'wrong hash')
+
+        mock_upload_gtfs_file.assert_not_called()
+        self.project_obj.refresh_from_db()
+        self.assertEqual(self.project_obj.creation_status, Project.CREATION_STATUS_ERROR_LOADING_GTFS)
+        self.assertEqual(self.project_obj.loading_gtfs_error_message, 'staged GTFS file is corrupted')
@@ -3,6 +3,7 @@ from django_rq.queues import get_connection
 from rq import cancel_job
 from rq.command import send_kill_horse_command
 from rq.exceptions import NoSuchJobError
+from rq.job import Job
 from rq.worker import Worker, WorkerStatus
 
 
@@ -19,3 +20,16 @@ def delete_job(job_id):
         cancel_job(str(job_id), connection=redis_conn)
     except NoSuchJobError:
         pass
+
+
+def get_job_progress(job_id):
+    """Progress written by a job in its meta (see rqworkers.jobs.get_import_progress), only the meta is read from
+    redis. Returns None if the job does not exist or has not reported anything yet"""
+    if job_id is None:
+        return None
+    redis_conn = get_connection()
+    job = Job(str(job_id), connection=redis_conn)
+    meta = redis_conn.hget(job.key, 'meta')
+    if meta is None:
+        return None
+    return job.serializer.loads(meta).get('progress')
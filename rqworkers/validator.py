@@ -0,0 +1,149 @@
+import json
+import os
+import socket
+import socketserver
+import subprocess
+import threading
+import time
+
+from django.conf import settings
+
+# states of a validation run by the server
+RUN_FINISHED = 'finished'
+RUN_FAILED = 'failed'
+RUN_TIMED_OUT = 'timed_out'
+
+
+class ValidatorUnavailable(Exception):
+    """ the validator server is not running, the caller can run the validator by itself """
+    pass
+
+
+class ValidatorError(Exception):
+    pass
+
+
+def get_validator_arguments(input_path, output_path):
+    """Command line of the GTFS validator (jar) for the GTFS file input_path, reports are written in output_path.
+    It also extracts the file in its working directory, which has to be the workspace of the run"""
+    return ['java', '-jar', os.path.join(settings.BASE_DIR, 'gtfsvalidators', 'gtfs-validator-v1.4.0_cli.jar'),
+            '-i', input_path,
+            '-o', output_path,
+            '--abort_on_error', 'false']
+
+
+def get_output_path(workspace):
+    """ directory of the reports of the GTFS validator in the workspace of a run """
+    return os.path.join(workspace, 'output')
+
+
+class ValidatorRequestHandler(socketserver.StreamRequestHandler):
+    """ each request is one JSON line with a command ("validate" or "metrics"), the answer is one JSON line """
+
+    def handle(self):
+        try:
+            message = json.loads(self.rfile.readline().decode('utf-8'))
+            if message.get('command') == 'validate':
+                response = dict(status=self.server.validate(message['input'], message['workspace'],
+                                                            message.get('timeout')))
+            elif message.get('command') == 'metrics':
+                response = self.server.get_metrics()
+            else:
+                response = dict(status='error', message='unknown command')
+        except (ValueError, KeyError) as e:
+            response = dict(status='error', message=str(e))
+        self.wfile.write(json.dumps(response).encode('utf-8') + b'\n')
+
+
+class ValidatorServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """Long-lived process that runs the GTFS validator for the workers of the host. At most `workers` validations run
+    at the same time, the rest wait their turn, and a validation is killed after `timeout` seconds.
+    Metrics: validations waiting and running, finished, failed and timed out ones and their total seconds waiting
+    and running"""
+    daemon_threads = True
+
+    def __init__(self, socket_path, workers, timeout):
+        self.timeout_seconds = timeout
+        self.slots = threading.BoundedSemaphore(workers)
+        self.metrics_lock = threading.Lock()
+        self.metrics = dict(workers=workers, waiting=0, running=0, finished=0, failed=0, timed_out=0,
+                            wait_seconds=0.0, run_seconds=0.0)
+        remove_stale_socket(socket_path)
+        super().__init__(socket_path, ValidatorRequestHandler)
+
+    def update_metrics(self, **changes):
+        with self.metrics_lock:
+            for name, change in changes.items():
+                self.metrics[name] += change
+
+    def get_metrics(self):
+        with self.metrics_lock:
+            return dict(self.metrics)
+
+    def run_validator(self, input_path, workspace, timeout):
+        subprocess.run(get_validator_arguments(input_path, get_output_path(workspace)), cwd=workspace,
+                       timeout=timeout, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    def validate(self, input_path, workspace, timeout=None):
+        queued_at = time.time()
+        self.update_metrics(waiting=1)
+        with self.slots:
+            started_at = time.time()
+            self.update_metrics(waiting=-1, running=1, wait_seconds=started_at - queued_at)
+            state = RUN_FINISHED
+            try:
+                self.run_validator(input_path, workspace, timeout or self.timeout_seconds)
+            except subprocess.TimeoutExpired:
+                state = RUN_TIMED_OUT
+            except (OSError, subprocess.SubprocessError):
+                state = RUN_FAILED
+            finally:
+                self.update_metrics(running=-1, run_seconds=time.time() - started_at, **{state: 1})
+        return state
+
+    def server_close(self):
+        super().server_close()
+        try:
+            os.remove(self.server_address)
+        except OSError:
+            pass
+
+
+def remove_stale_socket(socket_path):
+    """ removes the socket left by a server that is not running anymore """
+    if not os.path.exists(socket_path):
+        return
+    try:
+        request_validator(dict(command='metrics'), socket_path)
+    except ValidatorUnavailable:
+        os.remove(socket_path)
+    else:
+        raise ValidatorError('validator server is already running on {0}'.format(socket_path))
+
+
+def request_validator(message, socket_path=None):
+    """ sends message to the validator server and returns its answer, it waits while the validation is queued """
+    socket_path = socket_path or settings.GTFS_VALIDATOR_SOCKET
+    if not hasattr(socket, 'AF_UNIX') or not os.path.exists(socket_path):
+        raise ValidatorUnavailable('validator server is not running')
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        try:
+            client.connect(socket_path)
+        except (ConnectionRefusedError, FileNotFoundError):
+            raise ValidatorUnavailable('validator server is not running')
+        client.sendall(json.dumps(message).encode('utf-8') + b'\n')
+        with client.makefile('rb') as file_obj:
+            line = file_obj.readline()
+    if not line:
+        raise ValidatorError('validator server closed the connection')
+    return json.loads(line.decode('utf-8'))
+
+
+def validate_with_server(input_path, workspace, socket_path=None):
+    """ runs the GTFS validator in the validator server, raises ValidatorUnavailable if it is not running """
+    response = request_validator(dict(command='validate', input=os.path.abspath(input_path),
+                                      workspace=os.path.abspath(workspace)), socket_path)
+    if response['status'] == RUN_TIMED_OUT:
+        raise ValidatorError('GTFS validator did not finish in time')
+    if response['status'] != RUN_FINISHED:
+        raise ValidatorError('GTFS validator failed: {0}'.format(response.get('message', response['status'])))
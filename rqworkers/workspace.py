@@ -0,0 +1,46 @@
+import fcntl
+import os
+import shutil
+import tempfile
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+
+
+def get_workspace_root():
+    os.makedirs(settings.GTFS_WORKSPACE_ROOT, exist_ok=True)
+    return settings.GTFS_WORKSPACE_ROOT
+
+
+@contextmanager
+def host_slot(poll_interval=0.5):
+    """Holds one of the GTFS_WORKSPACE_SLOTS slots of the host, waiting until one is free. Each slot is a lock on a
+    file of the workspace root, shared by every worker of the host, the kernel releases it if the process dies"""
+    root = get_workspace_root()
+    while True:
+        for slot in range(settings.GTFS_WORKSPACE_SLOTS):
+            lock_file = open(os.path.join(root, '.slot-{0}.lock'.format(slot)), 'a')
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                lock_file.close()
+                continue
+            try:
+                yield slot
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+                lock_file.close()
+            return
+        time.sleep(poll_interval)
+
+
+@contextmanager
+def workspace(prefix):
+    """ directory of its own for a run, inside GTFS_WORKSPACE_ROOT, removed at the end even if the run fails """
+    with host_slot():
+        directory = tempfile.mkdtemp(prefix=prefix, dir=get_workspace_root())
+        try:
+            yield directory
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)